@@ -0,0 +1,310 @@
+"""
+Benchmarks for the hot path: decoding and encoding messages, sending and receiving them, and mapper dispatch.
+
+Everything runs against the loopback backend, so no MIDI hardware (or Mac) is needed and results are comparable
+between machines of the same kind. Results are written as JSON, so that runs can be compared:
+
+    python benchmarks/bench.py --output before.json
+    ... make a change ...
+    python benchmarks/bench.py --output after.json --compare before.json
+
+Each benchmark is run several times and the fastest run is reported, which is the least noisy estimate of what the
+code itself costs.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+
+__dir__ = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(__dir__, '..'))
+sys.path.insert(0, os.path.join(__dir__, '..', 'simplecoremidi', 'examples'))
+
+from simplecoremidi import backends, Message, MIDIDestination, MIDISource
+from simplecoremidi.clock import monotonic
+
+SOURCE = 'bench in'
+DESTINATION = 'bench out'
+
+BENCHMARKS = []
+
+
+def benchmark(count):
+    """
+    registers a benchmark. The decorated function does any setup, and returns a function that performs a given
+    number of operations; count is the default number of operations per run.
+    """
+    def register(setup):
+        BENCHMARKS.append((setup.__name__, setup, count))
+        return setup
+    return register
+
+
+def traffic():
+    """
+    a burst of the kind of traffic a foot controller and a few knobs produce: note taps, controller sweeps, program
+    changes and a clock
+    """
+    events = []
+    for number in range(1, 11):
+        events.append([0x90 | 15, number, 127])
+        events.append([0x80 | 15, number, 0])
+    for value in range(0, 128, 4):
+        events.append([0xB0 | 15, 12, value])
+        events.append([0xB0 | 15, 0x1B, value])
+        events.append([0xB0 | 15, 7, value])
+        events.append([0xF8])
+    for program in range(8):
+        events.append([0xC0 | 15, program])
+    events.append([0xE0 | 15, 0, 0x40])
+    return events
+
+
+def mapper_actions():
+    """
+    the mapping from examples/my_midi_mapper.py, with its Keystroke actions replaced by program changes: keystrokes
+    need autopy and a desktop, and run on a worker thread anyway
+    """
+    from mapper import Note, Tap, LongPress, Controller, Program, Change, Send, Compare
+    return {
+        Note(1): {LongPress(): Program(16), Tap(): Program(17)},
+        Note(6): {LongPress(): Program(18), Tap(): Program(19)},
+
+        Note(2): {Tap(): Note(2), LongPress(): Note(12)},
+        Note(7): {Tap(): Note(7, toggle=True), LongPress(): Note(17)},
+
+        Note(3): {Tap(): Note(3, toggle=True), LongPress(): Note(13, toggle=True)},
+        Note(4): {Tap(): Note(4, toggle=True), LongPress(): Note(14, toggle=True)},
+        Note(5): {Tap(): Note(5, toggle=True), LongPress(): Note(15, toggle=True)},
+        Note(8): {Tap(): Note(8, toggle=True), LongPress(): Note(18, toggle=True)},
+        Note(9): {Tap(): Note(9, toggle=True), LongPress(): Note(19, toggle=True)},
+        Note(10): {Tap(): Note(10, toggle=True), LongPress(): Note(20, toggle=True)},
+
+        Controller(0x1A): {},
+        Controller(0x1B): {Change(): Send(control=0x0C)},
+        Controller(12): {Change(): Send(), Compare(lambda m: m.value > 120, duration=1.0): Note(11, toggle=True)},
+    }
+
+
+def endpoint(endpoints, name):
+    for e in endpoints:
+        if e.name == name:
+            return e
+    raise KeyError(name)
+
+
+def cycle(items, count):
+    """items repeated until there are count of them"""
+    return (items * (count // len(items) + 1))[:count]
+
+
+@benchmark(200000)
+def parse_message(count):
+    events = cycle(traffic(), count)
+    parse = Message.parse_message
+
+    def run(n):
+        for data in events[:n]:
+            parse(data)
+    return run
+
+
+@benchmark(200000)
+def parse_message_uninterned(count):
+    events = cycle(traffic(), count)
+    parse = Message.parse_message
+    interned = Message._interned
+
+    def run(n):
+        for data in events[:n]:
+            interned.clear()
+            parse(data)
+    return run
+
+
+@benchmark(200000)
+def to_bytes(count):
+    messages = [Message.parse_message(data) for data in cycle(traffic(), count)]
+
+    def run(n):
+        for message in messages[:n]:
+            message._encoded = None
+            message.toBytes()
+    return run
+
+
+@benchmark(2000000)
+def decode_array(count):
+    from simplecoremidi import npcodec
+    npcodec.event_dtype()
+    stream = bytearray()
+    for data in cycle(traffic(), count):
+        stream.extend(data)
+    stream = bytes(stream)
+
+    def run(n):
+        npcodec.decode(stream)
+    return run
+
+
+@benchmark(100000)
+def send(count):
+    destination = endpoint(MIDIDestination.list(), DESTINATION)
+    messages = [Message.parse_message(data) for data in cycle(traffic(), count)]
+
+    def run(n):
+        send = destination.send
+        for message in messages[:n]:
+            send(message)
+    return run
+
+
+@benchmark(200000)
+def send_many(count):
+    destination = endpoint(MIDIDestination.list(), DESTINATION)
+    messages = [Message.parse_message(data) for data in cycle(traffic(), count)]
+    batch = len(traffic())
+
+    def run(n):
+        for start in range(0, n, batch):
+            destination.send_many(messages[start:min(start + batch, n)])
+    return run
+
+
+@benchmark(100000)
+def receive(count):
+    loopback = backends.get_backend()
+    port = loopback.port(SOURCE)
+    source = endpoint(MIDISource.list(), SOURCE)
+    source.receive(timeout=0)
+    events = cycle(traffic(), count)
+
+    def run(n):
+        for data in events[:n]:
+            port.inject(data)
+            source.receive(timeout=0)
+    return run
+
+
+@benchmark(200000)
+def receive_many(count):
+    loopback = backends.get_backend()
+    port = loopback.port(SOURCE)
+    source = endpoint(MIDISource.list(), SOURCE)
+    source.receive(timeout=0)
+    burst = bytearray()
+    for data in traffic():
+        burst.extend(data)
+    per_burst = len(traffic())
+
+    def run(n):
+        for i in range(0, n, per_burst):
+            port.inject(burst)
+            source.receive_many(timeout=0)
+    return run
+
+
+@benchmark(100000)
+def mapper_handle(count):
+    from mapper import MIDIMapper
+    mapper = MIDIMapper(mapper_actions(), SOURCE, DESTINATION)
+    messages = [Message.parse_message(data) for data in cycle(traffic(), count)]
+
+    def run(n):
+        handle = mapper.handle
+        for message in messages[:n]:
+            handle(message)
+    return run
+
+
+def measure(run, count, repeat):
+    best = None
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i in range(repeat):
+            start = monotonic()
+            run(count)
+            elapsed = monotonic() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return {
+        'operations': count,
+        'seconds': best,
+        'operations_per_second': count / best if best else None,
+        'microseconds_per_operation': best * 1e6 / count,
+    }
+
+
+def run_benchmarks(names=None, scale=1.0, repeat=5):
+    loopback = backends.set_backend('loopback')
+    loopback.create_port(SOURCE)
+    loopback.create_port(DESTINATION)
+    results = {}
+    for name, setup, count in BENCHMARKS:
+        if names and name not in names:
+            continue
+        count = max(1, int(count * scale))
+        try:
+            run = setup(count)
+        except ImportError as e:
+            # an optional dependency is missing
+            results[name] = {'skipped': str(e)}
+            continue
+        results[name] = measure(run, count, repeat)
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def compare(report, baseline, file=sys.stderr):
+    file.write("%-28s %14s %14s %8s\n" % ('benchmark', 'baseline op/s', 'op/s', 'speedup'))
+    for name, result in sorted(report['results'].items()):
+        before = baseline['results'].get(name)
+        if 'skipped' in result:
+            file.write("%-28s %14s %14s %8s\n" % (name, '-', 'skipped', '-'))
+            continue
+        if before is None or not before.get('operations_per_second'):
+            file.write("%-28s %14s %14.0f %8s\n" % (name, '-', result['operations_per_second'], '-'))
+            continue
+        file.write("%-28s %14.0f %14.0f %7.2fx\n" % (
+            name, before['operations_per_second'], result['operations_per_second'],
+            result['operations_per_second'] / before['operations_per_second']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("benchmarks", nargs='*', help="Benchmarks to run (default: all of %s)" % ", ".join(
+        name for name, setup, count in BENCHMARKS))
+    parser.add_argument("--output", "-o", help="Write the results to this JSON file, rather than to stdout")
+    parser.add_argument("--compare", "-c", help="A JSON file from an earlier run to compare against")
+    parser.add_argument("--repeat", "-r", type=int, default=5, help="Runs of each benchmark; the fastest is reported")
+    parser.add_argument("--scale", "-s", type=float, default=1.0, help="Multiply the number of operations by this")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.benchmarks, args.scale, args.repeat)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
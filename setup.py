@@ -4,9 +4,10 @@ import sys, os
 version = '0.3.0'
 
 if sys.platform != 'darwin':
-    raise Exception(
-        "simplecoremidi only works on Mac OS X (plaform: darwin). "
-        "Your system claims to be {}, which won't work.".format(sys.platform))
+    print(
+        "The CoreMIDI backend only works on Mac OS X (plaform: darwin). "
+        "Your system claims to be {}, so only the loopback backend will be "
+        "available.".format(sys.platform))
 
 
 install_requires = [
@@ -15,7 +16,9 @@ install_requires = [
 
 _scm_module = Extension(
     'simplecoremidi._simplecoremidi',
-    sources=['simplecoremidi/_simplecoremidi.c'],
+    sources=['simplecoremidi/_simplecoremidi.c',
+             'simplecoremidi/scmbuffer.c',
+             'simplecoremidi/scmqueue.c'],
     extra_link_args=['-framework', 'CoreFoundation',
                      '-framework', 'CoreMIDI']
     )
@@ -42,8 +45,12 @@ setup(name='simplecoremidi',
       include_package_data=True,
       zip_safe=False,
       install_requires=install_requires,
+      extras_require={
+          # vectorised decoding and encoding (simplecoremidi.npcodec)
+          'numpy': ['numpy'],
+      },
       entry_points="""
       # -*- Entry points: -*-
       """,
-      ext_modules=[_scm_module],
+      ext_modules=[_scm_module] if sys.platform == 'darwin' else [],
       )
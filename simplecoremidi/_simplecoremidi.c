@@ -4,31 +4,24 @@
 #include <CoreFoundation/CoreFoundation.h>
 #include <Python.h>
 #include <stdbool.h>
+#include <stdlib.h>
 #include <string.h>
 #include <time.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <errno.h>
 
-
-//clock_gettime is not implemented on OSX
-#ifdef __MACH__
-#include <sys/time.h>
-#define CLOCK_REALTIME 0
-int clock_gettime(int clk_id, struct timespec* t) {
-    struct timeval now;
-    int rv = gettimeofday(&now, NULL);
-    if (rv) return rv;
-    t->tv_sec  = now.tv_sec;
-    t->tv_nsec = now.tv_usec * 1000;
-    return 0;
-}
-#endif
+#include "scmbuffer.h"
+#include "scmqueue.h"
 
 struct _SCMExternalSource {
   MIDIEndpointRef source;
-  CFMutableDataRef receivedMidi;
+  /* what has been received and not yet read; its mutex also guards readyPipe and readySignalled */
+  SCMPacketQueue receivedMidi;
   MIDIPortRef port;
-  pthread_mutex_t mutex;
-  pthread_cond_t condition;
-
+  /* created on demand by get_midi_source_fd. A byte is written to readyPipe[1] when midi arrives */
+  int readyPipe[2];
+  bool readySignalled;
 };
 
 struct _SCMExternalDestination {
@@ -41,6 +34,17 @@ typedef struct _SCMExternalDestination* SCMExternalDestinationRef;
 
 
 static MIDIClientRef _midiClient;
+static MIDIPortRef _outputPort;
+static mach_timebase_info_data_t _timebase;
+
+static pthread_once_t _clientOnce = PTHREAD_ONCE_INIT;
+static pthread_mutex_t _clientMutex = PTHREAD_MUTEX_INITIALIZER;
+static pthread_cond_t _clientCreated = PTHREAD_COND_INITIALIZER;
+static bool _clientReady = false;
+/* whether the notification run loop is running, so that _setupGeneration can be trusted */
+static volatile bool _notifying = false;
+/* incremented whenever CoreMIDI reports that endpoints have been added, removed or changed */
+static volatile SInt32 _setupGeneration = 0;
 
 
 void
@@ -49,27 +53,114 @@ SCMRecvMIDIProc(const MIDIPacketList* pktList,
                 void* srcConnRefCon);
 
 
+static void
+SCMNotifyProc(const MIDINotification* message, void* refCon) {
+  switch (message->messageID) {
+  case kMIDIMsgSetupChanged:
+  case kMIDIMsgObjectAdded:
+  case kMIDIMsgObjectRemoved:
+  case kMIDIMsgPropertyChanged:
+    __sync_fetch_and_add(&_setupGeneration, 1);
+    break;
+  default:
+    break;
+  }
+}
+
+/*
+ * Notifications are delivered on the run loop that was current when the client was created, and Python's threads
+ * don't run one, so the client is created on a thread of its own which does nothing but run its loop.
+ */
+static void*
+SCMClientThread(void* arg) {
+  pthread_mutex_lock(&_clientMutex);
+  if (noErr == MIDIClientCreate(CFSTR("simple core midi client"), SCMNotifyProc, NULL, &_midiClient))
+    _notifying = true;
+  _clientReady = true;
+  pthread_cond_signal(&_clientCreated);
+  pthread_mutex_unlock(&_clientMutex);
+
+  CFRunLoopRun();
+  /* the loop only returns if it has nothing to wait on */
+  _notifying = false;
+  return NULL;
+}
+
+static void
+SCMCreateClient(void) {
+  pthread_t thread;
+  pthread_attr_t attr;
+  int failed;
+
+  pthread_attr_init(&attr);
+  pthread_attr_setdetachstate(&attr, PTHREAD_CREATE_DETACHED);
+  failed = pthread_create(&thread, &attr, SCMClientThread, NULL);
+  pthread_attr_destroy(&attr);
+  if (failed) {
+    /* still usable, but without notifications */
+    MIDIClientCreate(CFSTR("simple core midi client"), NULL, NULL, &_midiClient);
+    return;
+  }
+
+  pthread_mutex_lock(&_clientMutex);
+  while (!_clientReady)
+    pthread_cond_wait(&_clientCreated, &_clientMutex);
+  pthread_mutex_unlock(&_clientMutex);
+}
+
 static MIDIClientRef
 SCMGlobalMIDIClient() {
-  if (! _midiClient) {
-    MIDIClientCreate(CFSTR("simple core midi client"), NULL, NULL,
-                     &(_midiClient));
-  }
+  pthread_once(&_clientOnce, SCMCreateClient);
   return _midiClient;
 }
 
+/* one output port serves every destination, as MIDISend takes the destination separately */
+static MIDIPortRef
+SCMGlobalOutputPort() {
+  if (! _outputPort) {
+    OSStatus result = MIDIOutputPortCreate(SCMGlobalMIDIClient(), CFSTR("Out"), &_outputPort);
+    if (result != noErr) {
+      printf("Failed to create output port. %d\n", (int) result);
+      _outputPort = 0;
+    }
+  }
+  return _outputPort;
+}
+
+static UInt64
+SCMHostTimeToNanos(MIDITimeStamp hostTime) {
+  if (_timebase.denom == 0)
+    mach_timebase_info(&_timebase);
+  return hostTime * _timebase.numer / _timebase.denom;
+}
+
+static MIDITimeStamp
+SCMNanosToHostTime(UInt64 nanos) {
+  if (_timebase.denom == 0)
+    mach_timebase_info(&_timebase);
+  return nanos * _timebase.denom / _timebase.numer;
+}
+
+static PyObject*
+SCMGetHostTime(PyObject* self, PyObject* args) {
+  return PyFloat_FromDouble(SCMHostTimeToNanos(mach_absolute_time()) * 1e-9);
+}
+
 static void
 SCMExternalSourceDispose(SCMExternalSourceRef sourceRef) {
     if (sourceRef->port)
         MIDIPortDispose(sourceRef->port);
-  CFRelease(sourceRef->receivedMidi);
+  SCMPacketQueueDestroy(&sourceRef->receivedMidi);
+  if (sourceRef->readyPipe[0] >= 0) {
+    close(sourceRef->readyPipe[0]);
+    close(sourceRef->readyPipe[1]);
+  }
   CFAllocatorDeallocate(NULL, sourceRef);
 }
 
 static void
 SCMExternalDestinationDispose(SCMExternalSourceRef destRef) {
-    if (destRef->port)
-        MIDIPortDispose(destRef->port);
+  /* the port is shared (see SCMGlobalOutputPort), so it is left alone */
   CFAllocatorDeallocate(NULL, destRef);
 }
 
@@ -79,11 +170,15 @@ SCMConnectExternalSource(MIDIEndpointRef ref) {
     OSStatus result;
   SCMExternalSourceRef sourceRef
     = CFAllocatorAllocate(NULL, sizeof(struct _SCMExternalSource), 0);
-  sourceRef->receivedMidi = CFDataCreateMutable(NULL, 0);
   sourceRef->source = ref;
   sourceRef->port = nil;
-  pthread_mutex_init(&sourceRef->mutex, NULL);
-  pthread_cond_init(&sourceRef->condition, NULL);
+  sourceRef->readyPipe[0] = sourceRef->readyPipe[1] = -1;
+  sourceRef->readySignalled = false;
+  if (SCMPacketQueueInit(&sourceRef->receivedMidi) != 0)
+  {
+      CFAllocatorDeallocate(NULL, sourceRef);
+      return nil;
+  }
 
   result = MIDIInputPortCreate(SCMGlobalMIDIClient(),
                       CFSTR("In"),
@@ -108,19 +203,13 @@ SCMConnectExternalSource(MIDIEndpointRef ref) {
 
 static SCMExternalDestinationRef
 SCMConnectExternalDestination(MIDIEndpointRef ref) {
-    OSStatus result;
     SCMExternalDestinationRef destRef
       = CFAllocatorAllocate(NULL, sizeof(struct _SCMExternalDestination), 0);
 
     destRef->destination = ref;
-
-  result = MIDIOutputPortCreate(SCMGlobalMIDIClient(),
-                      CFSTR("Out"),
-                      &destRef->port
-                      );
-  if (result != noErr)
+    destRef->port = SCMGlobalOutputPort();
+  if (! destRef->port)
   {
-      printf("Failed to create output port. %d\n", result);
       SCMExternalDestinationDispose(destRef);
       return nil;
   }
@@ -187,6 +276,40 @@ SCMGetMidiEndpointName(PyObject* self, PyObject* args) {
   return result;
 }
 
+static PyObject *
+SCMGetMidiEndpointId(PyObject* self, PyObject* args) {
+  PyObject *pyEndpoint;
+  MIDIEndpointRef endpoint;
+  SInt32 uniqueId;
+
+  if (!PyArg_ParseTuple(args, "O", &pyEndpoint))
+      return NULL;
+  endpoint = (MIDIEndpointRef) (uintptr_t) PyCObject_AsVoidPtr(pyEndpoint);
+  if (noErr != MIDIObjectGetIntegerProperty(endpoint, kMIDIPropertyUniqueID, &uniqueId)) {
+      /* no unique id; the ref itself is at least stable while the endpoint exists */
+      return PyLong_FromUnsignedLong((unsigned long) endpoint);
+  }
+  return PyInt_FromLong(uniqueId);
+}
+
+static PyObject *
+SCMGetMidiEndpointHandle(PyObject* self, PyObject* args) {
+  PyObject *pyEndpoint;
+
+  if (!PyArg_ParseTuple(args, "O", &pyEndpoint))
+      return NULL;
+  return PyLong_FromUnsignedLong((unsigned long) (uintptr_t) PyCObject_AsVoidPtr(pyEndpoint));
+}
+
+static PyObject *
+SCMGetSetupGeneration(PyObject* self, PyObject* args) {
+  SCMGlobalMIDIClient();
+  if (!_notifying) {
+      Py_INCREF(Py_None);
+      return Py_None;
+  }
+  return PyInt_FromLong(_setupGeneration);
+}
 
 static PyObject *
 SCMGetSourceListPyObject(PyObject* self, PyObject* args) {
@@ -218,66 +341,415 @@ SCMGetDestinationListPyObject(PyObject* self, PyObject* args) {
 
 /* =========================== SEND/RECEIVE functions ===================== */
 
+#define SCM_PACKET_LIST_SIZE 65536
+/* room left in a packet list for its header and a packet's */
+#define SCM_PACKET_HEADROOM 256
+/* packet lists for single messages fit on the stack */
+#define SCM_SMALL_PACKET_LIST_SIZE 512
+
+/*
+ * adds length bytes of data, stamped with hostTime, to pktList.
+ * Whenever the list fills up it is sent and reinitialised, so arbitrarily long data can be added.
+ * Data too long for a single packet is split across several (which is only meaningful for SysEx).
+ */
+static OSStatus
+SCMPacketListAppend(SCMExternalDestinationRef destRef,
+                    MIDIPacketList* pktList,
+                    size_t listSize,
+                    MIDIPacket** pkt,
+                    MIDITimeStamp hostTime,
+                    const Byte* data,
+                    size_t length) {
+  OSStatus result;
+  size_t chunk;
+
+  while (length > 0) {
+    chunk = length < listSize - SCM_PACKET_HEADROOM ? length : listSize - SCM_PACKET_HEADROOM;
+    *pkt = MIDIPacketListAdd(pktList, listSize, *pkt, hostTime, chunk, data);
+    if (*pkt == NULL) {
+      if (pktList->numPackets == 0)
+        return -1;
+      result = MIDISend(destRef->port, destRef->destination, pktList);
+      if (result != noErr)
+        return result;
+      *pkt = MIDIPacketListInit(pktList);
+      continue;
+    }
+    data += chunk;
+    length -= chunk;
+  }
+  return noErr;
+}
+
+/*
+ * sends (destination, data) as a single packet, stamped now. data may be any object supporting the buffer protocol
+ * (str, bytearray, memoryview, array('B')...), which is copied straight into the packet list, or, more slowly, any
+ * sequence of ints bytearray() accepts.
+ */
 static PyObject*
 SCMSendMidi(PyObject* self, PyObject* args) {
   OSStatus result;
   SCMExternalDestinationRef destRef;
+  PyObject* pyDestination;
   PyObject* midiData;
-  Py_ssize_t nBytes;
-  char pktListBuf[1024+100];
-  MIDIPacketList* pktList = (MIDIPacketList*) pktListBuf;
+  PyObject* converted = NULL;
+  Py_buffer data;
+  Byte smallList[SCM_SMALL_PACKET_LIST_SIZE];
+  MIDIPacketList* pktList = (MIDIPacketList*) smallList;
+  size_t listSize = sizeof(smallList);
   MIDIPacket* pkt;
-  Byte midiDataToSend[1024];
-  UInt64 now;
-  int i;
 
-  destRef = (SCMExternalDestinationRef*) PyCObject_AsVoidPtr(PyTuple_GetItem(args, 0));
-  midiData = PyTuple_GetItem(args, 1);
-  nBytes = PySequence_Size(midiData);
+  if (!PyArg_ParseTuple(args, "OO", &pyDestination, &midiData))
+      return NULL;
+  destRef = (SCMExternalDestinationRef) PyCObject_AsVoidPtr(pyDestination);
+
+  if (!PyArg_Parse(midiData, "s*", &data)) {
+      PyErr_Clear();
+      converted = PyByteArray_FromObject(midiData);
+      if (converted == NULL)
+          return NULL;
+      if (!PyArg_Parse(converted, "s*", &data)) {
+          Py_DECREF(converted);
+          return NULL;
+      }
+  }
+
+  if ((size_t) data.len > listSize - SCM_PACKET_HEADROOM) {
+      listSize = SCM_PACKET_LIST_SIZE;
+      pktList = malloc(listSize);
+      if (pktList == NULL) {
+          PyBuffer_Release(&data);
+          Py_XDECREF(converted);
+          return PyErr_NoMemory();
+      }
+  }
+  pkt = MIDIPacketListInit(pktList);
+  result = SCMPacketListAppend(destRef, pktList, listSize, &pkt, mach_absolute_time(), data.buf, data.len);
+  if (result == noErr && pktList->numPackets > 0)
+      result = MIDISend(destRef->port, destRef->destination, pktList);
 
-  for (i = 0; i < nBytes; i++) {
-    PyObject* midiByte;
+  if (pktList != (MIDIPacketList*) smallList)
+      free(pktList);
+  PyBuffer_Release(&data);
+  Py_XDECREF(converted);
 
-    midiByte = PySequence_GetItem(midiData, i);
-    midiDataToSend[i] = PyInt_AsLong(midiByte);
+  if (result != noErr) {
+      PyErr_Format(PyExc_IOError, "failed to send midi (OSStatus %d)", (int) result);
+      return NULL;
   }
+  Py_INCREF(Py_None);
+  return Py_None;
+}
 
-  now = mach_absolute_time();
+static PyObject*
+SCMSendMidiBatch(PyObject* self, PyObject* args) {
+  OSStatus result = noErr;
+  SCMExternalDestinationRef destRef;
+  PyObject* pyDestination;
+  Py_buffer data;
+  const char* index = NULL;
+  int indexLength = 0;
+  size_t numPackets, i, start, end;
+  SCMPacketIndex packet, next;
+  MIDIPacketList* pktList;
+  MIDIPacket* pkt;
+  MIDITimeStamp now;
+
+  if (!PyArg_ParseTuple(args, "Os*|z#", &pyDestination, &data, &index, &indexLength))
+      return NULL;
+  destRef = (SCMExternalDestinationRef) PyCObject_AsVoidPtr(pyDestination);
+
+  pktList = malloc(SCM_PACKET_LIST_SIZE);
+  if (pktList == NULL) {
+      PyBuffer_Release(&data);
+      return PyErr_NoMemory();
+  }
   pkt = MIDIPacketListInit(pktList);
-  pkt = MIDIPacketListAdd(pktList, 1024+100, pkt, now, nBytes, midiDataToSend);
+  now = mach_absolute_time();
+  numPackets = indexLength / sizeof(SCMPacketIndex);
 
-  if (pkt == NULL)
-      PyErr_SetString(PyExc_TypeError, "failed to create the midi packet");
+  if (numPackets == 0) {
+      result = SCMPacketListAppend(destRef, pktList, SCM_PACKET_LIST_SIZE, &pkt, now, data.buf, data.len);
+  }
+  for (i = 0; i < numPackets && result == noErr; i++) {
+      // the index comes from a python string, so may not be aligned
+      memcpy(&packet, index + i * sizeof(SCMPacketIndex), sizeof(SCMPacketIndex));
+      if (i + 1 < numPackets) {
+          memcpy(&next, index + (i + 1) * sizeof(SCMPacketIndex), sizeof(SCMPacketIndex));
+          end = next.offset;
+      } else {
+          end = data.len;
+      }
+      start = packet.offset;
+      if (start > end || end > (size_t) data.len) {
+          free(pktList);
+          PyBuffer_Release(&data);
+          PyErr_SetString(PyExc_ValueError, "packet index does not match the data");
+          return NULL;
+      }
+      result = SCMPacketListAppend(destRef, pktList, SCM_PACKET_LIST_SIZE, &pkt,
+                                   packet.timestamp ? SCMNanosToHostTime(packet.timestamp) : now,
+                                   (const Byte*) data.buf + start, end - start);
+  }
+  if (result == noErr && pktList->numPackets > 0)
+      result = MIDISend(destRef->port, destRef->destination, pktList);
 
-  result = MIDISend(destRef->port, destRef->destination, pktList);
-  if (noErr != result)
-      PyErr_SetString(PyExc_TypeError, "failed to send the packet");
+  free(pktList);
+  PyBuffer_Release(&data);
 
+  if (result != noErr) {
+      PyErr_Format(PyExc_IOError, "failed to send midi (OSStatus %d)", (int) result);
+      return NULL;
+  }
   Py_INCREF(Py_None);
   return Py_None;
 }
 
+/*
+ * An asynchronous SysEx send. CoreMIDI reads the data from the request, and updates it, as it sends, so both live
+ * here until the completion proc has been called.
+ */
+struct _SCMSysexRequest {
+  MIDISysexSendRequest request;
+  Byte* data;
+  UInt32 length;
+  pthread_mutex_t mutex;
+  pthread_cond_t completed;
+  bool finished;
+};
+
+typedef struct _SCMSysexRequest* SCMSysexRequestRef;
+
+static void
+SCMSysexCompletionProc(MIDISysexSendRequest* request) {
+  SCMSysexRequestRef requestRef = (SCMSysexRequestRef) request->completionRefCon;
+
+  pthread_mutex_lock(&requestRef->mutex);
+  requestRef->finished = true;
+  pthread_cond_broadcast(&requestRef->completed);
+  pthread_mutex_unlock(&requestRef->mutex);
+}
+
+/* waits for up to timeout seconds (forever if negative) for a request to finish, returning whether it has */
+static bool
+SCMSysexWait(SCMSysexRequestRef requestRef, double timeout) {
+  uint64_t deadline = SCMDeadline(timeout);
+  bool finished;
+
+  pthread_mutex_lock(&requestRef->mutex);
+  while (!requestRef->finished) {
+    if (SCMCondWaitUntil(&requestRef->completed, &requestRef->mutex, deadline) == ETIMEDOUT)
+      break;
+  }
+  finished = requestRef->finished;
+  pthread_mutex_unlock(&requestRef->mutex);
+  return finished;
+}
+
+static void
+SCMSysexRequestDispose(void* refCon) {
+  SCMSysexRequestRef requestRef = (SCMSysexRequestRef) refCon;
+
+  /* CoreMIDI still holds the request until it calls the completion proc, which it does promptly once cancelled */
+  requestRef->request.complete = true;
+  SCMSysexWait(requestRef, -1);
+  pthread_cond_destroy(&requestRef->completed);
+  pthread_mutex_destroy(&requestRef->mutex);
+  free(requestRef->data);
+  free(requestRef);
+}
+
+/*
+ * starts sending (destination, data) with MIDISendSysex, and returns a request object for
+ * get_midi_sysex_progress, wait_midi_sysex and cancel_midi_sysex. The data is copied, so the caller's buffer can be
+ * reused at once.
+ */
+static PyObject*
+SCMSendSysex(PyObject* self, PyObject* args) {
+  PyObject* pyDestination;
+  SCMExternalDestinationRef destRef;
+  SCMSysexRequestRef requestRef;
+  Py_buffer data;
+  OSStatus result;
+
+  if (!PyArg_ParseTuple(args, "Os*", &pyDestination, &data))
+      return NULL;
+  destRef = (SCMExternalDestinationRef) PyCObject_AsVoidPtr(pyDestination);
+  if (data.len > (Py_ssize_t) UINT32_MAX) {
+      PyBuffer_Release(&data);
+      PyErr_SetString(PyExc_ValueError, "too much data for one SysEx request");
+      return NULL;
+  }
+
+  requestRef = calloc(1, sizeof(struct _SCMSysexRequest));
+  if (requestRef)
+      requestRef->data = malloc(data.len ? data.len : 1);
+  if (requestRef == NULL || requestRef->data == NULL) {
+      if (requestRef)
+          free(requestRef);
+      PyBuffer_Release(&data);
+      return PyErr_NoMemory();
+  }
+  memcpy(requestRef->data, data.buf, data.len);
+  requestRef->length = (UInt32) data.len;
+  PyBuffer_Release(&data);
+  pthread_mutex_init(&requestRef->mutex, NULL);
+  SCMCondInit(&requestRef->completed);
+
+  requestRef->request.destination = destRef->destination;
+  requestRef->request.data = requestRef->data;
+  requestRef->request.bytesToSend = requestRef->length;
+  requestRef->request.complete = false;
+  requestRef->request.completionProc = SCMSysexCompletionProc;
+  requestRef->request.completionRefCon = requestRef;
+
+  result = MIDISendSysex(&requestRef->request);
+  if (result != noErr) {
+      /* the completion proc won't be called */
+      requestRef->finished = true;
+      SCMSysexRequestDispose(requestRef);
+      PyErr_Format(PyExc_IOError, "failed to send SysEx (OSStatus %d)", (int) result);
+      return NULL;
+  }
+  return PyCObject_FromVoidPtr(requestRef, SCMSysexRequestDispose);
+}
+
+/* returns (bytes sent, finished) for a SysEx request */
+static PyObject*
+SCMGetSysexProgress(PyObject* self, PyObject* args) {
+  PyObject* pyRequest;
+  SCMSysexRequestRef requestRef;
+  UInt32 remaining;
+  bool finished;
+
+  if (!PyArg_ParseTuple(args, "O", &pyRequest))
+      return NULL;
+  requestRef = (SCMSysexRequestRef) PyCObject_AsVoidPtr(pyRequest);
+
+  pthread_mutex_lock(&requestRef->mutex);
+  remaining = requestRef->request.bytesToSend;
+  finished = requestRef->finished;
+  pthread_mutex_unlock(&requestRef->mutex);
+  return Py_BuildValue("(kO)", (unsigned long) (requestRef->length - remaining),
+                       finished ? Py_True : Py_False);
+}
+
+/* waits up to timeout seconds (forever if negative) for a SysEx request to finish, returning whether it has */
+static PyObject*
+SCMWaitSysex(PyObject* self, PyObject* args) {
+  PyObject* pyRequest;
+  SCMSysexRequestRef requestRef;
+  double timeout;
+  bool finished;
+
+  if (!PyArg_ParseTuple(args, "Od", &pyRequest, &timeout))
+      return NULL;
+  requestRef = (SCMSysexRequestRef) PyCObject_AsVoidPtr(pyRequest);
+
+  Py_BEGIN_ALLOW_THREADS
+  finished = SCMSysexWait(requestRef, timeout);
+  Py_END_ALLOW_THREADS
+  return PyBool_FromLong(finished);
+}
+
+/* asks CoreMIDI to stop sending a SysEx request; it finishes (see wait_midi_sysex) soon after */
+static PyObject*
+SCMCancelSysex(PyObject* self, PyObject* args) {
+  PyObject* pyRequest;
+  SCMSysexRequestRef requestRef;
+
+  if (!PyArg_ParseTuple(args, "O", &pyRequest))
+      return NULL;
+  requestRef = (SCMSysexRequestRef) PyCObject_AsVoidPtr(pyRequest);
+  requestRef->request.complete = true;
+  Py_INCREF(Py_None);
+  return Py_None;
+}
+
+/* the source's mutex must be held. Takes the source as a void* so it can be an SCMPacketQueue callback. */
+static void
+SCMSignalReady(void* refCon) {
+  SCMExternalSourceRef sourceRef = (SCMExternalSourceRef) refCon;
+  if (sourceRef->readyPipe[1] >= 0 && !sourceRef->readySignalled) {
+    sourceRef->readySignalled = (write(sourceRef->readyPipe[1], "", 1) == 1);
+  }
+}
+
+/* the source's mutex must be held */
+static void
+SCMClearReady(void* refCon) {
+  SCMExternalSourceRef sourceRef = (SCMExternalSourceRef) refCon;
+  char drain[16];
+  if (sourceRef->readySignalled) {
+    while (read(sourceRef->readyPipe[0], drain, sizeof(drain)) > 0)
+      ;
+    sourceRef->readySignalled = false;
+  }
+}
+
+/*
+ * returns a file descriptor that is readable whenever the source has midi waiting,
+ * for use with select() or an event loop.
+ */
+static PyObject*
+SCMGetSourceFd(PyObject* self, PyObject* args) {
+  PyObject* pySource;
+  SCMExternalSourceRef sourceRef;
+  int i, fd;
+
+  if (!PyArg_ParseTuple(args, "O", &pySource))
+      return NULL;
+  sourceRef = (SCMExternalSourceRef) PyCObject_AsVoidPtr(pySource);
+
+  pthread_mutex_lock(&sourceRef->receivedMidi.mutex);
+  if (sourceRef->readyPipe[0] < 0) {
+    if (pipe(sourceRef->readyPipe) != 0) {
+      sourceRef->readyPipe[0] = sourceRef->readyPipe[1] = -1;
+      pthread_mutex_unlock(&sourceRef->receivedMidi.mutex);
+      return PyErr_SetFromErrno(PyExc_OSError);
+    }
+    for (i = 0; i < 2; i++) {
+      fcntl(sourceRef->readyPipe[i], F_SETFL, O_NONBLOCK);
+      fcntl(sourceRef->readyPipe[i], F_SETFD, FD_CLOEXEC);
+    }
+    if (SCMPacketBufferSize(&sourceRef->receivedMidi.buffer) > 0)
+      SCMSignalReady(sourceRef);
+  }
+  fd = sourceRef->readyPipe[0];
+  pthread_mutex_unlock(&sourceRef->receivedMidi.mutex);
+  return PyInt_FromLong(fd);
+}
+
+/*
+ * waits for up to timeout seconds (forever if negative) for midi to arrive, and moves everything received into
+ * taken. The GIL is released while waiting, so other Python threads run meanwhile; the source's mutex is never
+ * held while the GIL is being taken back. Returns the number of bytes taken: 0 on timeout.
+ */
+static size_t
+SCMWaitForMidi(SCMExternalSourceRef sourceRef, double timeout, SCMPacketBuffer* taken) {
+  size_t numBytes;
+
+  Py_BEGIN_ALLOW_THREADS
+  numBytes = SCMPacketQueueTake(&sourceRef->receivedMidi, timeout, taken, SCMClearReady, sourceRef);
+  Py_END_ALLOW_THREADS
+  return numBytes;
+}
+
 static PyObject*
 SCMRecvMidi(PyObject* self, PyObject* args) {
+  PyObject* pySource;
   PyObject* receivedMidiT;
-  UInt8* bytePtr;
-  int i;
-  CFIndex numBytes;
-  SCMExternalSourceRef sourceRef
-    = (SCMExternalSourceRef) PyCObject_AsVoidPtr(PyTuple_GetItem(args, 0));
-  int timeout_seconds = PyLong_AsLong(PyTuple_GetItem(args, 1));
-  struct timespec abstime;
-  int result;
-  clock_gettime(CLOCK_REALTIME, &abstime);
-  abstime.tv_sec += timeout_seconds;
+  SCMExternalSourceRef sourceRef;
+  SCMPacketBuffer taken;
+  double timeout;
+  size_t i, numBytes;
 
-  while (true) {
+  if (!PyArg_ParseTuple(args, "Od", &pySource, &timeout))
+      return NULL;
+  sourceRef = (SCMExternalSourceRef) PyCObject_AsVoidPtr(pySource);
 
-      numBytes = CFDataGetLength(sourceRef->receivedMidi);
-      if (numBytes > 0) break;
-      result = pthread_cond_timedwait(&sourceRef->condition, &sourceRef->mutex, &abstime);
-      if (result == ETIMEDOUT) break;
-  }
+  SCMPacketBufferInit(&taken);
+  numBytes = SCMWaitForMidi(sourceRef, timeout, &taken);
 
   if (numBytes == 0)
   {
@@ -287,48 +759,159 @@ SCMRecvMidi(PyObject* self, PyObject* args) {
   else
   {
       receivedMidiT = PyTuple_New(numBytes);
-      bytePtr = CFDataGetMutableBytePtr(sourceRef->receivedMidi);
-      for (i = 0; i < numBytes; i++, bytePtr++) {
-        PyObject* midiByte = PyInt_FromLong(*bytePtr);
-        PyTuple_SetItem(receivedMidiT, i, midiByte);
+      for (i = 0; receivedMidiT && i < numBytes; i++) {
+        PyTuple_SET_ITEM(receivedMidiT, i, PyInt_FromLong(taken.data[i]));
       }
-      CFDataDeleteBytes(sourceRef->receivedMidi, CFRangeMake(0, numBytes));
   }
 
-  pthread_mutex_unlock(&sourceRef->mutex);
+  SCMPacketQueueRecycle(&sourceRef->receivedMidi, &taken);
   return receivedMidiT;
 }
 
+/*
+ * returns None on timeout, otherwise a tuple of (data, index):
+ * data is a string holding every byte received, and index is a string of packed
+ * SCMPacketIndex structs giving the offset and arrival time of each packet.
+ * The timeout is in seconds, and may be fractional; a negative timeout waits forever.
+ */
+static PyObject*
+SCMRecvMidiPackets(PyObject* self, PyObject* args) {
+  PyObject* pySource;
+  PyObject* result;
+  double timeout;
+  SCMExternalSourceRef sourceRef;
+  SCMPacketBuffer taken;
+
+  if (!PyArg_ParseTuple(args, "Od", &pySource, &timeout))
+      return NULL;
+  sourceRef = (SCMExternalSourceRef) PyCObject_AsVoidPtr(pySource);
+
+  SCMPacketBufferInit(&taken);
+  if (SCMWaitForMidi(sourceRef, timeout, &taken) == 0)
+  {
+      Py_INCREF(Py_None);
+      result = Py_None;
+  }
+  else
+  {
+      result = Py_BuildValue("(s#s#)",
+                             taken.data, (int) taken.length,
+                             (char*) taken.packets,
+                             (int) (taken.numPackets * sizeof(SCMPacketIndex)));
+  }
+
+  SCMPacketQueueRecycle(&sourceRef->receivedMidi, &taken);
+  return result;
+}
+
+/*
+ * configures the bounds of a source's receive buffer: (source, limit in bytes, policy), where policy is one of the
+ * SCMOverflowPolicy values. A limit of 0 lets the buffer grow without bound.
+ */
+static PyObject*
+SCMSetSourceBuffer(PyObject* self, PyObject* args) {
+  PyObject* pySource;
+  SCMExternalSourceRef sourceRef;
+  SCMPacketQueue* queue;
+  Py_ssize_t limit;
+  int policy, result;
+
+  if (!PyArg_ParseTuple(args, "Oni", &pySource, &limit, &policy))
+      return NULL;
+  if (limit < 0) {
+      PyErr_SetString(PyExc_ValueError, "the buffer limit can't be negative");
+      return NULL;
+  }
+  sourceRef = (SCMExternalSourceRef) PyCObject_AsVoidPtr(pySource);
+  queue = &sourceRef->receivedMidi;
+
+  pthread_mutex_lock(&queue->mutex);
+  result = SCMPacketBufferSetLimit(&queue->buffer, (size_t) limit, (SCMOverflowPolicy) policy);
+  if (limit > 0)
+    SCMPacketBufferFree(&queue->spare);
+  pthread_cond_broadcast(&queue->spaceReady);
+  pthread_mutex_unlock(&queue->mutex);
+  if (result != 0) {
+      PyErr_SetString(PyExc_ValueError, "unknown overflow policy");
+      return NULL;
+  }
+  Py_INCREF(Py_None);
+  return Py_None;
+}
+
+/* returns (overflows, dropped packets, dropped bytes, coalesced messages) for a source */
+static PyObject*
+SCMGetSourceOverflow(PyObject* self, PyObject* args) {
+  PyObject* pySource;
+  SCMExternalSourceRef sourceRef;
+  SCMOverflowCounters counters;
+
+  if (!PyArg_ParseTuple(args, "O", &pySource))
+      return NULL;
+  sourceRef = (SCMExternalSourceRef) PyCObject_AsVoidPtr(pySource);
+
+  pthread_mutex_lock(&sourceRef->receivedMidi.mutex);
+  counters = sourceRef->receivedMidi.buffer.counters;
+  pthread_mutex_unlock(&sourceRef->receivedMidi.mutex);
+  return Py_BuildValue("(KKKK)",
+                       (unsigned PY_LONG_LONG) counters.overflows,
+                       (unsigned PY_LONG_LONG) counters.droppedPackets,
+                       (unsigned PY_LONG_LONG) counters.droppedBytes,
+                       (unsigned PY_LONG_LONG) counters.coalesced);
+}
+
+/* how long a read proc waits for room under SCM_OVERFLOW_BLOCK before dropping the packet */
+#define SCM_BLOCK_TIMEOUT_SECONDS 1.0
+
 void
 SCMRecvMIDIProc(const MIDIPacketList* pktList,
                 void* readProcRefCon,
                 void* srcConnRefCon) {
   SCMExternalSourceRef sourceRef = (SCMExternalSourceRef) readProcRefCon;
+  SCMPacketQueue* queue = &sourceRef->receivedMidi;
   int i;
   const MIDIPacket* pkt;
+  UInt64 timestamp;
 
   // TODO: timeout pthread_mutex_timedlock
-  pthread_mutex_lock(&sourceRef->mutex);
+  pthread_mutex_lock(&queue->mutex);
   pkt = &pktList->packet[0];
   for (i = 0; i < pktList->numPackets; i++) {
-    CFDataAppendBytes(sourceRef->receivedMidi, pkt->data, pkt->length);
+    // a zero timestamp means "now"
+    timestamp = SCMHostTimeToNanos(pkt->timeStamp ? pkt->timeStamp : mach_absolute_time());
+    SCMPacketQueuePut(queue, pkt->data, pkt->length, timestamp,
+                      SCM_BLOCK_TIMEOUT_SECONDS, SCMSignalReady, sourceRef);
     pkt = MIDIPacketNext(pkt);
   }
 
-  pthread_cond_signal(&sourceRef->condition);
-  pthread_mutex_unlock(&sourceRef->mutex);
+  pthread_cond_signal(&queue->dataReady);
+  SCMSignalReady(sourceRef);
+  pthread_mutex_unlock(&queue->mutex);
 }
 
 
 
 static PyMethodDef SimpleCoreMidiMethods[] = {
   {"get_midi_endpoint_name", SCMGetMidiEndpointName, METH_VARARGS, "Get the name of a midi endpoint."},
+  {"get_midi_endpoint_id", SCMGetMidiEndpointId, METH_VARARGS, "Get the unique id of a midi endpoint, which is the same in every endpoint list."},
+  {"get_midi_endpoint_handle", SCMGetMidiEndpointHandle, METH_VARARGS, "Get the MIDIEndpointRef a midi endpoint object holds, as a number. Unlike the unique id, it changes if the endpoint is recreated."},
+  {"get_host_time", SCMGetHostTime, METH_NOARGS, "Get the host clock CoreMIDI timestamps packets with, in seconds since boot."},
+  {"get_setup_generation", SCMGetSetupGeneration, METH_NOARGS, "Get a number that changes whenever MIDI endpoints are added, removed or changed, or None if changes can't be detected."},
   {"get_midi_source_list", SCMGetSourceListPyObject, METH_NOARGS, "Get the available MIDI sources."},
   {"get_midi_source", SCMGetSourcePyObject, METH_VARARGS, "Get a MIDI destination object."},
   {"get_midi_destination", SCMGetDestinationPyObject, METH_VARARGS, "Get a MIDI destination object."},
   {"get_midi_destination_list", SCMGetDestinationListPyObject, METH_NOARGS, "Get the available MIDI destinations."},
-  {"send_midi", SCMSendMidi, METH_VARARGS, "Send midi data tuple to an external destination."},
+  {"send_midi", SCMSendMidi, METH_VARARGS, "Send midi data to an external destination as one packet. The data may be a string or any other object supporting the buffer protocol, or a sequence of ints."},
+  {"send_midi_batch", SCMSendMidiBatch, METH_VARARGS, "Send a string of midi data to an external destination, packed into as few packet lists as possible. An optional packet index string, in the format returned by receive_midi_packets, gives the offset and timestamp (in nanoseconds, 0 meaning now) of each packet."},
+  {"send_midi_sysex", SCMSendSysex, METH_VARARGS, "Start sending a string of SysEx data to an external destination asynchronously, paced by CoreMIDI. Returns a request for get_midi_sysex_progress, wait_midi_sysex and cancel_midi_sysex."},
+  {"get_midi_sysex_progress", SCMGetSysexProgress, METH_VARARGS, "Get a SysEx request's progress: (bytes sent, finished)."},
+  {"wait_midi_sysex", SCMWaitSysex, METH_VARARGS, "Wait up to timeout seconds (forever if negative) for a SysEx request to finish. Returns whether it has."},
+  {"cancel_midi_sysex", SCMCancelSysex, METH_VARARGS, "Stop sending a SysEx request."},
   {"receive_midi", SCMRecvMidi, METH_VARARGS, "Receive midi data from an external source. NOTE: this method will block until midi data is received."},
+  {"get_midi_source_fd", SCMGetSourceFd, METH_VARARGS, "Get a file descriptor that becomes readable when a MIDI source has data waiting."},
+  {"set_midi_source_buffer", SCMSetSourceBuffer, METH_VARARGS, "Bound a MIDI source's receive buffer: (source, limit in bytes, overflow policy). Policies are 0 (grow), 1 (block), 2 (drop oldest), 3 (drop newest) and 4 (coalesce)."},
+  {"get_midi_source_overflow", SCMGetSourceOverflow, METH_VARARGS, "Get a MIDI source's overflow counters: (overflows, dropped packets, dropped bytes, coalesced messages)."},
+  {"receive_midi_packets", SCMRecvMidiPackets, METH_VARARGS, "Receive midi data from an external source as a (data, packet index) tuple of strings. Each packet index entry is a pair of native uint64 values: the packet's offset in data, and its arrival time in nanoseconds."},
   {NULL, NULL, 0, NULL}
 };
 
@@ -0,0 +1,67 @@
+"""
+asyncio support for MIDISource (Python 3 only).
+
+Rather than blocking a thread in receive(), these wait for the source's
+readiness file descriptor with the event loop's add_reader, so any number of
+sources can be serviced by one loop:
+
+    async for message in source.stream():
+        ...
+"""
+import asyncio
+
+
+async def wait_readable(source, timeout=None):
+    """wait until source has data to read. Returns False if timeout seconds pass first"""
+    loop = asyncio.get_running_loop()
+    fd = source.fileno()
+    ready = loop.create_future()
+
+    def on_readable():
+        if not ready.done():
+            ready.set_result(True)
+
+    loop.add_reader(fd, on_readable)
+    try:
+        return await asyncio.wait_for(ready, timeout)
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        loop.remove_reader(fd)
+
+
+async def areceive_many(source, timeout=None):
+    """every message received so far, waiting up to timeout seconds if there are none"""
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    while True:
+        messages = source.receive_many(timeout=0)
+        if messages:
+            return messages
+        remaining = None if deadline is None else deadline - loop.time()
+        if remaining is not None and remaining <= 0:
+            return []
+        if not await wait_readable(source, remaining):
+            return []
+
+
+async def areceive(source, timeout=None):
+    """the next message, or None if none arrives within timeout seconds"""
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    while True:
+        message = source.receive(timeout=0)
+        if message is not None:
+            return message
+        remaining = None if deadline is None else deadline - loop.time()
+        if remaining is not None and remaining <= 0:
+            return None
+        if not await wait_readable(source, remaining):
+            return None
+
+
+async def stream(source):
+    """yields messages from source as they arrive, forever"""
+    while True:
+        for message in await areceive_many(source):
+            yield message
@@ -0,0 +1,212 @@
+"""
+MIDI backends.
+
+MIDISource and MIDIDestination don't talk to CoreMIDI directly; they go through
+whichever backend is currently selected. The 'coremidi' backend wraps the C
+extension and only works on OS X. The 'loopback' backend is pure Python and runs
+anywhere, which makes it useful for testing and load testing.
+
+The backend is chosen by the SIMPLECOREMIDI_BACKEND environment variable, or by
+calling set_backend() before any endpoints are used.
+"""
+import os
+
+from ..clock import monotonic
+
+# what a bounded receive buffer does with a packet that doesn't fit:
+#   grow         -- nothing; the buffer is unbounded
+#   block        -- the sender waits (for up to a second) for the buffer to be read
+#   drop-oldest  -- the oldest packets are discarded to make room
+#   drop-newest  -- the new packet is discarded
+#   coalesce     -- superseded controller, pitch bend and aftertouch values are discarded, keeping only the latest
+#                   of each, then the oldest packets if that isn't enough
+OVERFLOW_POLICIES = ('grow', 'block', 'drop-oldest', 'drop-newest', 'coalesce')
+
+
+class Backend(object):
+    """
+    The interface a backend must implement.
+
+    Endpoint refs and connections are opaque to the rest of the package; they are
+    only ever passed back to the backend that produced them.
+    """
+    name = None
+
+    def source_list(self):
+        """a sequence of refs to the available sources"""
+        raise NotImplementedError
+
+    def destination_list(self):
+        """a sequence of refs to the available destinations"""
+        raise NotImplementedError
+
+    def endpoint_name(self, ref):
+        raise NotImplementedError
+
+    def endpoint_id(self, ref):
+        """
+        a hashable value identifying the endpoint ref refers to, which is the same whichever listing the ref came
+        from. Refs that are themselves stable can serve as their own ids.
+        """
+        return ref
+
+    def endpoint_handle(self, ref):
+        """
+        a hashable value that changes when the endpoint with a given id is recreated (a device unplugged and plugged
+        back in, say), so that connections made through its old ref can be replaced. Refs that are themselves
+        stable can serve as their own handles.
+        """
+        return ref
+
+    def setup_generation(self):
+        """
+        a value that changes whenever endpoints are added, removed or renamed, so that listings can be cached
+        until it does. None means the backend can't tell, and nothing should be cached.
+        """
+        return None
+
+    def connect_source(self, ref):
+        """returns a connection from which receive() can read, or None if the source is unavailable"""
+        raise NotImplementedError
+
+    def connect_destination(self, ref):
+        """returns a connection to which send() can write, or None if the destination is unavailable"""
+        raise NotImplementedError
+
+    def disconnect(self, connection):
+        """
+        releases a connection returned by connect_source() or connect_destination(). Backends whose connections
+        are released when they are garbage collected needn't do anything.
+        """
+        pass
+
+    def send(self, destination, data):
+        """
+        send bytes to a connected destination as one packet. data may be any object supporting the buffer protocol
+        (bytes, bytearray, memoryview, array('B')); backends should read it in place rather than copy it.
+        """
+        raise NotImplementedError
+
+    def send_batch(self, destination, data, packets=None):
+        """
+        send a block of bytes holding any number of messages. packets is an optional list of (offset, timestamp)
+        pairs, in the same form receive_packets() returns, giving where each packet starts and when it should be
+        delivered (in seconds, on the clock.monotonic base; 0 means now).
+
+        Backends that can't schedule delivery send everything immediately.
+        """
+        if not packets:
+            return self.send(destination, data)
+        offsets = [offset for offset, timestamp in packets] + [len(data)]
+        for start, end in zip(offsets, offsets[1:]):
+            self.send(destination, data[start:end])
+
+    def send_sysex(self, destination, data):
+        """
+        starts sending a block of SysEx data to a connected destination, returning a request to pass to
+        sysex_progress(), wait_sysex() and cancel_sysex(). Backends that can pace SysEx do so in the background;
+        this one sends everything at once, so the request is finished before it is returned.
+        """
+        self.send_batch(destination, data)
+        return len(data)
+
+    def sysex_progress(self, request):
+        """a tuple of (bytes sent, finished) for a SysEx request"""
+        return request, True
+
+    def wait_sysex(self, request, timeout=None):
+        """waits up to timeout seconds (forever if None) for a SysEx request to finish, returning whether it has"""
+        return True
+
+    def cancel_sysex(self, request):
+        """stops sending a SysEx request. It may still take a moment to finish."""
+        pass
+
+    def receive(self, source, timeout):
+        """
+        returns the bytes received by a connected source since the last call, blocking for up to timeout
+        seconds if there are none. Returns an empty sequence (or None) on timeout.
+        """
+        raise NotImplementedError
+
+    def receive_packets(self, source, timeout):
+        """
+        like receive(), but returns a tuple of (data, packets) where packets is a list of (offset, timestamp)
+        pairs giving where each packet starts in data and when it arrived. Returns None on timeout.
+
+        Backends that don't keep packet boundaries treat everything received as a single packet.
+        """
+        data = self.receive(source, timeout)
+        if not data:
+            return None
+        return data, [(0, monotonic())]
+
+    def set_buffer_limit(self, source, limit, policy):
+        """
+        bounds the receive buffer of a connected source to limit bytes (0 for no limit), with one of
+        OVERFLOW_POLICIES deciding what happens when it is full
+        """
+        raise NotImplementedError("the %s backend can't bound its receive buffers" % self.name)
+
+    def overflow_counters(self, source):
+        """
+        a dict of what a connected source's receive buffer has done when full: overflows (packets that didn't fit),
+        dropped_packets, dropped_bytes and coalesced (messages discarded in favour of later values)
+        """
+        raise NotImplementedError("the %s backend doesn't count overflows" % self.name)
+
+    def fileno(self, source):
+        """
+        a file descriptor that is readable whenever a connected source has data waiting, for use with select() or
+        an event loop. Reading from the source clears it again.
+        """
+        raise NotImplementedError("the %s backend can't signal readiness with a file descriptor" % self.name)
+
+
+_factories = {}
+_backend = None
+
+
+def register_backend(name, factory):
+    """make a backend available to set_backend(). factory is called with no arguments"""
+    _factories[name] = factory
+
+
+def set_backend(backend):
+    """select the backend, either by name or by passing a Backend instance"""
+    global _backend
+    if not isinstance(backend, Backend):
+        try:
+            factory = _factories[backend]
+        except KeyError:
+            raise ValueError("Unknown MIDI backend %r. Available backends: %s" % (
+                backend, ", ".join(sorted(_factories))))
+        backend = factory()
+    _backend = backend
+    return backend
+
+
+def backend_selected():
+    """whether this process has selected a backend, and so may already be connected to MIDI"""
+    return _backend is not None
+
+
+def get_backend():
+    """the current backend, creating the default one if necessary"""
+    if _backend is None:
+        set_backend(os.environ.get('SIMPLECOREMIDI_BACKEND', 'coremidi'))
+    return _backend
+
+
+def _coremidi():
+    from .coremidi import CoreMIDIBackend
+    return CoreMIDIBackend()
+
+
+def _loopback():
+    from .loopback import LoopbackBackend
+    return LoopbackBackend()
+
+
+register_backend('coremidi', _coremidi)
+register_backend('loopback', _loopback)
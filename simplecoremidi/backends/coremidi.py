@@ -0,0 +1,108 @@
+"""
+The CoreMIDI backend: a thin wrapper around the _simplecoremidi extension.
+"""
+import struct
+
+from . import Backend, OVERFLOW_POLICIES
+from .. import _simplecoremidi as cfuncs
+
+# the layout of SCMPacketIndex: offset, timestamp (nanoseconds)
+_packet_index = struct.Struct('=QQ')
+
+
+# how far from now (in seconds) a packet may be scheduled. Timestamps further out are almost certainly on the wrong
+# clock: CoreMIDI would hold a packet stamped in the far future indefinitely.
+SCHEDULE_WINDOW = 10.0
+
+
+def _nanos(timestamp, now):
+    """converts a delivery time on the clock.monotonic base to host time nanoseconds, 0 meaning now"""
+    if not timestamp:
+        return 0
+    if abs(timestamp - now) > SCHEDULE_WINDOW:
+        raise ValueError("timestamp %r is more than %g seconds from now (%r): timestamps must be on the "
+                         "clock.monotonic base" % (timestamp, SCHEDULE_WINDOW, now))
+    # already due: send it straight away
+    return 0 if timestamp <= now else int(timestamp * 1e9)
+
+
+def _timeout(timeout):
+    # the extension waits with microsecond resolution, and forever if the timeout is negative
+    return -1.0 if timeout is None else float(timeout)
+
+
+class CoreMIDIBackend(Backend):
+    name = 'coremidi'
+
+    def source_list(self):
+        return cfuncs.get_midi_source_list()
+
+    def destination_list(self):
+        return cfuncs.get_midi_destination_list()
+
+    def endpoint_name(self, ref):
+        return cfuncs.get_midi_endpoint_name(ref)
+
+    def endpoint_id(self, ref):
+        # each listing wraps the refs afresh, so they can't be compared, but unique ids can
+        return cfuncs.get_midi_endpoint_id(ref)
+
+    def endpoint_handle(self, ref):
+        return cfuncs.get_midi_endpoint_handle(ref)
+
+    def setup_generation(self):
+        return cfuncs.get_setup_generation()
+
+    def connect_source(self, ref):
+        return cfuncs.get_midi_source(ref)
+
+    def connect_destination(self, ref):
+        return cfuncs.get_midi_destination(ref)
+
+    def send(self, destination, data):
+        return cfuncs.send_midi(destination, data)
+
+    def send_batch(self, destination, data, packets=None):
+        index = None
+        if packets:
+            now = cfuncs.get_host_time()
+            index = b''.join(_packet_index.pack(offset, _nanos(timestamp, now)) for offset, timestamp in packets)
+        return cfuncs.send_midi_batch(destination, data, index)
+
+    def send_sysex(self, destination, data):
+        return cfuncs.send_midi_sysex(destination, data)
+
+    def sysex_progress(self, request):
+        return cfuncs.get_midi_sysex_progress(request)
+
+    def wait_sysex(self, request, timeout=None):
+        return cfuncs.wait_midi_sysex(request, _timeout(timeout))
+
+    def cancel_sysex(self, request):
+        cfuncs.cancel_midi_sysex(request)
+
+    def receive(self, source, timeout):
+        received = cfuncs.receive_midi_packets(source, _timeout(timeout))
+        return received[0] if received else None
+
+    def receive_packets(self, source, timeout):
+        received = cfuncs.receive_midi_packets(source, _timeout(timeout))
+        if not received:
+            return None
+        data, index = received
+        size = _packet_index.size
+        return data, [(offset, timestamp * 1e-9)
+                      for offset, timestamp in (_packet_index.unpack_from(index, i)
+                                                for i in range(0, len(index), size))]
+
+    def set_buffer_limit(self, source, limit, policy):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy %r. Policies are: %s" % (policy, ", ".join(OVERFLOW_POLICIES)))
+        cfuncs.set_midi_source_buffer(source, limit, OVERFLOW_POLICIES.index(policy))
+
+    def overflow_counters(self, source):
+        return dict(zip(('overflows', 'dropped_packets', 'dropped_bytes', 'coalesced'),
+                        cfuncs.get_midi_source_overflow(source)))
+
+    def fileno(self, source):
+        return cfuncs.get_midi_source_fd(source)
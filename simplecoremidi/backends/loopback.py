@@ -0,0 +1,468 @@
+"""
+A pure Python, in-memory backend.
+
+Each LoopbackPort appears as both a source and a destination with the same name.
+Anything sent to the destination (or injected with LoopbackPort.inject) is
+received by every connection to the source, so a mapping pipeline can be driven
+and observed end to end without any MIDI hardware, at whatever rate the test
+can generate.
+
+    from simplecoremidi import backends, MIDISource, MIDIDestination, NoteOnMessage
+    loopback = backends.set_backend('loopback')
+    loopback.create_port('test')
+    source = [s for s in MIDISource.list() if s.name == 'test'][0]
+    source.receive(timeout=0)   # connect before sending
+    [d for d in MIDIDestination.list() if d.name == 'test'][0].send(NoteOnMessage(1, 60, 100))
+    source.receive()
+"""
+import os
+from collections import deque
+from threading import Condition, Lock
+
+from . import Backend, OVERFLOW_POLICIES
+from ..clock import monotonic
+from ..parser import DATA_LENGTHS, SYSEX_START, SYSEX_END, REALTIME_MIN
+
+# how long put() waits for room under the block policy before dropping the packet
+BLOCK_TIMEOUT = 1.0
+
+_SYSEX_END = bytearray([SYSEX_END])
+
+
+class _Span(object):
+    """a message within a held packet, as the coalesce policy tracks it"""
+    __slots__ = ('packet', 'offset', 'length', 'status', 'running', 'key', 'alive')
+
+    def __init__(self, packet, offset, length, status, running, key):
+        self.packet = packet
+        self.offset = offset
+        self.length = length
+        self.status = status
+        # whether the message relies on running status, having no status byte of its own
+        self.running = running
+        self.key = key
+        self.alive = True
+
+
+def _coalescing_key(status, data1):
+    """the key under which later values of a message supersede earlier ones, or None"""
+    kind = status & 0xF0
+    if kind in (0xA0, 0xB0):
+        return status, data1
+    if kind in (0xD0, 0xE0):
+        return status
+    return None
+
+
+def _spans(data, packet, start, end):
+    """splits the packet data[start:end] into messages, as scmbuffer.c's SCMNextMessage does"""
+    spans = []
+    running_status = 0
+    pos = start
+    while pos < end:
+        byte = data[pos]
+        running = False
+        if byte >= REALTIME_MIN:
+            status, length = byte, 1
+        elif byte == SYSEX_START:
+            stop = data.find(_SYSEX_END, pos, end)
+            status, length = byte, (stop + 1 if stop >= 0 else end) - pos
+            running_status = 0
+        elif byte >= 0x80:
+            status, length = byte, 1 + DATA_LENGTHS[byte]
+            running_status = byte if byte < 0xF0 else 0
+        elif running_status:
+            status, length, running = running_status, DATA_LENGTHS[running_status], True
+        else:
+            # a stray data byte
+            status, length = 0, 1
+        key = None
+        if pos + length <= end:
+            if length > 1 or running:
+                key = _coalescing_key(status, data[pos + (0 if running else 1)])
+        else:
+            length = end - pos
+        spans.append(_Span(packet, pos, length, status, running, key))
+        pos += length
+    return spans
+
+
+class LoopbackConnection(object):
+    """
+    a connection to a LoopbackPort's source side, buffering bytes until they are received.
+
+    The buffer can be bounded with set_limit, and then behaves as the CoreMIDI backend's does (see scmbuffer.h):
+    packets dropped from the front are skipped over rather than moved, and the survivors moved to the front once as
+    many have been dropped as are held. Under the coalesce policy each controller, pitch bend and aftertouch message
+    held is indexed by what it controls, so an overflow only visits the messages it discards and their packets.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self._condition = Condition(Lock())
+        self._ready_pipe = None
+        self._ready_signalled = False
+        self.limit = 0
+        self.policy = 'grow'
+        self.counters = dict(overflows=0, dropped_packets=0, dropped_bytes=0, coalesced=0)
+        self._clear()
+
+    def _clear(self):
+        self._buffer = bytearray()
+        # bytes before _start, and packets before _first, have been dropped
+        self._start = 0
+        # [offset, timestamp, bytes held] for each packet. Packets coalesced away entirely hold 0 bytes.
+        self._packets = []
+        self._first = 0
+        self._size = 0
+        self._count = 0
+        # under the coalesce policy: the spans of each packet holding messages that can be coalesced, by packet
+        # index, the live spans with each coalescing key, oldest first, and the keys with more than one
+        self._spans = {}
+        self._latest = {}
+        self._superseded = set()
+
+    def set_limit(self, limit, policy):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy %r. Policies are: %s" % (policy, ", ".join(OVERFLOW_POLICIES)))
+        if limit < 0:
+            raise ValueError("the buffer limit can't be negative")
+        with self._condition:
+            policy = policy if limit else 'grow'
+            if policy != 'coalesce':
+                self._spans = {}
+                self._latest = {}
+                self._superseded = set()
+            elif self.policy != 'coalesce':
+                for i in range(self._first, len(self._packets)):
+                    self._index(i)
+            self.limit = limit
+            self.policy = policy
+            while limit and (self._size > limit or self._count > limit):
+                self._drop_oldest()
+            self._condition.notify_all()
+
+    def _fits(self, length):
+        return not self.limit or (self._size + length <= self.limit and self._count < self.limit)
+
+    def _drop_oldest(self):
+        while self._first < len(self._packets):
+            offset, timestamp, size = self._packets[self._first]
+            if self._first in self._spans:
+                self._unindex(self._first)
+            self._first += 1
+            self._start = offset + size
+            if size:
+                self.counters['dropped_packets'] += 1
+                self.counters['dropped_bytes'] += size
+                self._size -= size
+                self._count -= 1
+                break
+        if self._first == len(self._packets):
+            self._clear()
+
+    def _compact(self):
+        """moves the packets held to the front of the buffer"""
+        start, first = self._start, self._first
+        del self._buffer[:start]
+        packets = self._packets[first:]
+        for packet in packets:
+            packet[0] -= start
+        spans = {}
+        for i, packet_spans in self._spans.items():
+            for span in packet_spans:
+                span.packet -= first
+                span.offset -= start
+            spans[i - first] = packet_spans
+        self._packets = packets
+        self._spans = spans
+        self._start = self._first = 0
+
+    def _index(self, i):
+        offset, timestamp, size = self._packets[i]
+        spans = _spans(self._buffer, i, offset, offset + size)
+        keyed = False
+        for span in spans:
+            if span.key is not None:
+                keyed = True
+                latest = self._latest.setdefault(span.key, deque())
+                latest.append(span)
+                if len(latest) > 1:
+                    self._superseded.add(span.key)
+        if keyed:
+            self._spans[i] = spans
+
+    def _unindex(self, i):
+        """forgets the oldest packet's spans, as it is dropped"""
+        for span in self._spans.pop(i):
+            if span.key is not None:
+                latest = self._latest[span.key]
+                latest.popleft()
+                if len(latest) < 2:
+                    self._superseded.discard(span.key)
+                if not latest:
+                    del self._latest[span.key]
+
+    def _rewrite(self, i):
+        """
+        moves packet i's surviving messages together in place, as SCMCoalesce does. A message whose running status
+        was discarded gets a status byte of its own, but the discarded message was at least as long, so the packet
+        never grows.
+        """
+        packet = self._packets[i]
+        buffer = self._buffer
+        out = packet[0]
+        last_status = 0
+        spans = []
+        for span in self._spans[i]:
+            if not span.alive:
+                continue
+            message = buffer[span.offset:span.offset + span.length]
+            if span.running and last_status != span.status:
+                message[0:0] = bytearray([span.status])
+                span.running = False
+            buffer[out:out + len(message)] = message
+            span.offset = out
+            span.length = len(message)
+            out += len(message)
+            if 0x80 <= span.status < 0xF0:
+                last_status = span.status
+            elif 0xF0 <= span.status < REALTIME_MIN:
+                last_status = 0
+            spans.append(span)
+        self._spans[i] = spans
+        size = out - packet[0]
+        self._size -= packet[2] - size
+        if not size:
+            self._count -= 1
+        packet[2] = size
+
+    def _coalesce(self, incoming):
+        """discards the controller, pitch bend and aftertouch values superseded by later ones"""
+        incoming_keys = set(span.key for span in _spans(incoming, None, 0, len(incoming)) if span.key is not None)
+        touched = set()
+        for key in self._superseded | (incoming_keys & set(self._latest)):
+            latest = self._latest[key]
+            keep = 0 if key in incoming_keys else 1
+            while len(latest) > keep:
+                span = latest.popleft()
+                span.alive = False
+                touched.add(span.packet)
+                self.counters['coalesced'] += 1
+            if not latest:
+                del self._latest[key]
+        self._superseded = set()
+        for i in touched:
+            self._rewrite(i)
+
+    def fileno(self):
+        with self._condition:
+            if self._ready_pipe is None:
+                self._ready_pipe = os.pipe()
+                for fd in self._ready_pipe:
+                    _set_nonblocking(fd)
+                if self._count:
+                    self._signal_ready()
+            return self._ready_pipe[0]
+
+    def close(self):
+        with self._condition:
+            if self._ready_pipe is not None:
+                for fd in self._ready_pipe:
+                    os.close(fd)
+                self._ready_pipe = None
+
+    def _signal_ready(self):
+        if self._ready_pipe is not None and not self._ready_signalled:
+            os.write(self._ready_pipe[1], b'\0')
+            self._ready_signalled = True
+
+    def _clear_ready(self):
+        if self._ready_signalled:
+            try:
+                while os.read(self._ready_pipe[0], 16):
+                    pass
+            except OSError:
+                pass
+            self._ready_signalled = False
+
+    def put(self, data):
+        timestamp = monotonic()
+        with self._condition:
+            if not self._fits(len(data)):
+                self.counters['overflows'] += 1
+                if self.policy == 'block' and len(data) <= self.limit:
+                    deadline = monotonic() + BLOCK_TIMEOUT
+                    while not self._fits(len(data)) and monotonic() < deadline:
+                        self._condition.notify_all()
+                        self._condition.wait(deadline - monotonic())
+                    if not self._fits(len(data)):
+                        self.counters['dropped_packets'] += 1
+                        self.counters['dropped_bytes'] += len(data)
+                        return
+                elif self.policy == 'drop-newest' or len(data) > self.limit:
+                    self.counters['dropped_packets'] += 1
+                    self.counters['dropped_bytes'] += len(data)
+                    return
+                else:
+                    if self.policy == 'coalesce':
+                        self._coalesce(data)
+                    while not self._fits(len(data)):
+                        self._drop_oldest()
+            if self._first and self._first >= self._count:
+                self._compact()
+            self._packets.append([len(self._buffer), timestamp, len(data)])
+            self._buffer.extend(data)
+            self._size += len(data)
+            self._count += 1
+            if self.policy == 'coalesce':
+                self._index(len(self._packets) - 1)
+            # not just notify(): a put() blocked for room may be waiting on the condition too
+            self._condition.notify_all()
+            self._signal_ready()
+
+    def take(self, timeout):
+        return self.take_packets(timeout)[0]
+
+    def take_packets(self, timeout):
+        """waits up to timeout seconds (forever if None or negative) for data, then takes everything buffered"""
+        with self._condition:
+            deadline = None if timeout is None or timeout < 0 else monotonic() + timeout
+            while not self._count:
+                if deadline is None:
+                    self._condition.wait()
+                    continue
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            start = self._start
+            if not self._spans:
+                data = bytes(self._buffer[start:] if start else self._buffer)
+                packets = [(offset - start, timestamp) for offset, timestamp, size in self._packets[self._first:]]
+            else:
+                # coalescing leaves gaps between packets
+                data = bytearray()
+                packets = []
+                for offset, timestamp, size in self._packets[self._first:]:
+                    if size:
+                        packets.append((len(data), timestamp))
+                        data.extend(self._buffer[offset:offset + size])
+                data = bytes(data)
+            self._clear()
+            self._clear_ready()
+            # for put()s blocked waiting for room
+            self._condition.notify_all()
+        return data, packets
+
+
+def _set_nonblocking(fd):
+    # fcntl isn't available everywhere, and is only needed if fileno() is used
+    import fcntl
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+class LoopbackPort(object):
+    def __init__(self, name):
+        self.name = name
+        self._connections = []
+        self._lock = Lock()
+
+    def connect(self):
+        connection = LoopbackConnection(self)
+        with self._lock:
+            self._connections.append(connection)
+        return connection
+
+    def disconnect(self, connection):
+        with self._lock:
+            self._connections.remove(connection)
+        connection.close()
+
+    def inject(self, data):
+        """deliver data to everything connected to this port, as if it had arrived from a device"""
+        data = bytearray(data)
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            connection.put(data)
+
+    def __repr__(self):
+        return "LoopbackPort(%r)" % self.name
+
+
+class LoopbackBackend(Backend):
+    name = 'loopback'
+
+    def __init__(self, port_names=('loopback',)):
+        self._ports = []
+        self._lock = Lock()
+        self._generation = 0
+        for name in port_names:
+            self.create_port(name)
+
+    def create_port(self, name):
+        """add a virtual port, which will be listed as both a source and a destination"""
+        port = LoopbackPort(name)
+        with self._lock:
+            self._ports.append(port)
+            self._generation += 1
+        return port
+
+    def remove_port(self, port):
+        with self._lock:
+            self._ports.remove(port)
+            self._generation += 1
+
+    def setup_generation(self):
+        return self._generation
+
+    def port(self, name):
+        for port in self._ports:
+            if port.name == name:
+                return port
+        raise KeyError(name)
+
+    def source_list(self):
+        return tuple(self._ports)
+
+    def destination_list(self):
+        return tuple(self._ports)
+
+    def endpoint_name(self, ref):
+        return ref.name
+
+    def connect_source(self, ref):
+        return ref.connect()
+
+    def connect_destination(self, ref):
+        return ref
+
+    def disconnect(self, connection):
+        # destinations are the ports themselves, and have nothing to release
+        if isinstance(connection, LoopbackConnection):
+            connection.port.disconnect(connection)
+
+    def send(self, destination, data):
+        destination.inject(data)
+
+    def send_batch(self, destination, data, packets=None):
+        destination.inject(data)
+
+    def receive(self, source, timeout):
+        return source.take(timeout)
+
+    def receive_packets(self, source, timeout):
+        data, packets = source.take_packets(timeout)
+        if not data:
+            return None
+        return data, packets
+
+    def set_buffer_limit(self, source, limit, policy):
+        source.set_limit(limit, policy)
+
+    def overflow_counters(self, source):
+        return dict(source.counters)
+
+    def fileno(self, source):
+        return source.fileno()
@@ -0,0 +1,16 @@
+"""
+The clock MIDI timestamps are measured against.
+
+Timestamps are in seconds. Where the CoreMIDI extension is available, monotonic() reads the host clock CoreMIDI
+stamps packets with (mach_absolute_time, counting from boot), so timestamps from the coremidi backend, and those
+given to send_many, can be compared directly against it. Elsewhere, only the loopback backend is available, and it
+stamps packets with whatever monotonic() is: time.monotonic, or on Python 2 time.time.
+"""
+import time
+
+try:
+    from ._simplecoremidi import get_host_time as host_time
+except ImportError:
+    host_time = None
+
+monotonic = host_time or getattr(time, 'monotonic', time.time)
@@ -1,4 +1,9 @@
-from . import _simplecoremidi as cfuncs
+from .backends import get_backend
+from .parser import MIDIParser, DATA_LENGTHS
+from .clock import monotonic
+from .stats import EndpointStats
+from collections import deque
+from operator import attrgetter
 import logging
 
 class MIDISource(object):
@@ -6,28 +11,191 @@ class MIDISource(object):
     self.name = name
     self._source_ref = source_ref
     self.__source = None
+    # counts connections made and closed, so a hub can tell when its readiness fd has changed
+    self._connections = 0
+    # (limit, policy) from set_buffer, applied again whenever the source reconnects
+    self._buffer = None
+    self._parser = MIDIParser()
+    self._pending = deque()
+    self.stats = EndpointStats(name)
+    # when the earliest packet in the last batch read arrived
+    self.last_arrival = None
 
   @classmethod
   def list(cls):
-      return [MIDISource(cfuncs.get_midi_endpoint_name(i), i)
-           for i in cfuncs.get_midi_source_list()
-      ]
+      """
+      the available sources. Listings are cached (see registry), so the same source objects, and their
+      connections, are returned each time until the MIDI setup changes.
+      """
+      from .registry import get_registry
+      return get_registry().sources()
 
   def _source(self):
     if not self.__source:
-        self.__source = cfuncs.get_midi_source(self._source_ref)
+        self.__source = get_backend().connect_source(self._source_ref)
+        if self.__source:
+            self._connections += 1
+            if self._buffer is not None:
+                get_backend().set_buffer_limit(self.__source, *self._buffer)
     if not self.__source:
        raise Exception('Source %s unavailable' % self.name)
     return self.__source
 
+  def close(self):
+    """
+    disconnects the source. Anything received but not yet read from the backend is lost; messages already queued
+    are kept. Using the source again reconnects it.
+    """
+    connection, self.__source = self.__source, None
+    if connection:
+        self._connections += 1
+        self._parser = MIDIParser()
+        get_backend().disconnect(connection)
+
+  def _rebind(self, ref):
+    """
+    points the source at a new ref to the same endpoint, replacing the connection made through the old one.
+    A source that was connected is reconnected straight away, so nothing sent to it from now on is missed.
+    """
+    connected = self.__source is not None
+    self._source_ref = ref
+    self.close()
+    if connected:
+        try:
+            self._source()
+        except Exception:
+            # it is tried again when the source is next used
+            pass
+
+  def _read(self, timeout):
+    received = get_backend().receive_packets(self._source(), timeout)
+    if received:
+        self._record(received)
+        self._enqueue(received[0])
+
+  def _record(self, received):
+    """updates the statistics for a (data, packets) tuple read from the backend"""
+    data, packets = received
+    stats = self.stats
+    now = monotonic()
+    for offset, timestamp in packets:
+        stats.latency.record(now - timestamp)
+    self.last_arrival = packets[0][1]
+    stats.bytes += len(data)
+    stats.batches += 1
+
+  def _enqueue(self, data):
+    """parses bytes received, and queues the messages in them"""
+    stats = self.stats
+    parser = self._parser
+    discarded = parser.discarded
+    messages = [Message.parse_message(m) for m in parser.feed(data)]
+    stats.dropped += parser.discarded - discarded
+    stats.messages += len(messages)
+    self._pending.extend(messages)
+
   def receive(self, timeout=1):
     """
-    this will block until data is available
+    returns the next message, blocking for up to timeout seconds until one is available.
+    Messages that arrive together are queued and returned by subsequent calls.
+    """
+    if not self._pending:
+        self._read(timeout)
+    if not self._pending:
+        return None
+    return self._pending.popleft()
+
+  def receive_many(self, timeout=1):
+    """
+    returns a list of every message received so far, blocking for up to timeout seconds if there are none.
     """
-    bytes = cfuncs.receive_midi(self._source(), timeout)
-    if not bytes:
+    if not self._pending:
+        self._read(timeout)
+    messages = list(self._pending)
+    self._pending.clear()
+    return messages
+
+  def receive_packets(self, timeout=1):
+    """
+    returns the raw bytes received, without parsing them into messages, as a tuple of (data, packets) where packets
+    is a list of (offset, timestamp) pairs: the offset in data at which each packet starts, and the time (in seconds,
+    see clock.monotonic) at which it arrived. Returns None if nothing arrived within timeout seconds.
+
+    Don't mix this with receive()/receive_many() on the same source; those keep parser state between calls.
+    """
+    return get_backend().receive_packets(self._source(), timeout)
+
+  def receive_array(self, timeout=1):
+    """
+    like receive_packets, but decodes what arrives into a NumPy structured array of events, timestamped by packet
+    (see npcodec). Returns None if nothing arrived within timeout seconds.
+    """
+    received = self.receive_packets(timeout)
+    if received is None:
         return None
-    return Message.parse_message(bytes)
+    return Message.decode_array(*received)
+
+  def fileno(self):
+    """
+    a file descriptor that becomes readable when data arrives, for select() or an event loop's add_reader.
+    Messages already queued by receive() don't make it readable, so check pending() first.
+    """
+    return get_backend().fileno(self._source())
+
+  def set_buffer(self, limit, policy='drop-oldest'):
+    """
+    bounds the backend's receive buffer for this source to limit bytes (0 for no limit), so a consumer that falls
+    behind can't build up an ever growing backlog. policy, one of backends.OVERFLOW_POLICIES, decides what happens
+    to data that arrives while the buffer is full; 'coalesce' keeps the latest position of every knob.
+    """
+    get_backend().set_buffer_limit(self._source(), limit, policy)
+    self._buffer = (limit, policy)
+
+  def overflow(self):
+    """the backend's overflow counters for this source's receive buffer, as a dict"""
+    return get_backend().overflow_counters(self._source())
+
+  def pending(self):
+    """the number of messages already received and waiting to be returned"""
+    return len(self._pending)
+
+  def areceive(self, timeout=None):
+    """
+    a coroutine returning the next message, or None if none arrives within timeout seconds (Python 3 only)
+    """
+    from .aio import areceive
+    return areceive(self, timeout)
+
+  def areceive_many(self, timeout=None):
+    """
+    a coroutine returning a list of every message received so far, waiting up to timeout seconds if there are none
+    (Python 3 only)
+    """
+    from .aio import areceive_many
+    return areceive_many(self, timeout)
+
+  def stream(self):
+    """
+    an asynchronous iterator over messages as they arrive: async for message in source.stream() (Python 3 only)
+    """
+    from .aio import stream
+    return stream(self)
+
+  def receive_sysex(self, sink, count=None, timeout=None, idle_timeout=2.0, progress=None):
+    """
+    writes the SysEx messages received to sink, a file-like object, as they arrive, so that dumps of any size can
+    be received in bounded memory. See sysex.receive_sysex. Returns a SysExReassembler counting what was received.
+    """
+    from .sysex import receive_sysex
+    return receive_sysex(self, sink, count, timeout, idle_timeout, progress)
+
+  def __iter__(self):
+    """
+    yields messages as they arrive, forever
+    """
+    while True:
+        for message in self.receive_many():
+            yield message
 
   def __str__(self):
       return self.name
@@ -37,134 +205,399 @@ class MIDIDestination(object):
     self.name = name
     self._destination_ref = destination_ref
     self.__destination = None
+    self.stats = EndpointStats(name)
+    # an OutputLimiter everything is sent through, if limit_rate has been called
+    self.limiter = None
 
   def _destination(self):
     if not self.__destination:
-        self.__destination = cfuncs.get_midi_destination(self._destination_ref)
+        self.__destination = get_backend().connect_destination(self._destination_ref)
     if not self.__destination:
        raise Exception('Destination %s unavailable' % self.name)
     return self.__destination
 
+  def close(self):
+    """disconnects the destination. Sending again reconnects it."""
+    connection, self.__destination = self.__destination, None
+    if connection:
+        get_backend().disconnect(connection)
+
+  def _rebind(self, ref):
+    """points the destination at a new ref to the same endpoint, closing the connection made through the old one"""
+    self._destination_ref = ref
+    self.close()
+
   def send(self, message):
-      logging.debug (message, map(hex,message.toBytes()))
-      return cfuncs.send_midi(self._destination(), message.toBytes())
+      """
+      sends a Message, or raw MIDI data: any object supporting the buffer protocol (bytes, bytearray, memoryview,
+      array('B')), which is handed to the backend without being copied, or a sequence of ints.
+      """
+      if not hasattr(message, 'toBytes'):
+          return self.send_bytes(message)
+      if self.limiter is not None:
+          return self.limiter.submit(message)
+      if logging.getLogger().isEnabledFor(logging.DEBUG):
+          logging.debug ("%s %s", message, " ".join(map(hex, bytearray(message.toBytes()))))
+      return self._send(message.toBytes(), 1)
+
+  def send_bytes(self, data):
+      """sends raw MIDI data as one packet (see send). With a rate limit, the messages in it are limited as usual."""
+      if isinstance(data, (tuple, list)):
+          data = bytearray(data)
+      if self.limiter is not None:
+          return self.limiter.submit_many([Message.parse_message(m) for m in MIDIParser().feed(data)])
+      return self._send(data, 1)
+
+  def _send(self, data, count, batch=False, packets=None):
+      stats = self.stats
+      start = monotonic()
+      try:
+          if batch:
+              result = get_backend().send_batch(self._destination(), data, packets)
+          else:
+              result = get_backend().send(self._destination(), data)
+      except Exception:
+          stats.dropped += count
+          raise
+      stats.latency.record(monotonic() - start)
+      stats.messages += count
+      stats.bytes += len(data)
+      stats.batches += 1
+      return result
+
+  def send_many(self, messages, timestamps=None):
+      """
+      sends a batch of messages in as few calls to the backend as possible.
+      timestamps, if given, holds a delivery time for each message (in seconds, on the clock.monotonic base; 0 means
+      now). Consecutive messages with the same timestamp share a packet. Timestamped batches bypass any rate limit.
+      Backends that schedule delivery raise ValueError for timestamps more than a few seconds from now.
+      """
+      if self.limiter is not None and timestamps is None:
+          return self.limiter.submit_many(messages)
+      return self._send_many(messages, timestamps)
+
+  def _send_many(self, messages, timestamps=None):
+      data = bytearray()
+      count = 0
+      packets = None
+      if timestamps is None:
+          for message in messages:
+              data.extend(message.toBytes())
+              count += 1
+      else:
+          packets = []
+          for message, timestamp in zip(messages, timestamps):
+              packets.append((len(data), timestamp))
+              data.extend(message.toBytes())
+              count += 1
+      if data:
+          return self._send(data, count, batch=True, packets=packets)
+
+  def send_sysex(self, data, chunk_size=4096, progress=None):
+      """
+      starts sending SysEx data, bytes or a file-like object, in the background and in chunks of chunk_size bytes,
+      so that dumps of any size can be sent in bounded memory. SysEx bypasses any rate limit: the backend paces it.
+      Returns a SysExSender (see sysex) to follow and wait for the transfer.
+      """
+      from .sysex import SysExSender
+      return SysExSender(self, data, chunk_size, progress)
+
+  def limit_rate(self, bytes_per_second, window=0.005, **kwargs):
+      """
+      sends everything through an OutputLimiter (see limiter), which keeps to bytes_per_second by sending in
+      batches every window seconds and merging controller values that are superseded while waiting.
+      None removes the limit, sending anything still waiting. Returns the limiter.
+      """
+      if self.limiter is not None:
+          self.limiter.close()
+          self.limiter = None
+      if bytes_per_second is not None:
+          from .limiter import OutputLimiter
+          self.limiter = OutputLimiter(self, bytes_per_second, window, **kwargs)
+      return self.limiter
 
   @classmethod
   def list(cls):
-      return [MIDIDestination( cfuncs.get_midi_endpoint_name(i), i)
-           for i in cfuncs.get_midi_destination_list()
-      ]
+      """
+      the available destinations. Like MIDISource.list, the same destination objects are returned each time
+      until the MIDI setup changes.
+      """
+      from .registry import get_registry
+      return get_registry().destinations()
 
   def __str__(self):
       return self.name
 
 
+def _field(name):
+    """a read-only message attribute, held in the slot _name: replace() is the only way to change a message"""
+    return property(attrgetter('_' + name))
+
+
 class Message(object):
+  """
+  The base class of all MIDI messages.
+
+  Messages are small: they use __slots__ rather than a __dict__. Messages returned by parse_message are interned, so
+  identical events share one object, and toBytes() caches its result, so messages are read-only: their fields are
+  properties over private slots, and replace() returns a modified copy.
+  """
   NOTE_OFF = 0x80
   NOTE_ON = 0x90
+  POLY_AFTERTOUCH = 0xA0
   CONTROL_CHANGE = 0xB0
   PROGRAM_CHANGE = 0xC0
+  CHANNEL_AFTERTOUCH = 0xD0
+  PITCH_BEND = 0xE0
+  SYSEX = 0xF0
+  MTC_QUARTER_FRAME = 0xF1
+  SONG_POSITION = 0xF2
+  SONG_SELECT = 0xF3
+  TUNE_REQUEST = 0xF6
+  SYSEX_END = 0xF7
+  TIMING_CLOCK = 0xF8
+  START = 0xFA
+  CONTINUE = 0xFB
+  STOP = 0xFC
+  ACTIVE_SENSING = 0xFE
+  SYSTEM_RESET = 0xFF
+
+  # the most messages parse_message will keep interned
+  INTERN_LIMIT = 65536
+  _interned = {}
+
+  # indexed by status byte: the class of message it starts, and the message's length (None for SysEx).
+  # Filled in once all the message classes are defined.
+  _classes = [None] * 256
+  _lengths = [None] * 256
+
+  __slots__ = ('_message_type', '_channel', '_encoded')
+  _fields = ('message_type', 'channel')
+  message_type = _field('message_type')
+  channel = _field('channel')
 
   def fromBytes(self, bytes):
-      self.message_type = bytes[0] & 0xF0
-      self.channel = bytes[0] & 0x0F
+      self._message_type = bytes[0] & 0xF0
+      self._channel = bytes[0] & 0x0F
+      self._encoded = None
+      return self
 
-  def toBytes(self):
-     if self.channel == -1 or self.message_type == -1:
+  def _encode(self):
+     """the message as a list of byte values"""
+     if self._channel == -1 or self._message_type == -1:
          raise Exception('Message is not initialised')
-     return [self.message_type | self.channel]
+     return [self._message_type | self._channel]
+
+  def toBytes(self):
+     """the message as a bytes object. It is only encoded once"""
+     data = self._encoded
+     if data is None:
+         data = self._encoded = bytes(bytearray(self._encode()))
+     return data
 
   def __init__(self, message_type=0, channel=1):
-      self.message_type = message_type
-      self.channel = channel
+      self._message_type = message_type
+      self._channel = channel
+      self._encoded = None
+
+  def replace(self, **changes):
+      """returns a copy of this message, with the given attributes changed"""
+      message = self.__class__.__new__(self.__class__)
+      for field in self._fields:
+          setattr(message, '_' + field, changes.pop(field, getattr(self, field)))
+      if changes:
+          raise TypeError("%s has no attribute %s" % (self.__class__.__name__, ", ".join(changes)))
+      message._encoded = None
+      return message
+
+  def _key(self):
+      """what messages are compared and hashed by: their bytes, or their fields if they can't be encoded yet"""
+      try:
+          return self.toBytes()
+      except Exception:
+          return (self.__class__,) + tuple(getattr(self, field, None) for field in self._fields)
+
+  def __eq__(self, other):
+      if not isinstance(other, Message):
+          return NotImplemented
+      return self._key() == other._key()
+
+  def __ne__(self, other):
+      return not self == other
+
+  def __hash__(self):
+      return hash(self._key())
 
   def __str__(self):
      # fixme this doesn't work if intermediate classes don't know whether to add the closing parenthesis
      return "{}(channel = {}".format(self.__class__.__name__, self.channel)
 
   @classmethod
-  def parse_message(cls, bytes):
-      message_type = bytes[0] & 0xF0
-      if message_type == cls.NOTE_OFF:
-        return NoteOffMessage().fromBytes(bytes)
-      elif message_type == cls.NOTE_ON:
-        return NoteOnMessage().fromBytes(bytes)
-      elif message_type == cls.PROGRAM_CHANGE:
-        return ProgramChangeMessage().fromBytes(bytes)
-      elif message_type == cls.CONTROL_CHANGE:
-        return ControllerChangeMessage().fromBytes(bytes)
-      else:
-        return UnknownMessage().fromBytes(bytes)
+  def decode_array(cls, data, packets=None):
+      """
+      decodes a whole byte stream at once into a NumPy structured array, one row per message, rather than into
+      Message objects. Needs numpy; see npcodec.decode
+      """
+      from .npcodec import decode
+      return decode(data, packets)
+
+  @classmethod
+  def encode_array(cls, events, running_status=False):
+      """encodes an array from decode_array back into bytes. Needs numpy; see npcodec.encode"""
+      from .npcodec import encode
+      return encode(events, running_status)
+
+  @classmethod
+  def parse_message(cls, data):
+      """
+      decodes a single message from a sequence of bytes, such as those returned by MIDIParser.feed.
+      If data is longer than the message its status byte starts, the rest is ignored.
+      """
+      status = data[0]
+      message_class = cls._classes[status]
+      length = cls._lengths[status]
+      if length is None:
+          return message_class.__new__(message_class).fromBytes(data)
+      key = bytes(bytearray(data[:length]))
+      message = cls._interned.get(key)
+      if message is None:
+          message = message_class.__new__(message_class).fromBytes(data)
+          message._encoded = key
+          if len(cls._interned) < cls.INTERN_LIMIT:
+              cls._interned[key] = message
+      return message
 
 
 class NoteMessage(Message):
+    __slots__ = ('_number', '_velocity')
+    _fields = Message._fields + ('number', 'velocity')
+    number = _field('number')
+    velocity = _field('velocity')
+
     def __init__(self, type=-1, channel=-1, number=-1, velocity=-1):
-        super(NoteMessage, self).__init__(type, channel)
-        self.number = number
-        self.velocity = velocity
+        self._message_type = type
+        self._channel = channel
+        self._number = number
+        self._velocity = velocity
+        self._encoded = None
 
     def __str__(self):
         return "{}, number = {}, velocity = {})".format(super(NoteMessage, self).__str__(), self.number, self.velocity)
 
-    def toBytes(self):
-        if self.number == -1:
+    def _encode(self):
+        if self._number == -1:
             raise Exception('Message is not initialised')
-        return super(NoteMessage, self).toBytes() + [self.number, self.velocity]
+        return [self._message_type | self._channel, self._number, self._velocity]
 
     def fromBytes(self, bytes):
-        super(NoteMessage, self).fromBytes(bytes)
-        self.number = bytes[1]
-        self.velocity = bytes[2]
+        self._message_type = bytes[0] & 0xF0
+        self._channel = bytes[0] & 0x0F
+        self._number = bytes[1]
+        self._velocity = bytes[2]
+        self._encoded = None
         return self
 
     def is_note_off(self):
         return self.velocity == 0 or self.message_type == self.NOTE_OFF
 
 class NoteOffMessage(NoteMessage):
+  __slots__ = ()
+
   def __init__(self, channel=-1, number=-1, velocity=-1):
-      super(NoteOffMessage, self).__init__(self.NOTE_OFF, channel, number, velocity)
+      self._message_type = self.NOTE_OFF
+      self._channel = channel
+      self._number = number
+      self._velocity = velocity
+      self._encoded = None
 
   def asNoteOn(self):
       return NoteOnMessage(self.channel, self.number, 0)
 
 
 class NoteOnMessage(NoteMessage):
+  __slots__ = ()
+
   def __init__(self, channel=-1, number=-1, velocity=-1):
-      super(NoteOnMessage, self).__init__(self.NOTE_ON, channel, number, velocity)
+      self._message_type = self.NOTE_ON
+      self._channel = channel
+      self._number = number
+      self._velocity = velocity
+      self._encoded = None
+
+
+class PolyAftertouchMessage(Message):
+    __slots__ = ('_number', '_pressure')
+    _fields = Message._fields + ('number', 'pressure')
+    number = _field('number')
+    pressure = _field('pressure')
+
+    def __init__(self, channel=-1, number=-1, pressure=-1):
+        self._message_type = self.POLY_AFTERTOUCH
+        self._channel = channel
+        self._number = number
+        self._pressure = pressure
+        self._encoded = None
+
+    def fromBytes(self, bytes):
+        self._message_type = bytes[0] & 0xF0
+        self._channel = bytes[0] & 0x0F
+        self._number = bytes[1]
+        self._pressure = bytes[2]
+        self._encoded = None
+        return self
+
+    def _encode(self):
+        if self._number == -1 or self._pressure == -1:
+            raise Exception('Message is not initialised')
+        return [self._message_type | self._channel, self._number, self._pressure]
+
+    def __str__(self):
+        return "{}, number = {}, pressure = {})".format(super(PolyAftertouchMessage, self).__str__(),
+                                                       self.number, self.pressure)
 
 
 class UnknownMessage(Message):
+  __slots__ = ('_bytes',)
+  _fields = Message._fields + ('bytes',)
+  bytes = _field('bytes')
+
   def fromBytes(self, bytes):
       super(UnknownMessage, self).fromBytes(bytes)
-      self.bytes = bytes[1:]
+      self._bytes = list(bytes[1:])
       return self
 
-  def toBytes(self):
-     if not self.bytes:
-         raise Exception('Message is not initialised')
-     return super(UnknownMessage, self).toBytes()
+  def _encode(self):
+     return super(UnknownMessage, self)._encode() + list(self._bytes)
 
   def __init__(self, type=-1, channel=-1, bytes=[]):
       super(UnknownMessage, self).__init__(type, channel)
-      self.bytes = bytes[1:]
+      self._bytes = bytes[1:]
 
   def __str__(self):
       return "{}, bytes = ({}))".format(super(UnknownMessage, self).__str__(), " ".join(map(hex,self.bytes)))
 
 class ProgramChangeMessage(Message):
+  __slots__ = ('_program',)
+  _fields = Message._fields + ('program',)
+  program = _field('program')
+
   def fromBytes(self, bytes):
-      super(ProgramChangeMessage, self).fromBytes(bytes)
-      self.program = bytes[1]
+      self._message_type = bytes[0] & 0xF0
+      self._channel = bytes[0] & 0x0F
+      self._program = bytes[1]
+      self._encoded = None
       return self
 
-  def toBytes(self):
-     if self.program == -1:
+  def _encode(self):
+     if self._program == -1:
          raise Exception('Message is not initialised')
-     return super(ProgramChangeMessage, self).toBytes() + [self.program]
+     return [self._message_type | self._channel, self._program]
 
   def __init__(self, channel=-1, program=-1):
-      super(ProgramChangeMessage, self).__init__(self.PROGRAM_CHANGE, channel)
-      self.program = program
+      self._message_type = self.PROGRAM_CHANGE
+      self._channel = channel
+      self._program = program
+      self._encoded = None
 
   def __str__(self):
       return "{}, program = {})".format(super(ProgramChangeMessage, self).__str__(), self.program)
@@ -241,25 +674,269 @@ class ControllerChangeMessage(Message):
     0x65:	'Registered Parameter Number MSB',
     }
 
+  __slots__ = ('_control', '_value')
+  _fields = Message._fields + ('control', 'value')
+  control = _field('control')
+  value = _field('value')
+
   def fromBytes(self, bytes):
-      super(ControllerChangeMessage, self).fromBytes(bytes)
-      self.control = bytes[1]
-      self.value = bytes[2]
+      self._message_type = bytes[0] & 0xF0
+      self._channel = bytes[0] & 0x0F
+      self._control = bytes[1]
+      self._value = bytes[2]
+      self._encoded = None
       return self
 
-  def toBytes(self):
-     if self.control == -1 or self.value == -1:
+  def _encode(self):
+     if self._control == -1 or self._value == -1:
          raise Exception('Message is not initialised')
-     return super(ControllerChangeMessage, self).toBytes() + [self.control, self.value]
+     return [self._message_type | self._channel, self._control, self._value]
 
   def __init__(self, channel=-1, control=-1, value=-1):
-      super(ControllerChangeMessage, self).__init__(self.CONTROL_CHANGE, channel)
-      self.control = control
-      self.value = value
+      self._message_type = self.CONTROL_CHANGE
+      self._channel = channel
+      self._control = control
+      self._value = value
+      self._encoded = None
 
   def __str__(self):
       return "{}, control = {}, value = {})".format(super(ControllerChangeMessage, self).__str__(),
                self.CONTROLLERS.get(self.control, 'Unknown Controller ({})'.format(hex(self.control))),
                self.value)
 
-# TODO: other message types
+
+class ChannelAftertouchMessage(Message):
+    __slots__ = ('_pressure',)
+    _fields = Message._fields + ('pressure',)
+    pressure = _field('pressure')
+
+    def __init__(self, channel=-1, pressure=-1):
+        self._message_type = self.CHANNEL_AFTERTOUCH
+        self._channel = channel
+        self._pressure = pressure
+        self._encoded = None
+
+    def fromBytes(self, bytes):
+        self._message_type = bytes[0] & 0xF0
+        self._channel = bytes[0] & 0x0F
+        self._pressure = bytes[1]
+        self._encoded = None
+        return self
+
+    def _encode(self):
+        if self._pressure == -1:
+            raise Exception('Message is not initialised')
+        return [self._message_type | self._channel, self._pressure]
+
+    def __str__(self):
+        return "{}, pressure = {})".format(super(ChannelAftertouchMessage, self).__str__(), self.pressure)
+
+
+class PitchBendMessage(Message):
+    """value is the raw 14 bit value, 0 - 16383, with 8192 meaning no bend. bend is relative to the centre"""
+    CENTRE = 0x2000
+
+    __slots__ = ('_value',)
+    _fields = Message._fields + ('value',)
+    value = _field('value')
+
+    def __init__(self, channel=-1, value=CENTRE):
+        self._message_type = self.PITCH_BEND
+        self._channel = channel
+        self._value = value
+        self._encoded = None
+
+    @property
+    def bend(self):
+        return self.value - self.CENTRE
+
+    def fromBytes(self, bytes):
+        self._message_type = bytes[0] & 0xF0
+        self._channel = bytes[0] & 0x0F
+        self._value = bytes[1] | (bytes[2] << 7)
+        self._encoded = None
+        return self
+
+    def _encode(self):
+        return [self._message_type | self._channel, self._value & 0x7F, (self._value >> 7) & 0x7F]
+
+    def __str__(self):
+        return "{}, bend = {})".format(super(PitchBendMessage, self).__str__(), self.bend)
+
+
+class SystemMessage(Message):
+    """
+    The base class of system common and realtime messages, which aren't sent on a channel.
+    message_type holds the whole status byte, and channel is None.
+    """
+    __slots__ = ()
+
+    def __init__(self, message_type):
+        self._message_type = message_type
+        self._channel = None
+        self._encoded = None
+
+    def fromBytes(self, bytes):
+        self._message_type = bytes[0]
+        self._channel = None
+        self._encoded = None
+        return self
+
+    def _encode(self):
+        return [self._message_type]
+
+    def __str__(self):
+        return "{}()".format(self.__class__.__name__)
+
+
+class SysExMessage(SystemMessage):
+    """data holds the bytes between the 0xF0 and 0xF7 which delimit the message"""
+    __slots__ = ('_data',)
+    _fields = Message._fields + ('data',)
+    data = _field('data')
+
+    def __init__(self, data=b''):
+        super(SysExMessage, self).__init__(self.SYSEX)
+        self._data = _to_bytes(data)
+
+    def fromBytes(self, bytes):
+        super(SysExMessage, self).fromBytes(bytes)
+        end = -1 if bytes[-1] == self.SYSEX_END else len(bytes)
+        self._data = _to_bytes(bytes[1:end])
+        return self
+
+    def _encode(self):
+        return [self.SYSEX] + list(bytearray(self._data)) + [self.SYSEX_END]
+
+    def __str__(self):
+        return "{}(length = {}, data = ({}{}))".format(
+            self.__class__.__name__, len(self.data),
+            " ".join(map(hex, bytearray(self.data[:16]))), " ..." if len(self.data) > 16 else "")
+
+
+class MTCQuarterFrameMessage(SystemMessage):
+    __slots__ = ('_piece', '_value')
+    _fields = Message._fields + ('piece', 'value')
+    piece = _field('piece')
+    value = _field('value')
+
+    def __init__(self, piece=0, value=0):
+        super(MTCQuarterFrameMessage, self).__init__(self.MTC_QUARTER_FRAME)
+        self._piece = piece
+        self._value = value
+
+    def fromBytes(self, bytes):
+        super(MTCQuarterFrameMessage, self).fromBytes(bytes)
+        self._piece = (bytes[1] >> 4) & 0x07
+        self._value = bytes[1] & 0x0F
+        return self
+
+    def _encode(self):
+        return [self._message_type, (self._piece << 4) | self._value]
+
+    def __str__(self):
+        return "{}(piece = {}, value = {})".format(self.__class__.__name__, self.piece, self.value)
+
+
+class SongPositionMessage(SystemMessage):
+    """position is in MIDI beats (sixteenth notes) since the start of the song"""
+    __slots__ = ('_position',)
+    _fields = Message._fields + ('position',)
+    position = _field('position')
+
+    def __init__(self, position=0):
+        super(SongPositionMessage, self).__init__(self.SONG_POSITION)
+        self._position = position
+
+    def fromBytes(self, bytes):
+        super(SongPositionMessage, self).fromBytes(bytes)
+        self._position = bytes[1] | (bytes[2] << 7)
+        return self
+
+    def _encode(self):
+        return [self._message_type, self._position & 0x7F, (self._position >> 7) & 0x7F]
+
+    def __str__(self):
+        return "{}(position = {})".format(self.__class__.__name__, self.position)
+
+
+class SongSelectMessage(SystemMessage):
+    __slots__ = ('_song',)
+    _fields = Message._fields + ('song',)
+    song = _field('song')
+
+    def __init__(self, song=0):
+        super(SongSelectMessage, self).__init__(self.SONG_SELECT)
+        self._song = song
+
+    def fromBytes(self, bytes):
+        super(SongSelectMessage, self).fromBytes(bytes)
+        self._song = bytes[1]
+        return self
+
+    def _encode(self):
+        return [self._message_type, self._song]
+
+    def __str__(self):
+        return "{}(song = {})".format(self.__class__.__name__, self.song)
+
+
+class TuneRequestMessage(SystemMessage):
+    __slots__ = ()
+
+    def __init__(self):
+        super(TuneRequestMessage, self).__init__(self.TUNE_REQUEST)
+
+
+class RealtimeMessage(SystemMessage):
+    """a single byte system realtime message: clock, start, continue, stop, active sensing or reset"""
+    NAMES = {
+        Message.TIMING_CLOCK: 'Timing Clock',
+        Message.START: 'Start',
+        Message.CONTINUE: 'Continue',
+        Message.STOP: 'Stop',
+        Message.ACTIVE_SENSING: 'Active Sensing',
+        Message.SYSTEM_RESET: 'System Reset',
+    }
+
+    __slots__ = ()
+
+    def __str__(self):
+        return "{}({})".format(self.__class__.__name__, self.NAMES.get(self.message_type, hex(self.message_type)))
+
+
+def _to_bytes(data):
+    return bytes(bytearray(data))
+
+
+def _build_status_tables():
+    channel_classes = {
+        Message.NOTE_OFF: NoteOffMessage,
+        Message.NOTE_ON: NoteOnMessage,
+        Message.POLY_AFTERTOUCH: PolyAftertouchMessage,
+        Message.CONTROL_CHANGE: ControllerChangeMessage,
+        Message.PROGRAM_CHANGE: ProgramChangeMessage,
+        Message.CHANNEL_AFTERTOUCH: ChannelAftertouchMessage,
+        Message.PITCH_BEND: PitchBendMessage,
+    }
+    system_classes = {
+        Message.SYSEX: SysExMessage,
+        Message.MTC_QUARTER_FRAME: MTCQuarterFrameMessage,
+        Message.SONG_POSITION: SongPositionMessage,
+        Message.SONG_SELECT: SongSelectMessage,
+        Message.TUNE_REQUEST: TuneRequestMessage,
+    }
+    for status in range(256):
+        length = DATA_LENGTHS[status]
+        Message._lengths[status] = None if length is None else length + 1
+        if 0x80 <= status < 0xF0:
+            Message._classes[status] = channel_classes[status & 0xF0]
+        elif status in system_classes:
+            Message._classes[status] = system_classes[status]
+        elif status in RealtimeMessage.NAMES:
+            Message._classes[status] = RealtimeMessage
+        else:
+            # data bytes, undefined statuses and stray end of exclusives
+            Message._classes[status] = UnknownMessage
+
+_build_status_tables()
@@ -1,10 +1,20 @@
 import argparse
-from simplecoremidi import MIDISource, MIDIDestination, ControllerChangeMessage, ProgramChangeMessage, NoteOffMessage, NoteOnMessage , NoteMessage
-from time import sleep, time as now
+import json
+from simplecoremidi import backends, smf, MIDISource, MIDIDestination, ControllerChangeMessage, ProgramChangeMessage, NoteOffMessage, NoteOnMessage , NoteMessage
+from simplecoremidi.hub import MIDIHub
+from simplecoremidi.registry import get_registry
+from simplecoremidi.scheduler import default_scheduler
+from simplecoremidi.stats import LatencyHistogram
+from simplecoremidi.clock import monotonic as now
+from array import array
 import sys
 import os
 import logging
-from threading import Timer, Lock
+from threading import Lock, Thread
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
 
 logging.basicConfig(format="%(levelname)-6s %(funcName)-20s   %(msg)s")
 logger = logging.getLogger("MIDIMapper")
@@ -13,7 +23,7 @@ try:
     import autopy
     from autopy import key
 except:
-    print >> sys.stderr, ("autopy is not available. Keystroke actions will not work")
+    sys.stderr.write("autopy is not available. Keystroke actions will not work\n")
     autopy = None
     key = None
 
@@ -27,13 +37,169 @@ def typename(obj):
 class EndpointError(Exception):
     pass
 
+class ActionPool(object):
+    """
+    Runs blocking actions on worker threads, so they can't hold up the receive loop.
+
+    The queue is bounded: if the workers fall behind by more than queue_size actions, further actions are dropped
+    (and counted) rather than building up an ever growing backlog.
+    """
+    def __init__(self, workers=1, queue_size=256):
+        self.dropped = 0
+        self.completed = 0
+        self._queue = Queue(queue_size)
+        for i in range(workers):
+            worker = Thread(target=self._work, name="MIDIMapper action %d" % i)
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, function, *args):
+        try:
+            self._queue.put_nowait((function, args))
+            return True
+        except Full:
+            self.dropped += 1
+            logger.warning("action queue full, dropped %s" % getattr(function, '__name__', function))
+            return False
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def _work(self):
+        while True:
+            function, args = self._queue.get()
+            try:
+                function(*args)
+            except Exception:
+                logger.exception("action failed")
+            self.completed += 1
+
+
 class MIDIMapper(object):
-    TRUE = object()
-    __pending_responses = {}
+    def __init__(self, actions, source, destination, scheduler=None, pool=None, merge=False):
+        self.__pending_responses = {}
+        self.state = TriggerState()
+        self.scheduler = scheduler or default_scheduler()
+        self.pool = pool or ActionPool()
+        self.received = 0
+        self.passed_through = 0
+        # per stage latencies:
+        #   queue       -- from the arrival of a batch of messages to the mapper receiving it (including parsing)
+        #   handle      -- dispatching and acting on one message (including sending)
+        #   action      -- executing one response
+        #   end_to_end  -- from the arrival of a batch to the mapper having handled all of it
+        self.latency = dict((stage, LatencyHistogram()) for stage in ('queue', 'handle', 'action', 'end_to_end'))
+        self.actions = {}
+        # (actions, dispatch tables) compiled by swap_actions, waiting for handle() to swap them in
+        self._staged = None
+        self._staged_lock = Lock()
+        self.set_actions(actions)
+        self.find_endpoints(source, destination, merge)
+
+    def set_actions(self, actions):
+        """replaces the mapping now. Only call this from the thread handling messages, or before it starts."""
+        self._swap(actions, self.compile(actions))
+
+    def swap_actions(self, actions):
+        """
+        replaces the mapping from another thread (a mapping file watcher, say) without stopping the mapper.
 
-    def __init__(self, actions, source, destination):
+        The new dispatch tables are compiled on the calling thread; handle() swaps them in before the next message,
+        so every message is handled entirely by one mapping or the other. Trigger state (which notes are held, and
+        for how long) belongs to the mapper, so it carries over, and toggled notes stay toggled.
+        """
+        dispatch = self.compile(actions)
+        with self._staged_lock:
+            self._staged = (actions, dispatch)
+
+    def _swap(self, actions, dispatch):
+        start = now()
+        previous = {}
+        for response in self._responses(self.actions):
+            key = response.state_key()
+            if key is not None:
+                previous[key] = response
+        for response in self._responses(actions):
+            key = response.state_key()
+            old = previous.get(key) if key is not None else None
+            if old is not None and old is not response:
+                response.adopt(old)
         self.actions = actions
-        self.find_endpoints(source, destination)
+        self._dispatch = dispatch
+        logger.info("mapping swapped in %0.3f ms" % ((now() - start) * 1000))
+
+    @staticmethod
+    def _responses(actions):
+        """every response action in an actions mapping"""
+        for responses in actions.values():
+            if isinstance(responses, dict):
+                for response in responses.values():
+                    yield response
+            elif isinstance(responses, (set, list, tuple)):
+                for response in responses:
+                    yield response
+            else:
+                yield responses
+
+    def compile(self, actions):
+        """
+        Builds the dispatch tables for an actions mapping.
+
+        Returns a dict from message class to a (table, attribute) pair. table is a list of 16 * 128 handlers, indexed
+        by (channel << 7) | getattr(message, attribute), each either None (pass the message through) or a function
+        taking the message.
+        """
+        notes = [None] * 2048
+        programs = [None] * 2048
+        controllers = [None] * 2048
+        tables = (
+            (Note, notes, 'number'),
+            (Program, programs, 'program'),
+            (Controller, controllers, 'control'),
+        )
+        for key, responses in actions.items():
+            for action_class, table, attribute in tables:
+                if isinstance(key, action_class):
+                    break
+            else:
+                raise TypeError("Can't map %s: actions must be keyed by Note, Program or Controller" % typename(key))
+            number = getattr(key, attribute)
+            handler = self._compile_responses(responses)
+            for channel in range(16):
+                table[(channel << 7) | number] = handler
+
+        return {
+            NoteOnMessage: (notes, 'number'),
+            NoteOffMessage: (notes, 'number'),
+            ProgramChangeMessage: (programs, 'program'),
+            ControllerChangeMessage: (controllers, 'control'),
+        }
+
+    def _compile_responses(self, responses):
+        if isinstance(responses, dict):
+            rules = tuple(responses.items())
+            for trigger, response in rules:
+                trigger.owner = self
+
+            def handler(message):
+                for trigger, response in rules:
+                    matches = trigger.matches(message)
+                    if matches is True:
+                        self.respond(response, message)
+                    elif matches is None:
+                        # the trigger will call execute() when it decides
+                        self.enqueue_response(trigger, response)
+            return handler
+
+        if isinstance(responses, (set, list, tuple)):
+            responses = tuple(responses)
+
+            def handler(message):
+                for response in responses:
+                    self.respond(response, message)
+            return handler
+
+        return lambda message: self.respond(responses, message)
 
     def dequeue_response(self, trigger):
         result = self.__pending_responses.get(trigger, None)
@@ -49,8 +215,15 @@ class MIDIMapper(object):
         self.__pending_responses[trigger] = response
 
     @classmethod
-    def main(cls, actions):
+    def main(cls, actions=None, mapping=None):
+        """
+        runs a mapper from the command line, with either the given actions or those in a mapping file (see
+        mapping.py). A mapping file given here or with --mapping is watched, and reloaded when it changes.
+        """
         args, help = cls.argparse()
+        if args.backend:
+            backends.set_backend(args.backend)
+
         if args.print_ports:
             cls.ports()
             return 0
@@ -60,62 +233,145 @@ class MIDIMapper(object):
         elif args.debug:
             logger.setLevel(logging.DEBUG)
 
+        mapping = args.mapping or mapping
+        if mapping:
+            from mapping import load, MappingError, MappingWatcher
+            try:
+                actions = load(mapping)
+            except (MappingError, IOError) as e:
+                sys.stderr.write("%s\n" % e)
+                return 2
+        elif actions is None:
+            sys.stderr.write("No mapping given: use --mapping FILE\n")
+            return 2
+
         try:
-            mapper = cls(actions, args.source, args.destination)
+            mapper = cls(actions, args.source, args.destination, merge=args.merge)
         except EndpointError as e:
-            print >> sys.stderr, (e.message)
+            sys.stderr.write("%s\n" % e)
             cls.ports()
             return 2
 
+        if mapping:
+            MappingWatcher(mapping, mapper.swap_actions)
+
+        if args.rate:
+            mapper.destination.limit_rate(args.rate, scheduler=mapper.scheduler)
+
+        if args.buffer is not None:
+            for source in mapper.sources:
+                source.set_buffer(args.buffer, args.overflow)
+
+        if args.stats:
+            mapper.dump_stats_every(args.stats)
+
         try:
-            mapper.run()
+            if args.replay:
+                smf.replay(args.replay, mapper.handle, speed=args.speed)
+            else:
+                mapper.run()
         except KeyboardInterrupt:
             return 0
+        finally:
+            if args.stats is not None:
+                mapper.dump_stats()
 
     def run(self):
+        """
+        handles messages as they arrive, from every source, in the order they arrive. Every message received is
+        handled on each wake up.
+
+        The loop waits for all the sources at once in a MIDIHub, which (where the backend provides readiness file
+        descriptors) waits in select() and so doesn't stop other threads, such as the scheduler's, from running.
+        """
+        hub = MIDIHub(self.sources)
+        queue_latency = self.latency['queue']
+        end_to_end_latency = self.latency['end_to_end']
         while True:
-            message = self.source.receive(timeout=1)
-            if message:
-                self.handle(message)
-            sleep(0.01) # give timer threads a chance to run
+            for source, messages in hub.receive(timeout=1):
+                arrival = source.last_arrival
+                if arrival is not None:
+                    queue_latency.record(now() - arrival)
+                for message in messages:
+                    self.handle(message)
+                if arrival is not None:
+                    end_to_end_latency.record(now() - arrival)
+
+    def stats(self):
+        """counters and latency summaries (in seconds) for the mapper, its source and its destination"""
+        stats = self.counters()
+        stats['latency'] = dict((stage, histogram.summary()) for stage, histogram in self.latency.items())
+        stats['sources'] = []
+        for source in self.sources:
+            summary = source.stats.summary()
+            try:
+                summary['overflow'] = source.overflow()
+            except NotImplementedError:
+                pass
+            stats['sources'].append(summary)
+        stats['destination'] = self.destination.stats.summary()
+        limiter = self.destination.limiter
+        if limiter is not None:
+            stats['destination']['merged'] = limiter.merged
+            stats['destination']['waiting'] = limiter.pending()
+        return stats
+
+    def dump_stats(self, file=None):
+        (file or sys.stderr).write(json.dumps(self.stats(), indent=2, sort_keys=True) + "\n")
+
+    def dump_stats_every(self, interval):
+        def dump():
+            self.dump_stats()
+            self.scheduler.call_later(interval, dump)
+        self.scheduler.call_later(interval, dump)
+
+    def counters(self):
+        return {
+            'received': self.received,
+            'passed_through': self.passed_through,
+            'action_queue_depth': self.pool.depth(),
+            'actions_completed': self.pool.completed,
+            'actions_dropped': self.pool.dropped,
+        }
 
     def handle(self, message):
-        action = None
-        if isinstance(message, NoteMessage):
-            action = self.actions.get(Note(message.number))
-        elif isinstance(message, ProgramChangeMessage):
-            action = self.actions.get(Program(message.program))
-        elif isinstance(message, ControllerChangeMessage):
-            action = self.actions.get(Controller(message.control))
-
-        if action is None:
+        start = now()
+        if self._staged is not None:
+            with self._staged_lock:
+                staged, self._staged = self._staged, None
+            self._swap(*staged)
+        self.received += 1
+        self.state.handled += 1
+        handler = None
+        entry = self._dispatch.get(message.__class__)
+        if entry is not None:
+            table, attribute = entry
+            handler = table[(message.channel << 7) | getattr(message, attribute)]
+
+        if handler is None:
             # if it doesn't have an associated action, pass the message through
+            self.passed_through += 1
             self.destination.send(message)
         else:
-            self._maybe_execute(action, message)
+            handler(message)
+        self.latency['handle'].record(now() - start)
 
-    def _maybe_execute(self, responses, message):
-        if isinstance(responses, dict):
-             for trigger, response in responses.items():
-                matches = trigger.matches(message)
-                if matches is False:
-                    continue
-                self.enqueue_response(trigger, response)
-                if matches is True:
-                    self.execute(trigger, message)
-        elif isinstance(responses, (set, list, tuple)):
-            for r in responses:
-                self.enqueue_response(self.TRUE, r)
-                self.execute(self.TRUE, message)
+    def respond(self, response, message):
+        if response.blocking:
+            self.pool.submit(self._respond, response, message)
         else:
-            self.enqueue_response(self.TRUE, responses)
-            self.execute(self.TRUE, message)
+            self._respond(response, message)
+
+    def _respond(self, response, message):
+        start = now()
+        response.update(self.destination, DEFAULT_CHANNEL, message, scheduler=self.scheduler).execute()
+        self.latency['action'].record(now() - start)
 
     def execute(self, trigger, message):
         with Lock():
             response = self.dequeue_response(trigger)
             if response:
-                response.update(self.destination, DEFAULT_CHANNEL, message).execute()
+                self.respond(response, message)
             else:
                 logger.error("%s has no queued response" % trigger)
 
@@ -126,28 +382,39 @@ class MIDIMapper(object):
         parser.add_argument("-d", "--debug", help="Show debugging output", action='store_true')
         parser.add_argument("source", help="A substring of the name of the MIDI port from which messages are read. The first port found matching this substring will be used")
         parser.add_argument("destination", help="A substring of the name of the MIDI port to which messages are written. The first port found matching this substring will be used")
+        parser.add_argument("--merge", help="Read from every source whose name contains the source substring, not just the first", action="store_true")
         parser.add_argument("--ports", help="Show the available source and destination ports", action="store_true", dest='print_ports')
+        parser.add_argument("--mapping", help="Read the mapping from this JSON file, and reload it whenever it changes", metavar="FILE")
+        parser.add_argument("--replay", help="Handle the messages in this Standard MIDI File, rather than those from the source", metavar="FILE")
+        parser.add_argument("--speed", help="Replay speed: 2 plays twice as fast as recorded, 0 as fast as possible (default 1)", type=float, default=1.0)
+        parser.add_argument("--stats", help="Print latency and throughput statistics as JSON on exit, and every STATS seconds if given", nargs='?', type=float, const=0, metavar="SECONDS")
+        parser.add_argument("--buffer", help="Bound each source's receive buffer to this many bytes", type=int, metavar="BYTES")
+        parser.add_argument("--overflow", help="What to do when a bounded receive buffer is full (default coalesce)", choices=backends.OVERFLOW_POLICIES, default='coalesce')
+        parser.add_argument("--rate", help="Limit output to this many bytes a second (3125 for DIN), merging superseded controller values", type=float, metavar="BYTES")
+        parser.add_argument("--backend", help="The MIDI backend to use, e.g. coremidi or loopback (default: $SIMPLECOREMIDI_BACKEND or coremidi)")
 
         return parser.parse_args(), parser.format_help()
 
     @classmethod
     def ports(cls):
-        print >> sys.stderr, "Available sources:"
-        print >> sys.stderr, "    " + "\n    ".join([s.name for s in MIDISource.list()])
-        print >> sys.stderr, ""
-        print >> sys.stderr, "Available destinations:"
-        print >> sys.stderr, "    " + "\n    ".join([d.name for d in MIDIDestination.list()])
+        sys.stderr.write("Available sources:\n")
+        sys.stderr.write("    " + "\n    ".join([s.name for s in MIDISource.list()]) + "\n\n")
+        sys.stderr.write("Available destinations:\n")
+        sys.stderr.write("    " + "\n    ".join([d.name for d in MIDIDestination.list()]) + "\n")
         return 1
 
-    def find_endpoints(self, source_substring, destination_substring):
-        sources = [s for s in MIDISource.list() if s.name.find(source_substring) != -1]
+    def find_endpoints(self, source_substring, destination_substring, merge=False):
+        registry = get_registry()
+        sources = registry.find_sources(source_substring)
         if sources:
+            self.sources = sources if merge else sources[:1]
             self.source = sources[0]
-            logger.info("Using \"%s\" as the midi source" % self.source.name)
+            for source in self.sources:
+                logger.info("Using \"%s\" as a midi source" % source.name)
         else:
             raise EndpointError("Unable to find a source with a substring of %s" % source_substring)
 
-        destinations = [s for s in MIDIDestination.list() if s.name.find(destination_substring) != -1]
+        destinations = registry.find_destinations(destination_substring)
         if destinations:
             self.destination = destinations[0]
             logger.info("Using \"%s\" as the midi destination" % self.destination.name)
@@ -155,80 +422,177 @@ class MIDIMapper(object):
             raise EndpointError("Unable to find a destination with a substring of %s" % destination_substring)
 
 
+class TriggerState(object):
+    """
+    The state triggers keep between messages, for one mapper.
+
+    Everything is held in fixed size arrays indexed by (channel << 7) | number, so updates are O(1) and the memory
+    used doesn't grow however long the mapper runs.
+    """
+    UNKNOWN = -1
+
+    def __init__(self):
+        # when each note went down (0 if it is up)
+        self.note_on_times = array('d', [0.0]) * 2048
+        # messages handled so far, counted by MIDIMapper.handle, so that triggers can tell one message from the next
+        self.handled = 0
+        # (handled, index, is long press) for the last note off that released a note
+        self.release = None
+        # per channel bitmaps of the notes that are down
+        self.active = [0] * 16
+        self._values = {}
+
+    @staticmethod
+    def index(message):
+        """
+        the slot a message's state is kept in: distinct for each message type, channel and note or controller number
+        """
+        number = getattr(message, 'control', None)
+        if number is None:
+            number = getattr(message, 'number', 0)
+        if message.channel is None:
+            # system messages
+            return (7 << 11) | ((message.message_type & 0x0F) << 7)
+        return (((message.message_type >> 4) & 0x07) << 11) | (message.channel << 7) | number
+
+    def swap_value(self, attribute, message, value):
+        """stores the value of one of a message's attributes, returning the value stored previously (or UNKNOWN)"""
+        values = self._values.get(attribute)
+        if values is None:
+            values = self._values[attribute] = array('i', [self.UNKNOWN]) * (8 << 11)
+        index = self.index(message)
+        last = values[index]
+        values[index] = value
+        return last
+
+    def note_on(self, channel, number, when):
+        index = (channel << 7) | number
+        if not self.note_on_times[index]:
+            self.note_on_times[index] = when
+            self.active[channel] |= 1 << number
+
+    def note_off(self, channel, number, when):
+        """returns how long the note was down, or None if it wasn't"""
+        index = (channel << 7) | number
+        on = self.note_on_times[index]
+        if not on:
+            return None
+        self.note_on_times[index] = 0.0
+        self.active[channel] &= ~(1 << number)
+        return when - on
+
+    def active_notes(self):
+        """a list of (channel, number) for every note that is down"""
+        notes = []
+        for channel, bitmap in enumerate(self.active):
+            number = 0
+            while bitmap:
+                if bitmap & 1:
+                    notes.append((channel, number))
+                bitmap >>= 1
+                number += 1
+        return notes
+
+
 class Trigger(object):
     LONG_PRESS_THRESHOLD = 0.5
-    LONG_PRESS_ATTR = '__is_longpress__'
 
-    __notes_down = {}
+    owner = None
+    # used by triggers that don't belong to a mapper
+    _default_state = TriggerState()
+
+    @property
+    def state(self):
+        return self.owner.state if self.owner is not None else self._default_state
 
-    def _maybe_set_longpress_attr(self, message):
+    def _is_longpress(self, message):
         """
         determines (on note off) whether the note was on for long enough to be a long press.
-        This is computed once per note number, and is attached as an attribute to the note off message.
 
-        As such, this method immediately if:
-            --  longpress has already been computed (the message contains that attribute)
+        Returns None (unknown) if:
             --  it is not a note message
             --  it is a not a note off message
+            --  there was no matching note on
 
-        Consequently, the "is_longpress" state of a message can be True, False, or unknown (no attribute)
-
+        Messages are shared and read-only (and interned, so a repeated note off is the same object), so the result
+        can't be attached to the note off message. Instead it is remembered with the count of messages the mapper
+        has handled, so that every trigger looking at the same note off gets the same answer, and a repeated note off
+        gets none.
         """
-        def set_note_down(number):
-            if number not in self.__notes_down:
-                self.__notes_down[number] = now()
-                logger.debug ("note %d on at %0.2f (%s)" % (
-                    number, self.__notes_down[number], typename(self)))
-
-        if hasattr(message, self.LONG_PRESS_ATTR):
-            return
-
         if not isinstance(message, NoteMessage):
-            return
+            return None
 
+        state = self.state
+        channel = message.channel
+        number = message.number
         if not message.is_note_off():
-            set_note_down(message.number)
-            return
-
-        if message.number not in self.__notes_down:
-            return
-
-        duration = (now() - self.__notes_down[message.number])
-        if duration > self.LONG_PRESS_THRESHOLD:
-            is_long_press = True
-        else:
-            is_long_press = False
-
-        setattr(message, self.LONG_PRESS_ATTR, is_long_press)
-        logger.debug ("note %d off at %0.2f (duration %0.2f): %s (%s)" % (
-            message.number, now(), duration,
+            state.note_on(channel, number, now())
+            return None
+
+        duration = state.note_off(channel, number, now())
+        index = (channel << 7) | number
+        if duration is None:
+            release = state.release
+            if self.owner is not None and release is not None and release[:2] == (state.handled, index):
+                # released by this message, as another trigger has already found
+                return release[2]
+            return None
+
+        is_long_press = duration > self.LONG_PRESS_THRESHOLD
+        state.release = (state.handled, index, is_long_press)
+        logger.debug ("note %d off (duration %0.2f): %s (%s)" % (
+            number, duration,
             "long press" if is_long_press else "tap",
             typename(self)))
-        del self.__notes_down[message.number]
-
+        return is_long_press
 
 
 class LongPress(Trigger):
 
     def matches(self, message):
-        self._maybe_set_longpress_attr(message)
-        return getattr(message, self.LONG_PRESS_ATTR, None) is True
+        return self._is_longpress(message) is True
 
 
 class Tap(Trigger):
     def matches(self, message):
-        self._maybe_set_longpress_attr(message)
-        return getattr(message, self.LONG_PRESS_ATTR, None) is False
+        return self._is_longpress(message) is False
 
 class Action(object):
+    scheduler = None
+    # blocking actions may take a while to execute, so are run on the mapper's ActionPool
+    blocking = False
+
     def execute(self):
         pass
 
     def update(self, *args, **kwargs):
+        scheduler = kwargs.get('scheduler')
+        if scheduler is not None:
+            self.scheduler = scheduler
         return self
 
+    def state_key(self):
+        """
+        identifies the state an action keeps between executions, or None if it keeps none. When a mapping is
+        replaced, each new action adopts the state of the old action with the same key.
+        """
+        return None
+
+    def adopt(self, previous):
+        """takes over the state of previous, the action this one replaces"""
+        pass
+
+    def later(self, delay, callback, *args):
+        """
+        calls callback(*args) after delay seconds, without blocking.
+        Actions must use this rather than sleeping, which would hold up every message behind them.
+        """
+        return (self.scheduler or default_scheduler()).call_later(delay, callback, *args)
+
 
 class Keystroke(Action):
+    blocking = True
+
     def __init__(self, key, modifiers=0, duration=DEFAULT_DURATION):
         self.key = key
         self.modifiers = modifiers
@@ -238,8 +602,7 @@ class Keystroke(Action):
         if autopy:
             logger.debug("Keypress %s" % self.key)
             autopy.key.toggle(self.key, True, self.modifiers)
-            sleep(self.duration)
-            autopy.key.toggle(self.key, False, self.modifiers)
+            self.later(self.duration, autopy.key.toggle, self.key, False, self.modifiers)
         else:
             logger.debug("autopy not found")
 
@@ -248,6 +611,7 @@ class MIDIAction(Action):
         self.update(port, channel, message=None)
 
     def update(self, port, channel, message, **kwargs):
+        super(MIDIAction, self).update(**kwargs)
         self.port = port
         self.channel = channel
         self.message = message
@@ -264,6 +628,7 @@ class Note(MIDIAction):
         self.duration = duration
 
         self.__state = self.OFF
+        self.__pending_off = None
 
     def __do_toggle(self):
         if self.__state == self.ON:
@@ -275,10 +640,15 @@ class Note(MIDIAction):
         logger.debug("note %d toggled %s" % (self.number, "off" if self.__state == self.OFF else "on"))
 
     def __do_tap(self):
+        note_off = NoteOffMessage(channel=self.channel, number=self.number).asNoteOn()
+        pending_off = self.__pending_off
+        if pending_off is not None and not pending_off.cancelled:
+            # tapped again before the last tap finished: end that one now, rather than in the middle of this one
+            pending_off.cancel()
+            pending_off.callback(*pending_off.args)
         self.port.send(NoteOnMessage(channel=self.channel, number=self.number, velocity=self.velocity))
-        sleep(self.duration)
-        self.port.send(NoteOffMessage(channel=self.channel, number=self.number).asNoteOn())
-        logger.debug("note %d tapped for %d seconds" % (self.number, self.duration))
+        self.__pending_off = self.later(self.duration, self.port.send, note_off)
+        logger.debug("note %d tapped for %0.2f seconds" % (self.number, self.duration))
 
     def execute(self):
         is_note_off = getattr(self.message, 'is_note_off', None)
@@ -290,6 +660,14 @@ class Note(MIDIAction):
         else:
             self.__do_tap()
 
+    def state_key(self):
+        return Note, self.number
+
+    def adopt(self, previous):
+        if self.toggle and previous.toggle:
+            self.__state = previous.__state
+        self.__pending_off = previous.__pending_off
+
     # FIXME -- need to be smarter about this hashing
     def __hash__(self):
         return hash(self.number)
@@ -339,26 +717,30 @@ class Send(MIDIAction):
         self.kwargs = kwargs
 
     def execute(self):
-        for attr, value in self.kwargs.items():
-            setattr(self.message, attr, value)
-        self.port.send(self.message)
+        message = self.message
+        if self.kwargs:
+            # received messages are shared, so send a modified copy
+            message = message.replace(**self.kwargs)
+        self.port.send(message)
 
 
 class Change(Trigger):
-    __last_value = {}
-
+    """matches when an attribute differs from its value in the last message of the same type, channel and number"""
     def __init__(self, attribute='value'):
         self.attribute = attribute
 
     def matches(self, message):
-        last_value = self.__last_value.get(message, None)
         this_value = getattr(message, self.attribute, None)
-
-        self.__last_value[message] = this_value
-        return last_value != this_value
+        if this_value is None:
+            this_value = TriggerState.UNKNOWN
+        return self.state.swap_value(self.attribute, message, this_value) != this_value
 
 
 class Compare(Trigger):
+    """
+    matches when predicate(message) is true. If duration is given, the predicate must stay true for that many seconds
+    before the trigger fires; the wait is armed on the mapper's scheduler, so no thread is created per timer.
+    """
     def __init__(self, predicate, duration=0):
         self.predicate = predicate
         self.duration = duration
@@ -366,25 +748,23 @@ class Compare(Trigger):
 
         self.timer = None
 
-    def fire(self, *args, **kwargs):
-        #_self = args[0]
-        _message = args[1]
+    def fire(self, message):
         logger.debug("%s firing trigger" % self)
         self.timer = None
-        self.owner.execute(self, _message)
+        self.owner.execute(self, message)
 
     def matches(self, message):
         result = self.predicate (message)
         if result:
             if self.duration > 0:
-                if not self.timer or not self.timer.is_alive():
+                if self.timer is None or self.timer.cancelled:
                     logger.debug("%s initiated a deferred trigger" % self)
-                    self.timer = Timer(self.duration, self.fire, args=(self, message))
-                    self.timer.start()
+                    scheduler = self.owner.scheduler if self.owner is not None else default_scheduler()
+                    self.timer = scheduler.call_later(self.duration, self.fire, message)
                 result = None  # we havent matched yet
         else:
             #logger.debug("%s became false before the duration expired" % self)
             if self.timer:
                 self.timer.cancel()
 
-        return result
\ No newline at end of file
+        return result
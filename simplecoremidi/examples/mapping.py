@@ -0,0 +1,431 @@
+"""
+Mapping files for MIDIMapper.
+
+A mapping file is JSON: a list of mappings, each naming the input it applies to (a note, controller or program
+number) and either the actions to take ("do") or a list of triggers and the action each fires ("when"):
+
+    {"mappings": [
+        {"note": 1, "when": [{"trigger": "long_press", "do": {"keystroke": "K_F16"}},
+                             {"trigger": "tap", "do": {"keystroke": "K_F17"}}]},
+        {"note": 3, "when": [{"trigger": "tap", "do": {"note": 3, "toggle": true}}]},
+        {"controller": 26, "do": []},
+        {"controller": 12, "when": [
+            {"trigger": "change", "do": {"send": {}}},
+            {"trigger": {"compare": {"op": ">", "value": 120, "duration": 1.0}}, "do": {"note": 11, "toggle": true}}]}
+    ]}
+
+Triggers are "tap", "long_press", "change" (or {"change": {"attribute": ...}}) and {"compare": {"attribute", "op",
+"value", "duration"}}. Actions are {"note": ...}, {"program": ...}, {"controller": ...}, {"keystroke": ...} and
+{"send": {...}}, each given either its first argument or an object of keyword arguments: {"note": 2} and
+{"note": {"number": 2}} are the same. A send resends the message received, with the attributes given replaced: its
+channel, or its number and velocity, program, or control and value.
+
+load() validates a file and builds the actions mapping MIDIMapper takes. The validated mapping is cached, as plain
+JSON with every shorthand expanded, in the user's cache directory, and while the file is unchanged the actions are
+built straight from the cache, so startup doesn't pay for validation. Nothing in the cache is executed: it only
+ever holds numbers, strings, lists and objects.
+
+MappingWatcher reloads a file when it changes, so a mapping can be edited, or replaced between songs, while the
+mapper runs.
+"""
+import hashlib
+import json
+import logging
+import operator
+import os
+import sys
+from threading import Event, Thread
+
+from mapper import Note, Program, Controller, Keystroke, Send, Tap, LongPress, Change, Compare, key
+
+logger = logging.getLogger("MIDIMapper")
+
+# bump when the form of cached mappings changes
+CACHE_VERSION = 3
+
+OPERATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '>=': operator.ge,
+    '>': operator.gt,
+}
+
+
+class MappingError(ValueError):
+    pass
+
+
+class Comparison(object):
+    """a Compare predicate: true when getattr(message, attribute) op value. Unlike a lambda, it can be pickled."""
+    def __init__(self, attribute, op, value):
+        self.attribute = attribute
+        self.op = op
+        self.value = value
+        self._compare = OPERATORS[op]
+
+    def __call__(self, message):
+        value = getattr(message, self.attribute, None)
+        return value is not None and self._compare(value, self.value)
+
+    def __getstate__(self):
+        return self.attribute, self.op, self.value
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __repr__(self):
+        return "Comparison(%r, %r, %r)" % (self.attribute, self.op, self.value)
+
+
+def _require(condition, where, problem):
+    if not condition:
+        raise MappingError("%s: %s" % (where, problem))
+
+
+def _number(value, where, maximum=127):
+    _require(isinstance(value, int) and not isinstance(value, bool) and 0 <= value <= maximum,
+             where, "expected a number from 0 to %d, not %r" % (maximum, value))
+    return value
+
+
+def _duration(value, where):
+    _require(isinstance(value, (int, float)) and not isinstance(value, bool) and value >= 0,
+             where, "expected a number of seconds, not %r" % (value,))
+    return value
+
+
+def _single(spec, where, kinds):
+    """splits {"kind": arguments} into its kind and arguments"""
+    _require(isinstance(spec, dict) and len(spec) == 1, where, "expected one of %s" % ", ".join(sorted(kinds)))
+    kind, arguments = list(spec.items())[0]
+    _require(kind in kinds, where, "unknown %r (expected one of %s)" % (kind, ", ".join(sorted(kinds))))
+    return kind, arguments
+
+
+def _arguments(arguments, where, names, first=None):
+    """the keyword arguments of an action or trigger, given either as an object or as the value of the first"""
+    if not isinstance(arguments, dict):
+        _require(first is not None, where, "expected an object of arguments")
+        arguments = {first: arguments}
+    for name in arguments:
+        _require(name in names, where, "unknown argument %r (expected %s)" % (name, ", ".join(sorted(names))))
+    if first is not None:
+        _require(first in arguments, where, "%r is required" % first)
+    return arguments
+
+
+def _note(arguments, where):
+    arguments = _arguments(arguments, where, ('number', 'velocity', 'toggle', 'duration'), 'number')
+    _number(arguments['number'], where + ".number")
+    _number(arguments.get('velocity', 0), where + ".velocity")
+    _duration(arguments.get('duration', 0), where + ".duration")
+    _require(isinstance(arguments.get('toggle', False), bool), where + ".toggle", "expected true or false")
+    return arguments
+
+
+def _program(arguments, where):
+    arguments = _arguments(arguments, where, ('program',), 'program')
+    _number(arguments['program'], where + ".program")
+    return arguments
+
+
+def _controller(arguments, where):
+    arguments = _arguments(arguments, where, ('control', 'value'), 'control')
+    _number(arguments['control'], where + ".control")
+    _number(arguments.get('value', 0), where + ".value")
+    return arguments
+
+
+def _keystroke(arguments, where):
+    arguments = _arguments(arguments, where, ('key', 'modifiers', 'duration'), 'key')
+    name = arguments['key']
+    _require(isinstance(name, (str, type(u''))), where + ".key",
+             "expected a key name such as K_F16, not %r" % (name,))
+    _duration(arguments.get('duration', 0), where + ".duration")
+    # without autopy keystrokes don't work anyway, so the name can't be checked
+    _require(key is None or hasattr(key, name), where + ".key", "unknown key %r" % name)
+    return arguments
+
+
+def _send(arguments, where, fields):
+    _require(isinstance(arguments, dict), where, "expected an object of attributes to replace")
+    for name, value in arguments.items():
+        _require(name in fields, where, "unknown attribute %r (expected %s)" % (name, ", ".join(sorted(fields))))
+        _number(value, "%s.%s" % (where, name), fields[name])
+    return arguments
+
+
+ACTIONS = {
+    'note': _note,
+    'program': _program,
+    'controller': _controller,
+    'keystroke': _keystroke,
+    'send': _send,
+}
+
+
+def _tap(arguments, where):
+    return _arguments(arguments or {}, where, ())
+
+
+def _long_press(arguments, where):
+    return _arguments(arguments or {}, where, ())
+
+
+def _change(arguments, where):
+    return _arguments(arguments or {}, where, ('attribute',))
+
+
+def _compare(arguments, where):
+    arguments = _arguments(arguments, where, ('attribute', 'op', 'value', 'duration'))
+    _require('value' in arguments, where, "'value' is required")
+    op = arguments.get('op', '==')
+    _require(op in OPERATORS, where + ".op", "unknown operator %r (expected one of %s)" % (
+        op, ", ".join(sorted(OPERATORS))))
+    _number(arguments['value'], where + ".value", 16383)
+    _duration(arguments.get('duration', 0), where + ".duration")
+    return arguments
+
+
+TRIGGERS = {
+    'tap': _tap,
+    'long_press': _long_press,
+    'change': _change,
+    'compare': _compare,
+}
+
+INPUTS = {
+    'note': Note,
+    'program': Program,
+    'controller': Controller,
+}
+
+# the attributes a send may replace in the messages each input maps, and the largest value of each
+SEND_FIELDS = {
+    'note': {'channel': 15, 'number': 127, 'velocity': 127},
+    'program': {'channel': 15, 'program': 127},
+    'controller': {'channel': 15, 'control': 127, 'value': 127},
+}
+
+
+def _strings(arguments):
+    # JSON keys are unicode on python 2, which isn't allowed for keyword arguments there
+    return dict((str(name), value) for name, value in arguments.items())
+
+
+def _make_keystroke(**arguments):
+    if key is not None:
+        arguments['key'] = getattr(key, arguments['key'])
+    return Keystroke(**arguments)
+
+
+def _make_compare(attribute='value', op='==', value=None, duration=0):
+    return Compare(Comparison(str(attribute), str(op), value), duration=duration)
+
+
+# what each kind of action and trigger is built with, from the keyword arguments its validator returned
+ACTION_CLASSES = {
+    'note': Note,
+    'program': Program,
+    'controller': Controller,
+    'keystroke': _make_keystroke,
+    'send': Send,
+}
+
+TRIGGER_CLASSES = {
+    'tap': Tap,
+    'long_press': LongPress,
+    'change': Change,
+    'compare': _make_compare,
+}
+
+
+def _action(spec, where, input):
+    kind, arguments = _single(spec, where, ACTIONS)
+    where = "%s.%s" % (where, kind)
+    if kind == 'send':
+        # what a send can replace depends on the message it resends
+        return [kind, _send(arguments, where, SEND_FIELDS[input])]
+    return [kind, ACTIONS[kind](arguments, where)]
+
+
+def _trigger(spec, where):
+    if isinstance(spec, dict):
+        kind, arguments = _single(spec, where, TRIGGERS)
+    else:
+        kind, arguments = spec, None
+        _require(kind in TRIGGERS, where, "unknown trigger %r (expected one of %s)" % (
+            kind, ", ".join(sorted(TRIGGERS))))
+    return [kind, TRIGGERS[kind](arguments, "%s.%s" % (where, kind))]
+
+
+def validate(document):
+    """
+    validates a parsed mapping document, returning it in the plain form load() caches: a list of [input, number,
+    form, rules], where form is 'do' for a list of actions, 'action' for a single action, or 'when' for a list of
+    [trigger, action] pairs, and each trigger or action is a [kind, keyword arguments] pair.
+    """
+    _require(isinstance(document, dict) and isinstance(document.get('mappings'), list),
+             "mapping", "expected an object with a list of mappings")
+    mappings = []
+    inputs = {}
+    for i, mapping in enumerate(document['mappings']):
+        where = "mappings[%d]" % i
+        _require(isinstance(mapping, dict), where, "expected an object")
+        named = [name for name in INPUTS if name in mapping]
+        _require(len(named) == 1, where, "expected exactly one of %s" % ", ".join(sorted(INPUTS)))
+        kind = named[0]
+        number = _number(mapping[kind], "%s.%s" % (where, kind))
+        _require((kind, number) not in inputs, where, "%s %d is already mapped by %s" % (
+            kind, number, inputs.get((kind, number))))
+        inputs[kind, number] = where
+        rest = set(mapping) - set([kind])
+        _require(len(rest) == 1 and rest <= set(['do', 'when']), where, "expected either 'do' or 'when'")
+
+        if 'do' in mapping:
+            spec = mapping['do']
+            if isinstance(spec, list):
+                mappings.append([kind, number, 'do', [_action(action, "%s.do[%d]" % (where, j), kind)
+                                                      for j, action in enumerate(spec)]])
+            else:
+                mappings.append([kind, number, 'action', _action(spec, where + ".do", kind)])
+        else:
+            _require(isinstance(mapping['when'], list), where + ".when", "expected a list of rules")
+            rules = []
+            for j, rule in enumerate(mapping['when']):
+                rule_where = "%s.when[%d]" % (where, j)
+                _require(isinstance(rule, dict) and set(rule) == set(['trigger', 'do']),
+                         rule_where, "expected an object with 'trigger' and 'do'")
+                rules.append([_trigger(rule['trigger'], rule_where + ".trigger"),
+                              _action(rule['do'], rule_where + ".do", kind)])
+            mappings.append([kind, number, 'when', rules])
+    return mappings
+
+
+def _build(spec, classes):
+    kind, arguments = spec
+    return classes[kind](**_strings(arguments))
+
+
+def build(mappings):
+    """builds the actions mapping for MIDIMapper from mappings in the form validate() returns"""
+    actions = {}
+    for kind, number, form, rules in mappings:
+        if form == 'do':
+            responses = tuple(_build(action, ACTION_CLASSES) for action in rules)
+        elif form == 'action':
+            responses = _build(rules, ACTION_CLASSES)
+        else:
+            responses = dict((_build(trigger, TRIGGER_CLASSES), _build(action, ACTION_CLASSES))
+                             for trigger, action in rules)
+        actions[INPUTS[kind](number)] = responses
+    return actions
+
+
+def build_actions(document):
+    """validates a parsed mapping document, returning the actions mapping it describes"""
+    return build(validate(document))
+
+
+def cache_directory():
+    """where load() caches validated mappings"""
+    if sys.platform == 'darwin':
+        base = os.path.expanduser(os.path.join('~', 'Library', 'Caches'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(os.path.join('~', '.cache'))
+    return os.path.join(base, 'simplecoremidi', 'mappings')
+
+
+def _cache_path(path):
+    name = os.path.abspath(path)
+    if not isinstance(name, bytes):
+        name = name.encode('utf-8')
+    return os.path.join(cache_directory(), hashlib.sha1(name).hexdigest() + ".json")
+
+
+def _cache_key(source):
+    # key names are only checked when autopy is available, so a cache is only good for one or the other
+    return [CACHE_VERSION, hashlib.sha1(source).hexdigest(), key is not None]
+
+
+def load(path, cache=True):
+    """
+    reads, validates and builds the mapping in the file at path, returning the actions mapping for MIDIMapper.
+    Raises MappingError (a ValueError) if the file isn't a valid mapping.
+    """
+    with open(path, 'rb') as f:
+        source = f.read()
+    cache_key = _cache_key(source)
+    cache_path = _cache_path(path)
+    if cache:
+        try:
+            with open(cache_path, 'rb') as f:
+                cached = json.loads(f.read().decode('utf-8'))
+            if cached['key'] == cache_key:
+                return build(cached['mappings'])
+        except Exception:
+            # missing, stale or unreadable: validate it again
+            pass
+
+    try:
+        document = json.loads(source.decode('utf-8'))
+    except ValueError as e:
+        raise MappingError("%s: %s" % (path, e))
+    mappings = validate(document)
+
+    if cache:
+        temporary = "%s.%d" % (cache_path, os.getpid())
+        try:
+            if not os.path.isdir(cache_directory()):
+                os.makedirs(cache_directory())
+            with open(temporary, 'w') as f:
+                json.dump({'key': cache_key, 'mappings': mappings}, f)
+            os.rename(temporary, cache_path)
+        except (IOError, OSError) as e:
+            logger.debug("couldn't cache %s: %s" % (path, e))
+    return build(mappings)
+
+
+class MappingWatcher(object):
+    """
+    Polls a mapping file every interval seconds and, when it changes, loads it and calls on_change(actions) on the
+    watcher's thread. A file that doesn't load is logged and otherwise ignored, so the last good mapping stays in
+    use.
+    """
+    def __init__(self, path, on_change, interval=0.5):
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self._signature = self._stat()
+        self._stopped = Event()
+        self._thread = Thread(target=self._watch, name="MIDIMapper mapping watcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size, stat.st_ino
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            signature = self._stat()
+            if signature is None or signature == self._signature:
+                continue
+            self._signature = signature
+            try:
+                actions = load(self.path)
+            except (MappingError, IOError) as e:
+                logger.error("not reloading %s: %s" % (self.path, e))
+                continue
+            try:
+                self.on_change(actions)
+            except Exception:
+                logger.exception("reloading %s failed" % self.path)
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,198 @@
+"""
+Runs many mapper routes in one process.
+
+A route is a MIDIMapper: a source (or every source matching a name, with merge), a destination and a mapping. A
+MIDIRouter hosts any number of them, all sharing one MIDIHub to wait on their sources, one scheduler for their
+timers and one pool for their blocking actions, so routing twelve controllers takes one process and one receive
+thread rather than twelve of each. A source feeding several routes is read once, and each route handles every
+message from it.
+
+    python router.py --route "nanoKONTROL" "IAC Bus 1" kontrol.json --route "FCB1010" "IAC Bus 2" fcb.json
+
+With --workers N the routes are dealt out to N processes, each running its own router. Each process connects to its
+routes' endpoints itself (CoreMIDI delivers a source's messages to every client connected to it), so no messages
+need to pass between processes and a busy route only competes with the routes in its own process.
+"""
+import argparse
+import json
+import logging
+import sys
+from multiprocessing import Process
+
+from simplecoremidi import backends
+from simplecoremidi.hub import MIDIHub
+from simplecoremidi.scheduler import default_scheduler
+from simplecoremidi.clock import monotonic as now
+from mapper import MIDIMapper, ActionPool, EndpointError, logger
+
+
+class MIDIRouter(object):
+    def __init__(self, scheduler=None, pool=None, mapper_class=MIDIMapper):
+        self.scheduler = scheduler or default_scheduler()
+        self.pool = pool or ActionPool()
+        self.mapper_class = mapper_class
+        self.routes = []
+        self.hub = MIDIHub()
+        # source -> the routes it feeds
+        self._routes_by_source = {}
+
+    def add_route(self, actions, source, destination, merge=False):
+        """
+        adds a route from the source(s) matching source to the destination matching destination, mapped by actions.
+        Returns the route's MIDIMapper. Raises EndpointError if either can't be found.
+        """
+        route = self.mapper_class(actions, source, destination, scheduler=self.scheduler, pool=self.pool,
+                                  merge=merge)
+        self.routes.append(route)
+        for source in route.sources:
+            if source not in self._routes_by_source:
+                self.hub.register(source)
+                self._routes_by_source[source] = ()
+            self._routes_by_source[source] += (route,)
+        return route
+
+    def remove_route(self, route):
+        self.routes.remove(route)
+        for source in route.sources:
+            routes = tuple(r for r in self._routes_by_source[source] if r is not route)
+            if routes:
+                self._routes_by_source[source] = routes
+            else:
+                del self._routes_by_source[source]
+                self.hub.unregister(source)
+
+    def run(self):
+        """handles messages as they arrive, from every route's sources, until interrupted"""
+        while True:
+            self.handle_ready(timeout=1)
+
+    def handle_ready(self, timeout=1):
+        """waits up to timeout seconds for messages, then has each route handle those from its sources"""
+        for source, messages in self.hub.receive(timeout=timeout):
+            arrival = source.last_arrival
+            for route in self._routes_by_source.get(source, ()):
+                if arrival is not None:
+                    route.latency['queue'].record(now() - arrival)
+                handle = route.handle
+                for message in messages:
+                    handle(message)
+                if arrival is not None:
+                    route.latency['end_to_end'].record(now() - arrival)
+
+    def stats(self):
+        routes = []
+        for route in self.routes:
+            stats = route.stats()
+            stats['route'] = "%s -> %s" % (", ".join(source.name for source in route.sources),
+                                           route.destination.name)
+            routes.append(stats)
+        return {'routes': routes}
+
+    def dump_stats(self, file=None):
+        (file or sys.stderr).write(json.dumps(self.stats(), indent=2, sort_keys=True) + "\n")
+
+    def dump_stats_every(self, interval):
+        def dump():
+            self.dump_stats()
+            self.scheduler.call_later(interval, dump)
+        self.scheduler.call_later(interval, dump)
+
+
+def serve(routes, merge=False, stats=None):
+    """
+    runs a router for routes, a list of (source, destination, mapping file) triples, watching each mapping file for
+    changes. Returns an exit status.
+    """
+    from mapping import load, MappingError, MappingWatcher
+    router = MIDIRouter()
+    for source, destination, path in routes:
+        try:
+            route = router.add_route(load(path), source, destination, merge=merge)
+        except (EndpointError, MappingError, IOError) as e:
+            sys.stderr.write("%s -> %s: %s\n" % (source, destination, e))
+            return 2
+        MappingWatcher(path, route.swap_actions)
+
+    if stats:
+        router.dump_stats_every(stats)
+    try:
+        router.run()
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        if stats is not None:
+            router.dump_stats()
+
+
+def _serve_worker(routes, backend, merge, stats, verbosity):
+    if backend:
+        backends.set_backend(backend)
+    logger.setLevel(verbosity)
+    sys.exit(serve(routes, merge, stats))
+
+
+def serve_workers(routes, workers, backend=None, merge=False, stats=None):
+    """
+    deals routes out to workers processes, each serving its share with its own router. Returns an exit status: 0
+    if every worker exits cleanly. Each worker that doesn't is reported, with its routes, on stderr.
+
+    The workers are forked, and must connect to MIDI themselves: a CoreMIDI client doesn't survive a fork. So no
+    backend may have been selected in this process before they start; RuntimeError is raised if one has.
+    """
+    if backends.backend_selected():
+        raise RuntimeError("a MIDI backend is already in use in this process, so it can't fork router workers")
+    processes = []
+    for i in range(workers):
+        share = routes[i::workers]
+        if not share:
+            break
+        process = Process(target=_serve_worker, name="MIDIRouter worker %d" % i,
+                          args=(share, backend, merge, stats, logger.level))
+        process.start()
+        processes.append((process, share))
+    try:
+        for process, share in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # the workers get the interrupt too
+        for process, share in processes:
+            process.join()
+    status = 0
+    for process, share in processes:
+        if process.exitcode:
+            if process.exitcode < 0:
+                problem = "was killed by signal %d" % -process.exitcode
+            else:
+                problem = "exited with status %d" % process.exitcode
+            sys.stderr.write("%s (%s) %s\n" % (process.name, ", ".join(
+                "%s -> %s" % (source, destination) for source, destination, path in share), problem))
+            status = status or max(process.exitcode, 1)
+    return status
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run many MIDI mapper routes in one process")
+    parser.add_argument("-v", "--verbose", help="Show verbose output", action='store_true')
+    parser.add_argument("-d", "--debug", help="Show debugging output", action='store_true')
+    parser.add_argument("--route", help="Map messages from the first source whose name contains SOURCE to the first destination whose name contains DESTINATION, with the mapping in the JSON file MAPPING",
+                        nargs=3, action='append', metavar=("SOURCE", "DESTINATION", "MAPPING"), required=True)
+    parser.add_argument("--merge", help="Read from every source whose name contains SOURCE, not just the first", action="store_true")
+    parser.add_argument("--workers", help="Spread the routes across this many processes (default 1: serve them all in this one)", type=int, default=1)
+    parser.add_argument("--stats", help="Print per route statistics as JSON on exit, and every STATS seconds if given", nargs='?', type=float, const=0, metavar="SECONDS")
+    parser.add_argument("--backend", help="The MIDI backend to use, e.g. coremidi or loopback (default: $SIMPLECOREMIDI_BACKEND or coremidi)")
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        logger.setLevel(logging.INFO)
+    elif args.debug:
+        logger.setLevel(logging.DEBUG)
+
+    if args.workers > 1:
+        return serve_workers(args.route, args.workers, args.backend, args.merge, args.stats)
+    if args.backend:
+        backends.set_backend(args.backend)
+    return serve(args.route, args.merge, args.stats)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
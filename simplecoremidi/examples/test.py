@@ -4,6 +4,7 @@ __dir__ = os.path.dirname(__file__)
 sys.path.append(os.path.join(__dir__, '..'))
 
 from simplecoremidi import MIDIDestination, MIDISource, NoteOnMessage, NoteOffMessage
+from simplecoremidi.hub import MIDIHub
 from time import sleep
 
 NOTE_ON = 0x90
@@ -16,10 +17,11 @@ for d in MIDIDestination.list():
     sleep(1)
     d.send(NoteOffMessage(channel, MIDDLE_C).asNoteOn())
 
+hub = MIDIHub(MIDISource.list())
 while (True):
-  for s in MIDISource.list():
-    message = s.receive(timeout=2)
-    if message == None:
-      sys.stdout.write('.')
-    else:
+  batches = hub.receive(timeout=2)
+  if not batches:
+    sys.stdout.write('.')
+  for s, messages in batches:
+    for message in messages:
       print (s.name, str(message))
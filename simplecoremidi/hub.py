@@ -0,0 +1,121 @@
+"""
+Receiving from many sources at once.
+
+Polling sources one after another with receive(timeout=...) lets a quiet source hold up busy ones for the whole
+timeout. A MIDIHub instead waits once, in select(), on the readiness file descriptors of every source registered
+with it, and returns whatever has arrived on any of them:
+
+    hub = MIDIHub(MIDISource.list())
+    while True:
+        for source, messages in hub.receive():
+            ...
+
+Sources whose backend can't provide a readiness descriptor are polled every POLL_INTERVAL seconds instead. A
+source that is reconnected (see registry) is registered again with its new descriptor, and one that can't be is
+dropped.
+"""
+import select
+import time
+
+from .clock import monotonic
+
+POLL_INTERVAL = 0.001
+
+
+class MIDIHub(object):
+    def __init__(self, sources=()):
+        self._sources = []
+        # readiness fd -> source
+        self._fds = {}
+        # sources without a readiness fd
+        self._polled = []
+        # source -> its connection count when it was registered
+        self._connections = {}
+        for source in sources:
+            self.register(source)
+
+    @property
+    def sources(self):
+        return list(self._sources)
+
+    def register(self, source):
+        """adds a source. This connects it, so nothing it receives from now on is missed"""
+        if source in self._sources:
+            return
+        try:
+            fd = source.fileno()
+        except NotImplementedError:
+            fd = None
+        self._sources.append(source)
+        self._connections[source] = source._connections
+        if fd is None:
+            self._polled.append(source)
+        else:
+            self._fds[fd] = source
+
+    def unregister(self, source):
+        self._sources.remove(source)
+        del self._connections[source]
+        if source in self._polled:
+            self._polled.remove(source)
+        for fd, registered in list(self._fds.items()):
+            if registered is source:
+                del self._fds[fd]
+
+    def _check_connections(self):
+        for source in list(self._sources):
+            if source._connections != self._connections[source]:
+                self.unregister(source)
+                try:
+                    self.register(source)
+                except Exception:
+                    # the source has gone for good
+                    pass
+
+    def __len__(self):
+        return len(self._sources)
+
+    def _collect(self, sources):
+        batches = []
+        for source in sources:
+            messages = source.receive_many(timeout=0)
+            if messages:
+                batches.append((source, messages))
+        # in order of arrival; sources that can't say when go last
+        batches.sort(key=lambda batch: batch[0].last_arrival if batch[0].last_arrival is not None else float('inf'))
+        return batches
+
+    def receive(self, timeout=1):
+        """
+        waits up to timeout seconds (forever if timeout is None) for any registered source to receive something,
+        then returns a list of (source, messages) pairs: every message received so far, from every source with
+        any, with the sources in the order their messages arrived. Returns an empty list on timeout.
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            self._check_connections()
+            # messages already parsed don't make a source's fd readable
+            ready = [source for source in self._sources if source.pending()]
+            if ready:
+                wait = 0
+            else:
+                wait = None if deadline is None else max(0, deadline - monotonic())
+                if self._polled:
+                    wait = POLL_INTERVAL if wait is None else min(POLL_INTERVAL, wait)
+            if self._fds:
+                for fd in select.select(list(self._fds), [], [], wait)[0]:
+                    if self._fds[fd] not in ready:
+                        ready.append(self._fds[fd])
+            elif wait:
+                time.sleep(wait)
+            ready.extend(source for source in self._polled if source not in ready)
+            batches = self._collect(ready)
+            if batches or (deadline is not None and monotonic() >= deadline):
+                return batches
+
+    def __iter__(self):
+        """yields (source, message) pairs as they arrive, forever"""
+        while True:
+            for source, messages in self.receive():
+                for message in messages:
+                    yield source, message
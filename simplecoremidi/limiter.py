@@ -0,0 +1,139 @@
+"""
+Output rate limiting for MIDIDestination.
+
+A 5-pin DIN port carries 3125 bytes a second. Forward a fast knob sweep to one as it arrives and the messages pile
+up in the driver or the device, which is how notes get stuck: the note off is queued behind a second of controller
+values, or lost when a buffer overruns.
+
+An OutputLimiter queues what is sent to its destination and, every window seconds, sends as much as a byte rate
+budget allows. While a controller, pitch bend or aftertouch value is waiting, a later value for the same
+controller replaces it, so a sweep collapses to the positions there was time to send. Everything else, notes,
+program changes, bank selects and pedal switches included, is sent unmerged and in order.
+
+    destination.limit_rate(3125)
+"""
+from collections import deque
+from threading import Lock
+
+from .clock import monotonic
+from .core import ChannelAftertouchMessage, ControllerChangeMessage, PitchBendMessage, PolyAftertouchMessage
+from .scheduler import default_scheduler
+
+# MIDI DIN: 31250 baud, at 10 bits a byte
+DIN_BYTES_PER_SECOND = 3125
+
+# controllers whose every value matters, and must keep its place relative to other messages:
+#   bank select (MSB and LSB), which has to stay ahead of the program change it sets up
+#   the switches (sustain, portamento, sostenuto, soft pedal, legato, hold 2), whose on/off pairs bracket notes
+#   data entry and (N)RPN selection, which depend on the order of values
+#   channel mode messages, which are commands
+UNMERGED_CONTROLLERS = frozenset([0x00, 0x20] + list(range(0x40, 0x46)) +
+                                 [0x06, 0x26, 0x60, 0x61, 0x62, 0x63, 0x64, 0x65] + list(range(0x78, 0x80)))
+
+
+def coalescing_key(message):
+    """the key under which a later message supersedes a waiting one, or None if the message can't be merged"""
+    kind = type(message)
+    if kind is ControllerChangeMessage:
+        if message.control in UNMERGED_CONTROLLERS:
+            return None
+        return kind, message.channel, message.control
+    if kind is PitchBendMessage or kind is ChannelAftertouchMessage:
+        return kind, message.channel
+    if kind is PolyAftertouchMessage:
+        return kind, message.channel, message.number
+    return None
+
+
+class OutputLimiter(object):
+    """
+    Sends messages to a destination at no more than bytes_per_second, in batches every window seconds, merging
+    superseded controller values. burst is the most bytes sent at once after a quiet spell (by default, a window's
+    worth, and at least enough for a few messages). Flushes happen on scheduler's thread.
+    """
+    def __init__(self, destination, bytes_per_second=DIN_BYTES_PER_SECOND, window=0.005, burst=None,
+                 scheduler=None):
+        self.destination = destination
+        self.bytes_per_second = float(bytes_per_second)
+        self.window = window
+        self.burst = burst or max(16, bytes_per_second * window)
+        self.scheduler = scheduler or default_scheduler()
+        # messages merged into later ones
+        self.merged = 0
+        self._lock = Lock()
+        # cells (one item lists) in the order they were sent; a superseded cell is emptied rather than removed
+        self._queue = deque()
+        self._waiting = {}
+        self._tokens = self.burst
+        self._last_refill = monotonic()
+        self._flush_call = None
+
+    def pending(self):
+        """the number of messages waiting to be sent"""
+        with self._lock:
+            return sum(1 for cell in self._queue if cell[0] is not None)
+
+    def submit(self, message):
+        self.submit_many((message,))
+
+    def submit_many(self, messages):
+        with self._lock:
+            queue = self._queue
+            waiting = self._waiting
+            for message in messages:
+                cell = [message]
+                key = coalescing_key(message)
+                if key is not None:
+                    superseded = waiting.get(key)
+                    if superseded is not None:
+                        superseded[0] = None
+                        self.merged += 1
+                    waiting[key] = cell
+                queue.append(cell)
+            if self._flush_call is None and queue:
+                self._flush_call = self.scheduler.call_later(self.window, self.flush)
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.bytes_per_second)
+        self._last_refill = now
+
+    def flush(self, everything=False):
+        """sends as much as the budget allows (or everything waiting), and arranges to send the rest later"""
+        batch = []
+        with self._lock:
+            self._flush_call = None
+            self._refill()
+            queue = self._queue
+            waiting = self._waiting
+            needed = 0
+            while queue:
+                message = queue[0][0]
+                if message is None:
+                    queue.popleft()
+                    continue
+                size = len(message.toBytes())
+                # a message bigger than the burst goes once the budget is full, leaving it in debt
+                needed = min(size, self.burst)
+                if not everything and self._tokens < needed:
+                    break
+                cell = queue.popleft()
+                key = coalescing_key(message)
+                if key is not None and waiting.get(key) is cell:
+                    del waiting[key]
+                self._tokens -= size
+                batch.append(message)
+            if queue:
+                delay = max(self.window, (needed - self._tokens) / self.bytes_per_second)
+                self._flush_call = self.scheduler.call_later(delay, self.flush)
+        if batch:
+            self.destination._send_many(batch)
+        return len(batch)
+
+    def close(self):
+        """sends everything still waiting, regardless of the budget, and stops flushing"""
+        with self._lock:
+            if self._flush_call is not None:
+                self._flush_call.cancel()
+                self._flush_call = None
+        self.flush(everything=True)
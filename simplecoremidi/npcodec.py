@@ -0,0 +1,137 @@
+"""
+Vectorised decoding and encoding of MIDI byte streams with NumPy.
+
+Decoding a long capture a message at a time, through MIDIParser and Message objects, takes minutes. decode()
+turns a whole byte stream into a structured array, one row per message, in a handful of array operations; encode()
+turns such an array back into bytes.
+
+    events = npcodec.decode(data, packets)      # e.g. as returned by MIDISource.receive_packets
+    notes = events[events['status'] == 0x90]
+    data = npcodec.encode(notes)
+
+Each row is (timestamp, status, channel, data1, data2). For channel messages status holds the message type
+(0x80-0xE0) and channel the channel; system messages keep their whole status byte, with channel 0. Messages with
+one data byte have data2 0. Running status and realtime bytes interleaved within messages are handled as
+MIDIParser handles them. SysEx messages don't fit in a row, and are skipped.
+
+NumPy is optional: everything else in simplecoremidi works without it.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .parser import DATA_LENGTHS, SYSEX_START, REALTIME_MIN
+
+EVENT_FIELDS = ('timestamp', 'status', 'channel', 'data1', 'data2')
+
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError("numpy is required for vectorised decoding and encoding")
+
+
+def event_dtype():
+    """the structured dtype of decoded events"""
+    _require_numpy()
+    return numpy.dtype([('timestamp', 'f8'), ('status', 'u1'), ('channel', 'u1'), ('data1', 'u1'), ('data2', 'u1')])
+
+
+def _lengths():
+    # SysEx (None) has no fixed length; its bytes are skipped
+    return numpy.array([length or 0 for length in DATA_LENGTHS], dtype=numpy.int64)
+
+
+def _last_index(mask):
+    """for each position, the index of the last position at or before it where mask is set, or -1"""
+    positions = numpy.where(mask, numpy.arange(len(mask)), -1)
+    return numpy.maximum.accumulate(positions) if len(positions) else positions
+
+
+def decode(data, packets=None, timestamp=0.0):
+    """
+    decodes a byte stream (bytes, bytearray or a uint8 array) into a structured array of events.
+
+    packets is an optional sequence of (offset, timestamp) pairs, as returned by receive_packets, giving each
+    message the timestamp of the packet holding its last byte. Without it, every event gets timestamp.
+    The stream must start at a message boundary: running status from before it is unknown.
+    """
+    _require_numpy()
+    stream = numpy.frombuffer(bytes(data), dtype=numpy.uint8) if not isinstance(data, numpy.ndarray) else data
+    stream = stream.astype(numpy.int64)
+    positions = numpy.arange(len(stream))
+    lengths = _lengths()
+
+    is_realtime = stream >= REALTIME_MIN
+    is_status = (stream >= 0x80) & ~is_realtime
+    is_data = stream < 0x80
+
+    # the status byte each byte follows, skipping realtime bytes, which may appear anywhere
+    governing = _last_index(is_status)
+    governed = governing >= 0
+    status = numpy.where(governed, stream[numpy.maximum(governing, 0)], 0)
+    length = lengths[status]
+
+    # the ordinal of each data byte among the data bytes after its status: 1, 2, 3...
+    data_count = numpy.cumsum(is_data)
+    ordinal = data_count - numpy.where(governed, data_count[numpy.maximum(governing, 0)], 0)
+    index_in_message = (ordinal - 1) % numpy.maximum(length, 1)
+    message_in_run = (ordinal - 1) // numpy.maximum(length, 1)
+
+    # a data byte completes a message when it is the last of one; system common messages have no running status
+    completes = (is_data & governed & (length > 0) & (status != SYSEX_START) & (index_in_message == length - 1)
+                 & ((status < 0xF0) | (message_in_run == 0)))
+    # status bytes with no data (tune request, undefined system common) are complete in themselves
+    complete_status = is_status & (lengths[stream * is_status] == 0) & (stream != 0xF7) & (stream != SYSEX_START)
+    ends = numpy.flatnonzero(completes | complete_status | is_realtime)
+
+    end_status = numpy.where(is_data[ends], status[ends], stream[ends])
+    end_length = numpy.where(is_data[ends], length[ends], 0)
+    # the data byte before the last, for two byte messages
+    previous_data = numpy.concatenate(([-1], _last_index(is_data)[:-1])) if len(stream) else positions
+    first = numpy.where(end_length == 2, previous_data[ends], ends)
+
+    events = numpy.zeros(len(ends), dtype=event_dtype())
+    channel_message = end_status < 0xF0
+    events['status'] = numpy.where(channel_message, end_status & 0xF0, end_status)
+    events['channel'] = numpy.where(channel_message, end_status & 0x0F, 0)
+    events['data1'] = numpy.where(end_length > 0, stream[numpy.maximum(first, 0)], 0)
+    events['data2'] = numpy.where(end_length == 2, stream[ends], 0)
+    if packets:
+        offsets = numpy.array([offset for offset, stamp in packets], dtype=numpy.int64)
+        stamps = numpy.array([stamp for offset, stamp in packets], dtype=numpy.float64)
+        events['timestamp'] = stamps[numpy.maximum(numpy.searchsorted(offsets, ends, side='right') - 1, 0)]
+    else:
+        events['timestamp'] = timestamp
+    return events
+
+
+def encode(events, running_status=False):
+    """
+    encodes a structured array of events (as returned by decode) back into bytes. With running_status, the status
+    byte is left out of channel messages that repeat the previous one's.
+    """
+    _require_numpy()
+    status = events['status'].astype(numpy.int64)
+    status = numpy.where(status < 0xF0, (status & 0xF0) | (events['channel'].astype(numpy.int64) & 0x0F), status)
+    length = _lengths()[status] + 1
+
+    with_status = numpy.ones(len(status), dtype=bool)
+    if running_status and len(status):
+        channel_message = status < 0xF0
+        # system common messages cancel running status; realtime messages leave it alone
+        running = numpy.where(channel_message, status, numpy.where(status < REALTIME_MIN, 0, -1))
+        last = _last_index(running >= 0)
+        previous = numpy.concatenate(([-1], numpy.where(last >= 0, running[numpy.maximum(last, 0)], -1)[:-1]))
+        with_status = ~(channel_message & (status == previous))
+
+    size = length - (~with_status).astype(numpy.int64)
+    starts = numpy.cumsum(size) - size
+    out = numpy.zeros(int(size.sum()), dtype=numpy.uint8)
+    out[starts[with_status]] = status[with_status]
+    data_start = starts + with_status
+    has_data1 = length >= 2
+    out[data_start[has_data1]] = events['data1'][has_data1] & 0x7F
+    has_data2 = length >= 3
+    out[data_start[has_data2] + 1] = events['data2'][has_data2] & 0x7F
+    return out.tobytes()
@@ -0,0 +1,127 @@
+"""
+Incremental decoder for raw MIDI byte streams.
+
+CoreMIDI hands us whatever has been buffered since the last read, which may hold
+any number of messages, may use running status, may have realtime bytes
+interleaved mid-message, and may split a message (or a SysEx dump) across reads.
+MIDIParser keeps enough state between calls to cope with all of that.
+"""
+
+SYSEX_START = 0xF0
+SYSEX_END = 0xF7
+REALTIME_MIN = 0xF8
+
+# number of data bytes following each status nibble (channel voice messages)
+CHANNEL_DATA_LENGTHS = {
+    0x80: 2,  # note off
+    0x90: 2,  # note on
+    0xA0: 2,  # polyphonic aftertouch
+    0xB0: 2,  # control change
+    0xC0: 1,  # program change
+    0xD0: 1,  # channel aftertouch
+    0xE0: 2,  # pitch bend
+}
+
+# number of data bytes following each system common status
+SYSTEM_DATA_LENGTHS = {
+    0xF1: 1,  # MTC quarter frame
+    0xF2: 2,  # song position pointer
+    0xF3: 1,  # song select
+    0xF4: 0,  # undefined
+    0xF5: 0,  # undefined
+    0xF6: 0,  # tune request
+}
+
+
+def _data_lengths():
+    lengths = [0] * 256
+    for status in range(0x80, 0xF0):
+        lengths[status] = CHANNEL_DATA_LENGTHS[status & 0xF0]
+    for status, length in SYSTEM_DATA_LENGTHS.items():
+        lengths[status] = length
+    lengths[SYSEX_START] = None
+    return lengths
+
+# indexed by status byte
+DATA_LENGTHS = _data_lengths()
+
+
+def data_length(status):
+    """
+    the number of data bytes that follow ``status``, or None for SysEx (which is
+    terminated by 0xF7 rather than having a fixed length)
+    """
+    return DATA_LENGTHS[status]
+
+
+class MIDIParser(object):
+    """
+    Splits a MIDI byte stream into complete messages.
+
+    Feed it whatever bytes arrive; it returns a list with one list of bytes per
+    complete message, and keeps any partial message around for the next call.
+
+    >>> p = MIDIParser()
+    >>> p.feed([0x90, 60, 100, 62, 100, 0xF8, 0xB0, 7])
+    [[144, 60, 100], [144, 62, 100], [248]]
+    >>> p.feed([127])
+    [[176, 7, 127]]
+    """
+
+    def __init__(self):
+        # the number of data bytes dropped because they didn't follow a status byte
+        self.discarded = 0
+        self.reset()
+
+    def reset(self):
+        """discard any partially received message and the running status"""
+        self._status = None
+        self._expected = 0
+        self._data = []
+        self._sysex = None
+
+    def feed(self, data):
+        messages = []
+        for byte in bytearray(data):
+            if byte >= REALTIME_MIN:
+                # realtime messages may appear anywhere, even in the middle of
+                # another message, and don't affect the running status
+                messages.append([byte])
+            elif byte >= 0x80:
+                self._start(byte, messages)
+            elif self._sysex is not None:
+                self._sysex.append(byte)
+            elif self._status is not None:
+                self._data.append(byte)
+                if len(self._data) == self._expected:
+                    messages.append([self._status] + self._data)
+                    self._data = []
+                    if self._status >= 0xF0:
+                        # system common messages cancel running status
+                        self._status = None
+            else:
+                # a data byte with no status to attach it to. Drop it.
+                self.discarded += 1
+        return messages
+
+    def _start(self, status, messages):
+        if self._sysex is not None:
+            # any status byte terminates a SysEx message, not just 0xF7
+            self._sysex.append(SYSEX_END)
+            messages.append(self._sysex)
+            self._sysex = None
+            if status == SYSEX_END:
+                return
+        self._data = []
+        if status == SYSEX_START:
+            self._status = None
+            self._sysex = [status]
+        elif status == SYSEX_END:
+            # stray end of exclusive
+            self._status = None
+        else:
+            self._status = status
+            self._expected = DATA_LENGTHS[status]
+            if self._expected == 0:
+                messages.append([status])
+                self._status = None
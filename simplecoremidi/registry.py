@@ -0,0 +1,113 @@
+"""
+A cache of the available endpoints.
+
+Listing endpoints means asking the backend for every ref and every name, and each new MIDISource or
+MIDIDestination opens a connection of its own when it is first used. The registry does that once, then hands out
+the same endpoint objects (and so the same connections) until the backend reports that its setup has changed, when
+it rescans. Endpoints that survive a rescan keep their objects, and are reconnected if the backend has recreated
+them under a new ref; those that disappear are closed and dropped.
+
+Backends that can't report setup changes are rescanned on every listing, but their endpoint objects are still
+reused.
+"""
+from threading import Lock
+
+from .backends import get_backend
+from .core import MIDIDestination, MIDISource
+
+
+class EndpointRegistry(object):
+    def __init__(self, backend):
+        self.backend = backend
+        self.scans = 0
+        self._lock = Lock()
+        # never equal to a generation, so the first listing scans
+        self._generation = object()
+        self._sources = ()
+        self._destinations = ()
+        # endpoint id -> (endpoint, handle of the ref it was made with)
+        self._source_pool = {}
+        self._destination_pool = {}
+        # (kind, substring) -> matching endpoints
+        self._lookups = {}
+
+    def _refresh(self):
+        generation = self.backend.setup_generation()
+        if generation is not None and generation == self._generation:
+            return
+        with self._lock:
+            if generation is not None and generation == self._generation:
+                return
+            backend = self.backend
+            self._sources, self._source_pool = self._scan(
+                backend.source_list(), self._source_pool, MIDISource)
+            self._destinations, self._destination_pool = self._scan(
+                backend.destination_list(), self._destination_pool, MIDIDestination)
+            self._lookups = {}
+            self.scans += 1
+            # read before scanning, so a change during the scan causes another
+            self._generation = generation
+
+    def _scan(self, refs, pool, endpoint_class):
+        backend = self.backend
+        endpoints = []
+        current = {}
+        for ref in refs:
+            key = backend.endpoint_id(ref)
+            name = backend.endpoint_name(ref)
+            handle = backend.endpoint_handle(ref)
+            endpoint, old_handle = pool.get(key, (None, None))
+            if endpoint is None:
+                endpoint = endpoint_class(name, ref)
+            else:
+                endpoint.name = name
+                if handle != old_handle:
+                    endpoint._rebind(ref)
+            current[key] = (endpoint, handle)
+            endpoints.append(endpoint)
+        for key, (endpoint, handle) in pool.items():
+            if key not in current:
+                endpoint.close()
+        return tuple(endpoints), current
+
+    def invalidate(self):
+        """forces a rescan on the next listing"""
+        with self._lock:
+            self._generation = object()
+
+    def sources(self):
+        self._refresh()
+        return list(self._sources)
+
+    def destinations(self):
+        self._refresh()
+        return list(self._destinations)
+
+    def _find(self, kind, endpoints, substring):
+        key = (kind, substring)
+        found = self._lookups.get(key)
+        if found is None:
+            found = self._lookups[key] = tuple(e for e in endpoints if e.name is not None and substring in e.name)
+        return list(found)
+
+    def find_sources(self, substring):
+        """the sources whose names contain substring, in the order the backend lists them"""
+        self._refresh()
+        return self._find('source', self._sources, substring)
+
+    def find_destinations(self, substring):
+        """the destinations whose names contain substring, in the order the backend lists them"""
+        self._refresh()
+        return self._find('destination', self._destinations, substring)
+
+
+_registry = None
+
+
+def get_registry():
+    """the registry for the current backend"""
+    global _registry
+    backend = get_backend()
+    if _registry is None or _registry.backend is not backend:
+        _registry = EndpointRegistry(backend)
+    return _registry
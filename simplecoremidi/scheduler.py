@@ -0,0 +1,149 @@
+"""
+Deferred callbacks without a thread per timer.
+
+A Scheduler keeps a heap of pending calls and services all of them from one
+background thread, so arming a callback is O(log n), cancelling it is O(1), and
+neither creates a thread. Callbacks run on the scheduler thread and should be
+quick; anything slow delays every call queued behind it.
+"""
+import heapq
+import itertools
+import logging
+from threading import Condition, Lock, Thread
+
+from .clock import monotonic
+
+logger = logging.getLogger(__name__)
+
+
+class ScheduledCall(object):
+    """
+    a pending call, as returned by Scheduler.call_at. cancelled is also set once the call has been made, or
+    discarded by Scheduler.stop, so a call that is not cancelled is still waiting in the scheduler's heap.
+    """
+    __slots__ = ('when', 'callback', 'args', 'cancelled', '_scheduler')
+
+    def __init__(self, scheduler, when, callback, args):
+        self._scheduler = scheduler
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """stop the call from happening, if it hasn't already"""
+        self._scheduler._cancel(self)
+
+
+class Scheduler(object):
+    # once this many cancelled calls are sitting in the heap, it is rebuilt without them
+    COMPACT_THRESHOLD = 1024
+
+    def __init__(self, name='scheduler'):
+        self.name = name
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = Condition(Lock())
+        self._num_cancelled = 0
+        self._thread = None
+        self._running = False
+
+    def call_at(self, when, callback, *args):
+        """call callback(*args) at time when (on the clock.monotonic base). Returns a ScheduledCall"""
+        call = ScheduledCall(self, when, callback, args)
+        with self._condition:
+            heapq.heappush(self._heap, (when, next(self._sequence), call))
+            if self._heap[0][2] is call:
+                # the thread may be sleeping until a later call
+                self._condition.notify()
+            if not self._running:
+                self._start()
+        return call
+
+    def call_later(self, delay, callback, *args):
+        """call callback(*args) after delay seconds. Returns a ScheduledCall"""
+        return self.call_at(monotonic() + delay, callback, *args)
+
+    def cancel(self, call):
+        self._cancel(call)
+
+    def __len__(self):
+        return len(self._heap) - self._num_cancelled
+
+    def __bool__(self):
+        # a scheduler with nothing pending is still a scheduler: don't let `scheduler or default_scheduler()` skip it
+        return True
+
+    __nonzero__ = __bool__
+
+    def stop(self):
+        """stop the scheduler thread. Pending calls are discarded"""
+        with self._condition:
+            self._running = False
+            for entry in self._heap:
+                entry[2].cancelled = True
+            self._heap = []
+            self._num_cancelled = 0
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _cancel(self, call):
+        # the scheduler thread marks calls cancelled as it makes them, so check and set under the same lock:
+        # otherwise a call cancelled as it fires would be counted as still in the heap
+        with self._condition:
+            if call.cancelled:
+                return
+            call.cancelled = True
+            self._num_cancelled += 1
+            if self._num_cancelled > self.COMPACT_THRESHOLD and self._num_cancelled > len(self._heap) // 2:
+                self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+                heapq.heapify(self._heap)
+                self._num_cancelled = 0
+
+    def _start(self):
+        self._running = True
+        self._thread = Thread(target=self._run, name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                call = None
+                while self._running and call is None:
+                    heap = self._heap
+                    if not heap:
+                        self._condition.wait()
+                        continue
+                    when, sequence, head = heap[0]
+                    if head.cancelled:
+                        heapq.heappop(heap)
+                        self._num_cancelled -= 1
+                        continue
+                    delay = when - monotonic()
+                    if delay > 0:
+                        self._condition.wait(delay)
+                        continue
+                    heapq.heappop(heap)
+                    call = head
+                if not self._running:
+                    return
+                # a call can only run once
+                call.cancelled = True
+            try:
+                call.callback(*call.args)
+            except Exception:
+                logger.exception("scheduled call to %r failed", call.callback)
+
+
+_default_scheduler = None
+
+
+def default_scheduler():
+    """a Scheduler shared by everything that doesn't need its own"""
+    global _default_scheduler
+    if _default_scheduler is None:
+        _default_scheduler = Scheduler()
+    return _default_scheduler
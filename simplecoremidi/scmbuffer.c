@@ -0,0 +1,351 @@
+#include <stdlib.h>
+#include <string.h>
+
+#include "scmbuffer.h"
+
+#define SCM_INITIAL_CAPACITY 256
+#define SCM_INITIAL_PACKETS 32
+
+/* coalescing keys: poly aftertouch and controllers by channel and number, then channel aftertouch and pitch bend
+   by channel */
+#define SCM_KEY_POLY_AFTERTOUCH 0
+#define SCM_KEY_CONTROLLER 2048
+#define SCM_KEY_CHANNEL_AFTERTOUCH 4096
+#define SCM_KEY_PITCH_BEND 4112
+#define SCM_COALESCE_KEYS 4128
+#define SCM_NOT_SEEN UINT32_MAX
+
+void
+SCMPacketBufferInit(SCMPacketBuffer* buffer) {
+  memset(buffer, 0, sizeof(SCMPacketBuffer));
+}
+
+void
+SCMPacketBufferFree(SCMPacketBuffer* buffer) {
+  free(buffer->data);
+  free(buffer->packets);
+  free(buffer->coalesceTable);
+  SCMPacketBufferInit(buffer);
+}
+
+/* grows *ptr to hold at least needed items, doubling, but to no more than limit items (if limit isn't 0) */
+static int
+SCMGrow(void** ptr, size_t* capacity, size_t needed, size_t itemSize, size_t initial, size_t limit) {
+  size_t newCapacity = *capacity ? *capacity : initial;
+  void* newPtr;
+
+  if (needed <= *capacity)
+    return 0;
+  while (newCapacity < needed)
+    newCapacity *= 2;
+  if (limit && newCapacity > limit)
+    newCapacity = limit;
+  newPtr = realloc(*ptr, newCapacity * itemSize);
+  if (newPtr == NULL)
+    return -1;
+  *ptr = newPtr;
+  *capacity = newCapacity;
+  return 0;
+}
+
+size_t
+SCMPacketBufferSize(const SCMPacketBuffer* buffer) {
+  return buffer->length - buffer->start;
+}
+
+static size_t
+SCMPacketCount(const SCMPacketBuffer* buffer) {
+  return buffer->numPackets - buffer->firstPacket;
+}
+
+static size_t
+SCMPacketEnd(const SCMPacketBuffer* buffer, size_t i) {
+  return i + 1 < buffer->numPackets ? buffer->packets[i + 1].offset : buffer->length;
+}
+
+/* whether length more bytes, in one more packet, would fit */
+static int
+SCMFits(const SCMPacketBuffer* buffer, size_t length) {
+  return !buffer->limit
+    || (SCMPacketBufferSize(buffer) + length <= buffer->limit && SCMPacketCount(buffer) < buffer->limit);
+}
+
+static void
+SCMDropOldest(SCMPacketBuffer* buffer) {
+  size_t end = SCMPacketEnd(buffer, buffer->firstPacket);
+
+  buffer->counters.droppedPackets++;
+  buffer->counters.droppedBytes += end - buffer->start;
+  buffer->firstPacket++;
+  buffer->start = end;
+  if (buffer->firstPacket == buffer->numPackets)
+    SCMPacketBufferClear(buffer);
+}
+
+void
+SCMPacketBufferCompact(SCMPacketBuffer* buffer) {
+  size_t i;
+
+  if (buffer->firstPacket > 0) {
+    memmove(buffer->packets, buffer->packets + buffer->firstPacket,
+            SCMPacketCount(buffer) * sizeof(SCMPacketIndex));
+    buffer->numPackets -= buffer->firstPacket;
+    buffer->firstPacket = 0;
+  }
+  if (buffer->start > 0) {
+    memmove(buffer->data, buffer->data + buffer->start, SCMPacketBufferSize(buffer));
+    for (i = 0; i < buffer->numPackets; i++)
+      buffer->packets[i].offset -= buffer->start;
+    buffer->length -= buffer->start;
+    buffer->start = 0;
+  }
+}
+
+/* ----------------------------------------------------------------- coalescing */
+
+/* the number of data bytes following a status byte */
+static size_t
+SCMDataLength(unsigned char status) {
+  switch (status & 0xF0) {
+  case 0xC0:
+  case 0xD0:
+    return 1;
+  case 0xF0:
+    if (status == 0xF1 || status == 0xF3)
+      return 1;
+    return status == 0xF2 ? 2 : 0;
+  default:
+    return 2;
+  }
+}
+
+typedef struct {
+  size_t offset;
+  size_t length;
+  unsigned char status;
+  int running;        /* the message uses running status: it has no status byte of its own */
+  int key;            /* the coalescing key, or -1 if the message can't be coalesced */
+} SCMMessageSpan;
+
+/* finds the message starting at data[pos], within a packet ending at end */
+static void
+SCMNextMessage(const unsigned char* data, size_t pos, size_t end, unsigned char* runningStatus,
+               SCMMessageSpan* message) {
+  unsigned char byte = data[pos];
+  size_t length;
+
+  message->offset = pos;
+  message->running = 0;
+  message->key = -1;
+  if (byte >= 0xF8) {
+    /* realtime, which doesn't affect running status */
+    message->status = byte;
+    message->length = 1;
+    return;
+  }
+  if (byte == 0xF0) {
+    length = 1;
+    while (pos + length < end && data[pos + length] != 0xF7)
+      length++;
+    message->status = byte;
+    message->length = pos + length < end ? length + 1 : length;
+    *runningStatus = 0;
+    return;
+  }
+  if (byte >= 0x80) {
+    message->status = byte;
+    length = 1 + SCMDataLength(byte);
+    *runningStatus = byte < 0xF0 ? byte : 0;
+  } else if (*runningStatus) {
+    message->status = *runningStatus;
+    message->running = 1;
+    length = SCMDataLength(*runningStatus);
+  } else {
+    /* a stray data byte */
+    message->status = 0;
+    message->length = 1;
+    return;
+  }
+  message->length = pos + length < end ? length : end - pos;
+
+  if (message->length == length) {
+    const unsigned char* bytes = data + pos + (message->running ? 0 : 1);
+    unsigned channel = message->status & 0x0F;
+    switch (message->status & 0xF0) {
+    case 0xA0:
+      message->key = SCM_KEY_POLY_AFTERTOUCH + (channel << 7) + (bytes[0] & 0x7F);
+      break;
+    case 0xB0:
+      message->key = SCM_KEY_CONTROLLER + (channel << 7) + (bytes[0] & 0x7F);
+      break;
+    case 0xD0:
+      message->key = SCM_KEY_CHANNEL_AFTERTOUCH + channel;
+      break;
+    case 0xE0:
+      message->key = SCM_KEY_PITCH_BEND + channel;
+      break;
+    }
+  }
+}
+
+/* records the sequence number of the last message with each key in data[start:end] */
+static uint32_t
+SCMMarkLatest(uint32_t* table, uint32_t sequence, const unsigned char* data, size_t start, size_t end) {
+  SCMMessageSpan message;
+  unsigned char runningStatus = 0;
+  size_t pos;
+
+  for (pos = start; pos < end; pos += message.length, sequence++) {
+    SCMNextMessage(data, pos, end, &runningStatus, &message);
+    if (message.key >= 0)
+      table[message.key] = sequence;
+  }
+  return sequence;
+}
+
+/*
+ * discards every controller, pitch bend and aftertouch message that is superseded by a later one, either in the
+ * buffer or in the incoming data. Packets left empty are removed.
+ *
+ * This works in place. A message that relied on running status gets a status byte of its own if the message
+ * that supplied the status is discarded, but that message was at least as long, so the output never overtakes
+ * the input.
+ */
+static void
+SCMCoalesce(SCMPacketBuffer* buffer, const unsigned char* incoming, size_t incomingLength) {
+  uint32_t* table = buffer->coalesceTable;
+  uint32_t sequence = 0;
+  size_t i, pos, out, packetStart, outPacket;
+  unsigned char runningStatus, lastStatus;
+  SCMMessageSpan message;
+
+  if (table == NULL) {
+    table = buffer->coalesceTable = malloc(SCM_COALESCE_KEYS * sizeof(uint32_t));
+    if (table == NULL)
+      return;
+  }
+  for (i = 0; i < SCM_COALESCE_KEYS; i++)
+    table[i] = SCM_NOT_SEEN;
+
+  for (i = buffer->firstPacket; i < buffer->numPackets; i++)
+    sequence = SCMMarkLatest(table, sequence, buffer->data, buffer->packets[i].offset, SCMPacketEnd(buffer, i));
+  SCMMarkLatest(table, sequence, incoming, 0, incomingLength);
+
+  sequence = 0;
+  out = buffer->start;
+  outPacket = buffer->firstPacket;
+  for (i = buffer->firstPacket; i < buffer->numPackets; i++) {
+    size_t end = SCMPacketEnd(buffer, i);
+    packetStart = out;
+    runningStatus = lastStatus = 0;
+    for (pos = buffer->packets[i].offset; pos < end; pos += message.length, sequence++) {
+      SCMNextMessage(buffer->data, pos, end, &runningStatus, &message);
+      if (message.key >= 0 && table[message.key] != sequence) {
+        buffer->counters.coalesced++;
+        continue;
+      }
+      if (message.running && lastStatus != message.status)
+        buffer->data[out++] = message.status;
+      memmove(buffer->data + out, buffer->data + message.offset, message.length);
+      out += message.length;
+      if (message.status >= 0x80 && message.status < 0xF0)
+        lastStatus = message.status;
+      else if (message.status >= 0xF0 && message.status < 0xF8)
+        lastStatus = 0;
+    }
+    if (out > packetStart) {
+      buffer->packets[outPacket].offset = packetStart;
+      buffer->packets[outPacket].timestamp = buffer->packets[i].timestamp;
+      outPacket++;
+    }
+  }
+  buffer->length = out;
+  buffer->numPackets = outPacket;
+  if (buffer->firstPacket == buffer->numPackets)
+    SCMPacketBufferClear(buffer);
+}
+
+/* ----------------------------------------------------------------- */
+
+int
+SCMPacketBufferSetLimit(SCMPacketBuffer* buffer, size_t limit, SCMOverflowPolicy policy) {
+  if (policy < SCM_OVERFLOW_GROW || policy >= SCM_OVERFLOW_POLICIES)
+    return -1;
+  buffer->limit = limit;
+  buffer->policy = limit ? policy : SCM_OVERFLOW_GROW;
+  if (!limit)
+    return 0;
+
+  while (SCMPacketBufferSize(buffer) > limit || SCMPacketCount(buffer) > limit)
+    SCMDropOldest(buffer);
+  SCMPacketBufferCompact(buffer);
+  /* give back memory beyond the limit */
+  if (buffer->capacity > limit) {
+    unsigned char* data = realloc(buffer->data, limit);
+    if (data != NULL) {
+      buffer->data = data;
+      buffer->capacity = limit;
+    }
+  }
+  if (buffer->packetCapacity > limit) {
+    SCMPacketIndex* packets = realloc(buffer->packets, limit * sizeof(SCMPacketIndex));
+    if (packets != NULL) {
+      buffer->packets = packets;
+      buffer->packetCapacity = limit;
+    }
+  }
+  return 0;
+}
+
+int
+SCMPacketBufferAppend(SCMPacketBuffer* buffer,
+                      const unsigned char* data,
+                      size_t length,
+                      uint64_t timestamp) {
+  SCMPacketIndex* packet;
+
+  if (length == 0)
+    return 0;
+
+  if (!SCMFits(buffer, length)) {
+    if (buffer->policy == SCM_OVERFLOW_BLOCK && length <= buffer->limit)
+      return SCM_BUFFER_FULL;
+    buffer->counters.overflows++;
+    if (length > buffer->limit || buffer->policy == SCM_OVERFLOW_DROP_NEWEST) {
+      /* packets too big to ever fit are dropped whatever the policy */
+      buffer->counters.droppedPackets++;
+      buffer->counters.droppedBytes += length;
+      return 0;
+    }
+    if (buffer->policy == SCM_OVERFLOW_COALESCE)
+      SCMCoalesce(buffer, data, length);
+    while (!SCMFits(buffer, length))
+      SCMDropOldest(buffer);
+  }
+
+  /* reuse the space freed by dropped packets before growing */
+  if ((buffer->length + length > buffer->capacity && buffer->start > 0)
+      || (buffer->numPackets + 1 > buffer->packetCapacity && buffer->firstPacket > 0))
+    SCMPacketBufferCompact(buffer);
+  if (SCMGrow((void**) &buffer->data, &buffer->capacity,
+              buffer->length + length, 1, SCM_INITIAL_CAPACITY, buffer->limit))
+    return -1;
+  if (SCMGrow((void**) &buffer->packets, &buffer->packetCapacity,
+              buffer->numPackets + 1, sizeof(SCMPacketIndex), SCM_INITIAL_PACKETS, buffer->limit))
+    return -1;
+
+  packet = &buffer->packets[buffer->numPackets++];
+  packet->offset = buffer->length;
+  packet->timestamp = timestamp;
+  memcpy(buffer->data + buffer->length, data, length);
+  buffer->length += length;
+  return 0;
+}
+
+void
+SCMPacketBufferClear(SCMPacketBuffer* buffer) {
+  buffer->start = 0;
+  buffer->length = 0;
+  buffer->firstPacket = 0;
+  buffer->numPackets = 0;
+}
@@ -0,0 +1,92 @@
+/*
+ * Portable receive buffer for simplecoremidi.
+ *
+ * Holds the bytes received by a source, in one contiguous block, together with
+ * an index giving the offset and arrival time of each packet. Nothing in here
+ * depends on CoreMIDI or Python, so it can be built and exercised on any
+ * platform.
+ *
+ * By default the buffer grows as needed. Given a limit, it never holds more
+ * than that many bytes (or packets), and what happens to a packet that doesn't
+ * fit depends on the overflow policy. Packets dropped from the front are
+ * skipped over rather than moved, so dropping is O(1); the survivors are moved
+ * to the front in one go when the buffer is next read or runs out of room.
+ */
+#ifndef SCMBUFFER_H
+#define SCMBUFFER_H
+
+#include <stddef.h>
+#include <stdint.h>
+
+typedef struct {
+  uint64_t offset;      /* of the packet's first byte within the buffer */
+  uint64_t timestamp;   /* host time in nanoseconds */
+} SCMPacketIndex;
+
+typedef enum {
+  SCM_OVERFLOW_GROW = 0,      /* no limit */
+  SCM_OVERFLOW_BLOCK,         /* the caller should wait for the buffer to be read, then retry */
+  SCM_OVERFLOW_DROP_OLDEST,   /* discard the oldest packets to make room */
+  SCM_OVERFLOW_DROP_NEWEST,   /* discard the packet that doesn't fit */
+  SCM_OVERFLOW_COALESCE,      /* keep only the latest value of each controller, pitch bend and aftertouch,
+                                 then drop the oldest packets if that isn't enough */
+  SCM_OVERFLOW_POLICIES
+} SCMOverflowPolicy;
+
+/* returned by SCMPacketBufferAppend when the policy is SCM_OVERFLOW_BLOCK and the packet doesn't fit */
+#define SCM_BUFFER_FULL 1
+
+typedef struct {
+  uint64_t overflows;         /* packets that didn't fit when they arrived */
+  uint64_t droppedPackets;
+  uint64_t droppedBytes;
+  uint64_t coalesced;         /* messages discarded because a later one superseded them */
+} SCMOverflowCounters;
+
+typedef struct {
+  unsigned char* data;
+  size_t start;         /* offset of the first byte still held; bytes before it have been dropped */
+  size_t length;        /* offset just past the last byte held */
+  size_t capacity;
+  SCMPacketIndex* packets;
+  size_t firstPacket;   /* index of the first packet still held */
+  size_t numPackets;    /* index just past the last packet held */
+  size_t packetCapacity;
+
+  size_t limit;         /* the most bytes, and packets, held at once; 0 for no limit */
+  SCMOverflowPolicy policy;
+  SCMOverflowCounters counters;
+  uint32_t* coalesceTable;
+} SCMPacketBuffer;
+
+void SCMPacketBufferInit(SCMPacketBuffer* buffer);
+void SCMPacketBufferFree(SCMPacketBuffer* buffer);
+
+/*
+ * bounds the buffer to limit bytes (0 for no limit). Packets already held beyond the new limit are dropped,
+ * oldest first. Returns 0 on success, -1 for an unknown policy.
+ */
+int SCMPacketBufferSetLimit(SCMPacketBuffer* buffer, size_t limit, SCMOverflowPolicy policy);
+
+/*
+ * returns 0 on success (including when the overflow policy dropped something), -1 if memory could not be
+ * allocated, or SCM_BUFFER_FULL
+ */
+int SCMPacketBufferAppend(SCMPacketBuffer* buffer,
+                          const unsigned char* data,
+                          size_t length,
+                          uint64_t timestamp);
+
+/* the number of bytes held */
+size_t SCMPacketBufferSize(const SCMPacketBuffer* buffer);
+
+/*
+ * moves the packets held to the front of the buffer, so that data[0:length] and packets[0:numPackets] hold
+ * exactly them, with offsets relative to data. Call before reading the buffer directly.
+ */
+void SCMPacketBufferCompact(SCMPacketBuffer* buffer);
+
+/* empties the buffer, keeping its memory for reuse */
+void SCMPacketBufferClear(SCMPacketBuffer* buffer);
+
+#endif
@@ -0,0 +1,195 @@
+#include <errno.h>
+#include <stdint.h>
+#include <time.h>
+
+#ifdef __APPLE__
+#include <mach/mach_time.h>
+#endif
+
+#include "scmqueue.h"
+
+#define SCM_NANOS_PER_SECOND 1000000000ULL
+/* longer timeouts than this (about 30 years) are treated as forever */
+#define SCM_MAX_TIMEOUT_SECONDS 1e9
+
+int
+SCMCondInit(pthread_cond_t* condition) {
+  pthread_condattr_t attributes;
+  int result = pthread_condattr_init(&attributes);
+
+  if (result != 0)
+    return result;
+#ifndef __APPLE__
+  /* Apple has no pthread_condattr_setclock; waits there are relative instead (see SCMCondWaitUntil) */
+  pthread_condattr_setclock(&attributes, CLOCK_MONOTONIC);
+#endif
+  result = pthread_cond_init(condition, &attributes);
+  pthread_condattr_destroy(&attributes);
+  return result;
+}
+
+int
+SCMPacketQueueInit(SCMPacketQueue* queue) {
+  int result;
+
+  SCMPacketBufferInit(&queue->buffer);
+  SCMPacketBufferInit(&queue->spare);
+  result = pthread_mutex_init(&queue->mutex, NULL);
+  if (result == 0)
+    result = SCMCondInit(&queue->dataReady);
+  if (result == 0)
+    result = SCMCondInit(&queue->spaceReady);
+  return result;
+}
+
+void
+SCMPacketQueueDestroy(SCMPacketQueue* queue) {
+  pthread_cond_destroy(&queue->spaceReady);
+  pthread_cond_destroy(&queue->dataReady);
+  pthread_mutex_destroy(&queue->mutex);
+  SCMPacketBufferFree(&queue->buffer);
+  SCMPacketBufferFree(&queue->spare);
+}
+
+uint64_t
+SCMMonotonicNanos(void) {
+#ifdef __APPLE__
+  static mach_timebase_info_data_t timebase;
+  if (timebase.denom == 0)
+    mach_timebase_info(&timebase);
+  return mach_absolute_time() * timebase.numer / timebase.denom;
+#else
+  struct timespec now;
+  clock_gettime(CLOCK_MONOTONIC, &now);
+  return (uint64_t) now.tv_sec * SCM_NANOS_PER_SECOND + now.tv_nsec;
+#endif
+}
+
+uint64_t
+SCMDeadline(double timeout) {
+  if (timeout < 0 || timeout > SCM_MAX_TIMEOUT_SECONDS)
+    return 0;
+  return SCMMonotonicNanos() + (uint64_t) (timeout * SCM_NANOS_PER_SECOND) + 1;
+}
+
+int
+SCMCondWaitUntil(pthread_cond_t* condition, pthread_mutex_t* mutex, uint64_t deadline) {
+  struct timespec when;
+  uint64_t now;
+
+  if (deadline == 0)
+    return pthread_cond_wait(condition, mutex);
+  now = SCMMonotonicNanos();
+  if (now >= deadline)
+    return ETIMEDOUT;
+#ifdef __APPLE__
+  when.tv_sec = (deadline - now) / SCM_NANOS_PER_SECOND;
+  when.tv_nsec = (deadline - now) % SCM_NANOS_PER_SECOND;
+  return pthread_cond_timedwait_relative_np(condition, mutex, &when);
+#else
+  when.tv_sec = deadline / SCM_NANOS_PER_SECOND;
+  when.tv_nsec = deadline % SCM_NANOS_PER_SECOND;
+  return pthread_cond_timedwait(condition, mutex, &when);
+#endif
+}
+
+/* exchanges the memory of two buffers, leaving their contents, limits and counters behind */
+static void
+SCMSwapStorage(SCMPacketBuffer* a, SCMPacketBuffer* b) {
+  unsigned char* data = a->data;
+  SCMPacketIndex* packets = a->packets;
+  size_t capacity = a->capacity;
+  size_t packetCapacity = a->packetCapacity;
+
+  a->data = b->data;
+  a->capacity = b->capacity;
+  a->packets = b->packets;
+  a->packetCapacity = b->packetCapacity;
+  b->data = data;
+  b->capacity = capacity;
+  b->packets = packets;
+  b->packetCapacity = packetCapacity;
+}
+
+/* moves the buffer's memory, and the packets in it, into out, and out's memory into the buffer */
+static void
+SCMSwapContents(SCMPacketBuffer* buffer, SCMPacketBuffer* out) {
+  SCMPacketBufferCompact(buffer);
+  SCMSwapStorage(buffer, out);
+  out->length = buffer->length;
+  out->start = 0;
+  out->numPackets = buffer->numPackets;
+  out->firstPacket = 0;
+  SCMPacketBufferClear(buffer);
+}
+
+size_t
+SCMPacketQueueTake(SCMPacketQueue* queue,
+                   double timeout,
+                   SCMPacketBuffer* out,
+                   void (*emptied)(void*),
+                   void* context) {
+  uint64_t deadline = SCMDeadline(timeout);
+  size_t numBytes;
+
+  pthread_mutex_lock(&queue->mutex);
+  while ((numBytes = SCMPacketBufferSize(&queue->buffer)) == 0) {
+    if (SCMCondWaitUntil(&queue->dataReady, &queue->mutex, deadline) == ETIMEDOUT) {
+      numBytes = SCMPacketBufferSize(&queue->buffer);
+      break;
+    }
+  }
+  SCMPacketBufferClear(out);
+  if (numBytes > 0) {
+    if (out->data == NULL)
+      SCMSwapStorage(out, &queue->spare);
+    SCMSwapContents(&queue->buffer, out);
+    if (emptied)
+      emptied(context);
+    pthread_cond_broadcast(&queue->spaceReady);
+  }
+  pthread_mutex_unlock(&queue->mutex);
+  return numBytes;
+}
+
+void
+SCMPacketQueueRecycle(SCMPacketQueue* queue, SCMPacketBuffer* taken) {
+  pthread_mutex_lock(&queue->mutex);
+  /* storage from before a limit was set may be bigger than the limit allows */
+  if (taken->capacity > queue->spare.capacity
+      && (!queue->buffer.limit || taken->capacity <= queue->buffer.limit))
+    SCMSwapStorage(taken, &queue->spare);
+  pthread_mutex_unlock(&queue->mutex);
+  SCMPacketBufferFree(taken);
+}
+
+int
+SCMPacketQueuePut(SCMPacketQueue* queue,
+                  const unsigned char* data,
+                  size_t length,
+                  uint64_t timestamp,
+                  double blockTimeout,
+                  void (*notify)(void*),
+                  void* context) {
+  SCMPacketBuffer* buffer = &queue->buffer;
+  uint64_t deadline;
+  int result = SCMPacketBufferAppend(buffer, data, length, timestamp);
+
+  if (result != SCM_BUFFER_FULL)
+    return result;
+
+  buffer->counters.overflows++;
+  deadline = SCMDeadline(blockTimeout);
+  do {
+    /* let anything waiting read what's already there */
+    pthread_cond_signal(&queue->dataReady);
+    if (notify)
+      notify(context);
+    if (SCMCondWaitUntil(&queue->spaceReady, &queue->mutex, deadline) == ETIMEDOUT) {
+      buffer->counters.droppedPackets++;
+      buffer->counters.droppedBytes += length;
+      return SCM_BUFFER_FULL;
+    }
+  } while ((result = SCMPacketBufferAppend(buffer, data, length, timestamp)) == SCM_BUFFER_FULL);
+  return result;
+}
@@ -0,0 +1,86 @@
+/*
+ * Thread safe packet queue for simplecoremidi.
+ *
+ * Wraps an SCMPacketBuffer with the mutex and conditions needed to hand
+ * packets from the thread that receives them (CoreMIDI's read proc) to the
+ * threads that read them. Waits are timed against a monotonic clock, so they
+ * are unaffected by changes to the wall clock, and take timeouts in seconds
+ * with sub-second resolution.
+ *
+ * Readers take everything queued in one go, and never hold the queue's mutex
+ * once they return, so a reader can release the Python GIL for the whole of
+ * its wait and only take the GIL back once the mutex is free: nothing ever
+ * holds the mutex while waiting for the GIL.
+ *
+ * Like scmbuffer, this needs only POSIX threads, so it builds on any platform.
+ */
+#ifndef SCMQUEUE_H
+#define SCMQUEUE_H
+
+#include <pthread.h>
+
+#include "scmbuffer.h"
+
+typedef struct {
+  pthread_mutex_t mutex;
+  pthread_cond_t dataReady;     /* signalled when packets are added */
+  pthread_cond_t spaceReady;    /* broadcast when packets are taken, for writers blocked by SCM_OVERFLOW_BLOCK */
+  SCMPacketBuffer buffer;       /* guarded by mutex */
+  SCMPacketBuffer spare;        /* storage given back by SCMPacketQueueRecycle for the next take to hand buffer;
+                                   guarded by mutex */
+} SCMPacketQueue;
+
+/* returns 0 on success, or an error number */
+int SCMPacketQueueInit(SCMPacketQueue* queue);
+void SCMPacketQueueDestroy(SCMPacketQueue* queue);
+
+/*
+ * the current time of the clock waits are timed against, in nanoseconds
+ */
+uint64_t SCMMonotonicNanos(void);
+
+/* the monotonic time timeout seconds from now, or 0 for no deadline (a negative or enormous timeout) */
+uint64_t SCMDeadline(double timeout);
+
+/* initialises a condition for use with SCMCondWaitUntil. Returns 0 on success, or an error number. */
+int SCMCondInit(pthread_cond_t* condition);
+
+/* waits on condition until signalled or deadline (0 for none) passes. Returns 0 or ETIMEDOUT. */
+int SCMCondWaitUntil(pthread_cond_t* condition, pthread_mutex_t* mutex, uint64_t deadline);
+
+/*
+ * waits up to timeout seconds (forever if timeout is negative) for packets, then moves everything queued into
+ * out, replacing what out held, and calls emptied(context) (if given) with the mutex still held. Returns the
+ * number of bytes taken: 0 if the wait timed out. Must be called without the mutex held, and returns without it.
+ *
+ * The queue keeps out's storage, or if out has none, the storage last given back with SCMPacketQueueRecycle, so
+ * a reader that recycles what it takes never makes the queue allocate again.
+ */
+size_t SCMPacketQueueTake(SCMPacketQueue* queue,
+                          double timeout,
+                          SCMPacketBuffer* out,
+                          void (*emptied)(void*),
+                          void* context);
+
+/*
+ * gives the storage of a buffer filled by SCMPacketQueueTake back to the queue, once its contents have been read,
+ * and leaves taken empty. The queue keeps the larger of it and the storage it already has spare (unless it is
+ * larger than the buffer's limit), and the other is freed. Must be called without the mutex held.
+ */
+void SCMPacketQueueRecycle(SCMPacketQueue* queue, SCMPacketBuffer* taken);
+
+/*
+ * queues a packet. The mutex must be held. If the overflow policy is SCM_OVERFLOW_BLOCK and the packet doesn't
+ * fit, waits up to blockTimeout seconds for a reader to make room, calling notify(context) first so that readers
+ * waiting some other way (on a pipe, say) know to read. Returns 0 if the packet was queued or the policy dropped
+ * something, -1 if memory could not be allocated, or SCM_BUFFER_FULL if the packet was dropped after blocking.
+ */
+int SCMPacketQueuePut(SCMPacketQueue* queue,
+                      const unsigned char* data,
+                      size_t length,
+                      uint64_t timestamp,
+                      double blockTimeout,
+                      void (*notify)(void*),
+                      void* context);
+
+#endif
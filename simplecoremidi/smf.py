@@ -0,0 +1,372 @@
+"""
+Recording to, and replaying from, Standard MIDI Files.
+
+    from simplecoremidi import smf
+    smf.record(source, 'session.mid', duration=3600)
+    smf.replay('session.mid', destination, speed=4)
+    smf.replay('session.mid', mapper.handle)
+
+SMFReader streams events straight out of a memory mapped file, decoding a window of a track at a time, so replaying
+an hour long capture uses no more memory than replaying a few seconds of one. Tracks of a format 1 file are merged
+lazily by time.
+
+Captures are written as format 0 files. Realtime messages (clock, start, stop...) have no place in an SMF track, so
+they are stored as escape events (0xF7), which this reader, unlike most sequencers, replays.
+"""
+import heapq
+import mmap
+import struct
+import time
+
+from .clock import monotonic
+from .core import Message
+from .parser import DATA_LENGTHS, MIDIParser, SYSEX_END, SYSEX_START
+
+META = 0xFF
+META_TEMPO = 0x51
+META_END_OF_TRACK = 0x2F
+
+DEFAULT_TEMPO = 500000  # microseconds per beat, i.e. 120 bpm
+DEFAULT_TICKS_PER_BEAT = 960
+
+_header = struct.Struct('>4sIHHH')
+_chunk = struct.Struct('>4sI')
+
+# bytes of a track decoded at a time
+WINDOW = 65536
+# enough for a delta time, a status byte and two data bytes, or the start of a meta or SysEx event
+_MARGIN = 16
+
+
+class SMFError(ValueError):
+    pass
+
+
+def _write_vlq(out, value):
+    buffer = [value & 0x7F]
+    value >>= 7
+    while value:
+        buffer.append(0x80 | (value & 0x7F))
+        value >>= 7
+    buffer.reverse()
+    out.extend(buffer)
+
+
+def _read_vlq(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            return value, pos
+
+
+class SMFWriter(object):
+    """
+    Writes a format 0 Standard MIDI File, one event at a time.
+
+    Timestamps are in seconds on any base (such as clock.monotonic, as used for packet arrival times); the first
+    event written is at time 0 unless start is given. The file must be seekable, as the track length is only known
+    when the writer is closed.
+    """
+    FLUSH_SIZE = 65536
+
+    def __init__(self, file, ticks_per_beat=DEFAULT_TICKS_PER_BEAT, tempo=DEFAULT_TEMPO, start=None):
+        if isinstance(file, (str, bytes)):
+            file = open(file, 'wb')
+        self._file = file
+        self.ticks_per_beat = ticks_per_beat
+        self.ticks_per_second = ticks_per_beat * 1e6 / tempo
+        self.start = start
+        self.events = 0
+        self._tick = 0
+        self._status = None
+        self._buffer = bytearray()
+        self._track_length = 0
+
+        file.write(_header.pack(b'MThd', 6, 0, 1, ticks_per_beat))
+        self._length_offset = file.tell() + 4
+        file.write(_chunk.pack(b'MTrk', 0))
+        self._meta(0, META_TEMPO, struct.pack('>I', tempo)[1:])
+
+    def _delta(self, timestamp):
+        if self.start is None:
+            self.start = timestamp
+        tick = int(round((timestamp - self.start) * self.ticks_per_second))
+        if tick < self._tick:
+            # out of order timestamps (from different sources, say) can't be represented
+            tick = self._tick
+        delta = tick - self._tick
+        self._tick = tick
+        return delta
+
+    def _meta(self, delta, kind, data):
+        out = self._buffer
+        _write_vlq(out, delta)
+        out.append(META)
+        out.append(kind)
+        _write_vlq(out, len(data))
+        out.extend(data)
+        self._status = None
+
+    def write(self, message, timestamp):
+        """adds a message (a Message, or a complete message as a sequence of bytes) at time timestamp"""
+        if isinstance(message, Message):
+            message = message.toBytes()
+        data = bytearray(message)
+        out = self._buffer
+        _write_vlq(out, self._delta(timestamp))
+        status = data[0]
+        if status == SYSEX_START:
+            out.append(SYSEX_START)
+            _write_vlq(out, len(data) - 1)
+            out.extend(data[1:])
+            self._status = None
+        elif status >= 0xF0:
+            # system common and realtime messages, as escapes
+            out.append(SYSEX_END)
+            _write_vlq(out, len(data))
+            out.extend(data)
+            self._status = None
+        else:
+            if status != self._status:
+                out.append(status)
+                self._status = status
+            out.extend(data[1:])
+        self.events += 1
+        if len(out) >= self.FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        self._track_length += len(self._buffer)
+        self._file.write(bytes(self._buffer))
+        del self._buffer[:]
+
+    def close(self):
+        """ends the track, fills in its length and closes the file"""
+        if self._file is None:
+            return
+        self._meta(0, META_END_OF_TRACK, b'')
+        self.flush()
+        self._file.seek(self._length_offset)
+        self._file.write(struct.pack('>I', self._track_length))
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def record(source, file, duration=None, stop=None, **kwargs):
+    """
+    records everything received from a MIDISource to a Standard MIDI File, stamping each message with the arrival
+    time of its packet. Runs until duration seconds have passed, stop (a threading.Event) is set, or it is
+    interrupted. Returns the number of messages recorded.
+
+    The source is read with receive_packets, so don't receive from it elsewhere while recording.
+    """
+    parser = MIDIParser()
+    deadline = None if duration is None else monotonic() + duration
+    with SMFWriter(file, **kwargs) as writer:
+        try:
+            while not (stop is not None and stop.is_set()):
+                timeout = 1
+                if deadline is not None:
+                    timeout = min(timeout, deadline - monotonic())
+                    if timeout <= 0:
+                        break
+                received = source.receive_packets(timeout)
+                if not received:
+                    continue
+                data, packets = received
+                for i, (offset, timestamp) in enumerate(packets):
+                    end = packets[i + 1][0] if i + 1 < len(packets) else len(data)
+                    for message in parser.feed(data[offset:end]):
+                        writer.write(message, timestamp)
+        except KeyboardInterrupt:
+            pass
+        return writer.events
+
+
+class SMFReader(object):
+    """
+    Reads a Standard MIDI File from a memory map.
+
+    events() yields (seconds, data) pairs, where data is the bytes of one message, and messages() yields
+    (seconds, Message) pairs. Both are generators that decode the file as they go; iterate again to start over.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < _header.size:
+            raise SMFError("%s is too short to be a MIDI file" % path)
+        magic, length, self.format, count, division = _header.unpack_from(self._map, 0)
+        if magic != b'MThd':
+            raise SMFError("%s is not a MIDI file" % path)
+        if division & 0x8000:
+            # SMPTE: frames per second (stored negated) and ticks per frame
+            frames = 256 - (division >> 8)
+            self.ticks_per_beat = None
+            self._seconds_per_tick = 1.0 / (frames * (division & 0xFF))
+        else:
+            self.ticks_per_beat = division
+            self._seconds_per_tick = None
+
+        self.tracks = []
+        pos = 8 + length
+        while pos + _chunk.size <= len(self._map) and len(self.tracks) < count:
+            kind, length = _chunk.unpack_from(self._map, pos)
+            pos += _chunk.size
+            if kind == b'MTrk':
+                self.tracks.append((pos, min(pos + length, len(self._map))))
+            pos += length
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _track(self, index):
+        """yields (tick, index, sequence, tempo, data) for each event of a track; tempo is set for tempo changes"""
+        mm = self._map
+        start, end = self.tracks[index]
+        window_start = start
+        window = bytearray(mm[start:min(end, start + WINDOW)])
+        pos = 0
+        tick = 0
+        status = None
+        sequence = 0
+        while window_start + pos < end:
+            if pos > len(window) - _MARGIN and window_start + len(window) < end:
+                window_start += pos
+                window = bytearray(mm[window_start:min(end, window_start + WINDOW)])
+                pos = 0
+            delta, pos = _read_vlq(window, pos)
+            tick += delta
+            byte = window[pos]
+            if byte == META:
+                kind = window[pos + 1]
+                length, pos = _read_vlq(window, pos + 2)
+                if kind == META_END_OF_TRACK:
+                    return
+                if kind == META_TEMPO and length == 3:
+                    tempo = struct.unpack('>I', b'\0' + bytes(window[pos:pos + 3]))[0]
+                    yield tick, index, sequence, tempo, None
+                pos += length
+            elif byte == SYSEX_START or byte == SYSEX_END:
+                length, pos = _read_vlq(window, pos + 1)
+                payload = mm[window_start + pos:window_start + pos + length]
+                yield tick, index, sequence, None, (b'\xf0' + payload) if byte == SYSEX_START else payload
+                pos += length
+                status = None
+            else:
+                if byte & 0x80:
+                    status = byte
+                    pos += 1
+                elif status is None:
+                    raise SMFError("data byte without a status in track %d at offset %d" % (
+                        index, window_start + pos))
+                length = DATA_LENGTHS[status]
+                data = bytearray((status,))
+                data.extend(window[pos:pos + length])
+                pos += length
+                yield tick, index, sequence, None, bytes(data)
+            sequence += 1
+
+    def _timed(self, events, seconds=0.0):
+        """converts ticks to seconds, following tempo changes, and drops the tempo events themselves"""
+        seconds_per_tick = self._seconds_per_tick
+        tempo_based = seconds_per_tick is None
+        if tempo_based:
+            seconds_per_tick = DEFAULT_TEMPO * 1e-6 / self.ticks_per_beat
+        last_tick = 0
+        for tick, index, sequence, tempo, data in events:
+            seconds += (tick - last_tick) * seconds_per_tick
+            last_tick = tick
+            if tempo is not None:
+                if tempo_based:
+                    seconds_per_tick = tempo * 1e-6 / self.ticks_per_beat
+            else:
+                yield seconds, data
+
+    def events(self):
+        if self.format == 2:
+            # independent sequences, one after another
+            seconds = 0.0
+            for index in range(len(self.tracks)):
+                for seconds, data in self._timed(self._track(index), seconds):
+                    yield seconds, data
+        else:
+            tracks = [self._track(index) for index in range(len(self.tracks))]
+            for event in self._timed(heapq.merge(*tracks)):
+                yield event
+
+    def messages(self):
+        parse = Message.parse_message
+        for seconds, data in self.events():
+            data = bytearray(data)
+            if not data:
+                continue
+            if data[0] < 0x80 or (data[0] != SYSEX_START and DATA_LENGTHS[data[0]] + 1 < len(data)):
+                # an escape holding several messages, or a fragment of one
+                for message in MIDIParser().feed(data):
+                    yield seconds, parse(message)
+            else:
+                yield seconds, parse(data)
+
+    def __iter__(self):
+        return self.messages()
+
+
+def replay(file, target, speed=1.0):
+    """
+    plays a Standard MIDI File (a path or an SMFReader) into target: either a MIDIDestination or a function taking
+    a Message, such as MIDIMapper.handle.
+
+    Events are played at their recorded times divided by speed, so speed=2 plays twice as fast; a speed of 0 (or
+    None) plays everything as fast as possible. Events that fall due together, or while replay is catching up,
+    are sent to a destination as one batch. Returns the number of messages played.
+    """
+    reader = file if isinstance(file, SMFReader) else SMFReader(file)
+    if hasattr(target, 'send_many'):
+        play = target.send_many
+    else:
+        def play(messages):
+            for message in messages:
+                target(message)
+
+    count = 0
+    batch = []
+    start = monotonic()
+    try:
+        for seconds, message in reader.messages():
+            if speed:
+                delay = start + seconds / speed - monotonic()
+                if delay > 0:
+                    if batch:
+                        play(batch)
+                        count += len(batch)
+                        batch = []
+                        delay = start + seconds / speed - monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+            batch.append(message)
+            if len(batch) >= 1024:
+                play(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            play(batch)
+            count += len(batch)
+    finally:
+        if reader is not file:
+            reader.close()
+    return count
@@ -0,0 +1,90 @@
+"""
+Lightweight instrumentation: latency histograms and throughput counters.
+
+Recording is cheap enough to leave switched on: a histogram update is a
+bit_length() and a few additions, with no allocation.
+"""
+from .clock import monotonic
+
+
+class LatencyHistogram(object):
+    """
+    Latencies in log2 buckets of microseconds: bucket n holds latencies of less than 2 ** n us (and at least
+    2 ** (n - 1) us), so percentiles are accurate to within a factor of two, while max is exact.
+    """
+    BUCKETS = 32
+
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        if seconds < 0:
+            seconds = 0.0
+        bucket = int(seconds * 1e6).bit_length()
+        if bucket >= self.BUCKETS:
+            bucket = self.BUCKETS - 1
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent):
+        """an upper bound on the given percentile, in seconds"""
+        if not self.count:
+            return 0.0
+        threshold = self.count * percent / 100.0
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= threshold:
+                return min((1 << bucket) * 1e-6, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class EndpointStats(object):
+    """
+    Throughput and drop counters for a source or destination, plus a latency histogram: for a source, the time from
+    a packet's arrival to it being read; for a destination, the time taken to send.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.latency = LatencyHistogram()
+        self.reset()
+
+    def reset(self):
+        self.messages = 0
+        self.bytes = 0
+        self.batches = 0
+        self.dropped = 0
+        self.started = monotonic()
+        self.latency.reset()
+
+    def summary(self):
+        elapsed = monotonic() - self.started
+        return {
+            'name': self.name,
+            'messages': self.messages,
+            'bytes': self.bytes,
+            'batches': self.batches,
+            'dropped': self.dropped,
+            'messages_per_second': self.messages / elapsed if elapsed > 0 else 0.0,
+            'latency': self.latency.summary(),
+        }
@@ -0,0 +1,259 @@
+"""
+Large SysEx transfers: patch libraries, sample and firmware dumps.
+
+A dump can run to megabytes, and at DIN speed takes minutes to send. SysExSender sends one in chunks, each handed to
+the backend as an asynchronous request (MIDISendSysex, on CoreMIDI, which paces the data to the destination), so no
+more than a chunk is ever held in memory and the caller isn't blocked:
+
+    transfer = destination.send_sysex(open('firmware.syx', 'rb'), progress=lambda t: print(t.sent, t.throughput()))
+    transfer.wait()
+
+On the receiving side, a SysExReassembler picks SysEx messages out of the incoming stream and writes them to a
+file-like sink as they arrive, however long they are, leaving everything else to be parsed as usual:
+
+    with open('dump.syx', 'wb') as f:
+        source.receive_sysex(f, idle_timeout=2)
+"""
+import io
+import re
+from threading import Event, Thread
+
+from .backends import get_backend
+from .clock import monotonic
+from .parser import SYSEX_START, SYSEX_END, REALTIME_MIN
+
+CHUNK_SIZE = 4096
+# how often a sender reports progress while a chunk is being sent
+PROGRESS_INTERVAL = 0.1
+
+_STATUS = re.compile(b'[\x80-\xff]')
+_SYSEX_END = b'\xf7'
+
+
+class _Throughput(object):
+    started = None
+    updated = None
+
+    def _update(self):
+        self.updated = monotonic()
+        if self.started is None:
+            self.started = self.updated
+
+    def elapsed(self):
+        """seconds from the first byte to the last"""
+        if self.started is None:
+            return 0.0
+        return self.updated - self.started
+
+    def throughput(self):
+        """bytes a second, so far"""
+        elapsed = self.elapsed()
+        return self.bytes / elapsed if elapsed > 0 else 0.0
+
+
+def _chunks(read, chunk_size):
+    """
+    yields chunks of at most chunk_size bytes from read. Chunks end at the end of a SysEx message where one falls
+    within them, since some devices expect each request to hold whole messages.
+    """
+    carry = b''
+    while True:
+        block = read(chunk_size - len(carry))
+        chunk = carry + block
+        if not block:
+            if chunk:
+                yield chunk
+            return
+        end = chunk.rfind(_SYSEX_END) + 1
+        if end in (0, len(chunk)):
+            carry = b''
+            yield chunk
+        else:
+            carry = chunk[end:]
+            yield chunk[:end]
+
+
+class SysExSender(_Throughput):
+    """
+    Sends SysEx data (bytes, or a file-like object open for reading) to a MIDIDestination in chunks of chunk_size
+    bytes, on a thread of its own. progress, if given, is called with the sender from that thread as the transfer
+    goes, and once more when it has finished.
+    """
+    def __init__(self, destination, data, chunk_size=CHUNK_SIZE, progress=None):
+        if hasattr(data, 'read'):
+            self.total = None
+            self._read = data.read
+        else:
+            data = bytes(bytearray(data))
+            self.total = len(data)
+            self._read = io.BytesIO(data).read
+        self.destination = destination
+        self.chunk_size = chunk_size
+        self.progress = progress
+        # bytes sent so far
+        self.bytes = 0
+        self.cancelled = False
+        # the exception that stopped the transfer, if one did
+        self.error = None
+        self._done = Event()
+        self._thread = Thread(target=self._run, name="SysEx to %s" % destination.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def sent(self):
+        return self.bytes
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """waits up to timeout seconds (forever if None) for the transfer to finish, returning whether it has"""
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def cancel(self):
+        """stops the transfer, part way through the chunk being sent"""
+        self.cancelled = True
+
+    def _report(self, sent):
+        self.bytes = sent
+        self._update()
+        if self.progress is not None:
+            self.progress(self)
+
+    def _run(self):
+        backend = get_backend()
+        stats = self.destination.stats
+        sent = 0
+        try:
+            destination = self.destination._destination()
+            self._update()
+            for chunk in _chunks(self._read, self.chunk_size):
+                if self.cancelled:
+                    break
+                start = monotonic()
+                request = backend.send_sysex(destination, chunk)
+                while not backend.wait_sysex(request, PROGRESS_INTERVAL):
+                    if self.cancelled:
+                        backend.cancel_sysex(request)
+                    self._report(sent + backend.sysex_progress(request)[0])
+                chunk_sent = backend.sysex_progress(request)[0]
+                sent += chunk_sent
+                stats.latency.record(monotonic() - start)
+                stats.bytes += chunk_sent
+                stats.messages += chunk.count(_SYSEX_END)
+                stats.batches += 1
+                self._report(sent)
+                if chunk_sent < len(chunk):
+                    break
+        except Exception as e:
+            self.error = e
+        finally:
+            try:
+                self._report(sent)
+            finally:
+                self._done.set()
+
+
+class SysExReassembler(_Throughput):
+    """
+    Writes the SysEx messages in a received byte stream to sink (anything with a write method) as their bytes
+    arrive, so a message takes no more memory than the reads it arrives in, whatever its size.
+
+    feed() takes each read, and returns the bytes that weren't SysEx, realtime bytes interleaved with SysEx
+    included, for parsing as usual. As MIDIParser does, any status byte other than a realtime one ends a SysEx
+    message; the 0xF7 it should have ended with is written for it, and the message counted as truncated.
+    progress, if given, is called with the reassembler after each read that had SysEx in it.
+    """
+    def __init__(self, sink, progress=None):
+        self.sink = sink
+        self.progress = progress
+        # SysEx bytes written, and complete messages
+        self.bytes = 0
+        self.messages = 0
+        self.truncated = 0
+        # whether a message has started but not yet ended
+        self.in_message = False
+
+    def _write(self, data):
+        if data:
+            self.sink.write(data)
+            self.bytes += len(data)
+
+    def _end_message(self):
+        self.in_message = False
+        self.messages += 1
+
+    def feed(self, data):
+        data = bytes(data)
+        other = bytearray()
+        bytes_before = self.bytes
+        messages_before = self.messages
+        position = 0
+        for match in _STATUS.finditer(data):
+            i = match.start()
+            status = ord(match.group())
+            if status >= REALTIME_MIN:
+                # realtime bytes may appear anywhere, and aren't part of the message they interrupt
+                if self.in_message:
+                    self._write(data[position:i])
+                else:
+                    other.extend(data[position:i])
+                other.append(status)
+                position = i + 1
+                continue
+            if self.in_message:
+                if status == SYSEX_END:
+                    self._write(data[position:i + 1])
+                    position = i + 1
+                    self._end_message()
+                    continue
+                self._write(data[position:i] + _SYSEX_END)
+                position = i
+                self._end_message()
+                self.truncated += 1
+            if status == SYSEX_START:
+                other.extend(data[position:i])
+                position = i
+                self.in_message = True
+        if self.in_message:
+            self._write(data[position:])
+        else:
+            other.extend(data[position:])
+
+        if self.bytes != bytes_before or self.messages != messages_before:
+            self._update()
+            if self.progress is not None:
+                self.progress(self)
+        return bytes(other)
+
+
+def receive_sysex(source, sink, count=None, timeout=None, idle_timeout=2.0, progress=None):
+    """
+    writes the SysEx messages a MIDISource receives to sink (see SysExReassembler) until count messages have
+    arrived, nothing has arrived for idle_timeout seconds after the first SysEx byte, or (if given) timeout seconds
+    have passed. Other messages received meanwhile are queued on the source as usual. Returns the reassembler,
+    which counts what was received.
+    """
+    reassembler = SysExReassembler(sink, progress)
+    backend = get_backend()
+    connection = source._source()
+    deadline = monotonic() + timeout if timeout is not None else None
+    while True:
+        wait = idle_timeout if reassembler.started is not None else 1.0
+        if deadline is not None:
+            wait = min(wait, deadline - monotonic())
+            if wait <= 0:
+                break
+        received = backend.receive_packets(connection, wait)
+        if not received:
+            if reassembler.started is not None:
+                # idle: the transfer is over, or has stalled
+                break
+            continue
+        source._record(received)
+        source._enqueue(reassembler.feed(received[0]))
+        if count is not None and reassembler.messages >= count:
+            break
+    return reassembler
@@ -0,0 +1,333 @@
+/*
+ * Stress test for scmqueue.
+ *
+ * Producer threads put packets into one queue while consumer threads take them, as CoreMIDI's read proc and
+ * Python's receive calls do, under every overflow policy. Every byte put must be taken, dropped or coalesced away,
+ * each producer's packets must arrive in the order they were put, and under the coalesce policy the latest value
+ * of every controller must survive. Timed waits are checked against the monotonic clock.
+ *
+ * Nothing here needs CoreMIDI or Python, so it runs on any platform with POSIX threads:
+ *
+ *   make test-c          build and run it
+ *   make test-c-tsan     the same, under ThreadSanitizer
+ */
+#include <errno.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+#include "scmqueue.h"
+
+#define PRODUCERS 4
+/* fewer than 2^14, so a packet's sequence number fits in its two data bytes */
+#define PACKETS_PER_PRODUCER 16000
+#define CONTROLLERS 8
+#define LIMIT 300
+
+static int failures = 0;
+
+#define CHECK(condition) do { \
+    if (!(condition)) { \
+      fprintf(stderr, "%s:%d: check failed: %s\n", __FILE__, __LINE__, #condition); \
+      failures++; \
+    } \
+  } while (0)
+
+static const char* policyNames[SCM_OVERFLOW_POLICIES] = {
+  "grow", "block", "drop-oldest", "drop-newest", "coalesce"
+};
+
+typedef struct {
+  SCMPacketQueue queue;
+  SCMOverflowPolicy policy;
+  int consumers;
+  int producing;            /* producers still running; guarded by queue.mutex */
+  unsigned long notified;   /* calls to the block policy's notify; guarded by queue.mutex */
+  unsigned long emptied;    /* calls to Take's emptied; guarded by queue.mutex */
+  unsigned long consumed;   /* bytes taken; guarded by queue.mutex */
+  long next[PRODUCERS];     /* the lowest sequence number each producer's next packet may have (one consumer only) */
+  int latest[PRODUCERS][CONTROLLERS];   /* the last value taken of each controller (one consumer only) */
+} Run;
+
+typedef struct {
+  Run* run;
+  int index;
+} Worker;
+
+static void
+sleepMillis(long millis) {
+  struct timespec delay;
+
+  delay.tv_sec = millis / 1000;
+  delay.tv_nsec = (millis % 1000) * 1000000L;
+  nanosleep(&delay, NULL);
+}
+
+static void
+countNotify(void* context) {
+  ((Run*) context)->notified++;
+}
+
+static void
+countEmptied(void* context) {
+  ((Run*) context)->emptied++;
+}
+
+/*
+ * the packet a producer puts i-th: a note on carrying the sequence number, or under the coalesce policy a control
+ * change cycling through the controllers, whose value rises with each cycle
+ */
+static void
+makePacket(Run* run, int producer, long i, unsigned char* packet) {
+  if (run->policy == SCM_OVERFLOW_COALESCE) {
+    packet[0] = (unsigned char) (0xb0 | producer);
+    packet[1] = (unsigned char) (i % CONTROLLERS);
+    packet[2] = (unsigned char) ((i / CONTROLLERS) & 0x7f);
+  } else {
+    packet[0] = (unsigned char) (0x90 | producer);
+    packet[1] = (unsigned char) (i >> 7);
+    packet[2] = (unsigned char) (i & 0x7f);
+  }
+}
+
+static void*
+produce(void* argument) {
+  Worker* worker = (Worker*) argument;
+  Run* run = worker->run;
+  unsigned char packet[3];
+  long i;
+  int result;
+
+  for (i = 0; i < PACKETS_PER_PRODUCER; i++) {
+    makePacket(run, worker->index, i, packet);
+    pthread_mutex_lock(&run->queue.mutex);
+    result = SCMPacketQueuePut(&run->queue, packet, sizeof(packet), (uint64_t) i, 5.0, countNotify, run);
+    pthread_cond_signal(&run->queue.dataReady);
+    pthread_mutex_unlock(&run->queue.mutex);
+    CHECK(result == 0);
+  }
+  pthread_mutex_lock(&run->queue.mutex);
+  run->producing--;
+  pthread_cond_broadcast(&run->queue.dataReady);
+  pthread_mutex_unlock(&run->queue.mutex);
+  return NULL;
+}
+
+static void
+checkTaken(Run* run, const SCMPacketBuffer* taken) {
+  size_t i;
+
+  CHECK(taken->start == 0 && taken->firstPacket == 0);
+  CHECK(taken->length == taken->numPackets * 3);
+  for (i = 0; i < taken->numPackets; i++) {
+    const unsigned char* packet = taken->data + taken->packets[i].offset;
+    int producer = packet[0] & 0x0f;
+    long sequence;
+
+    CHECK(taken->packets[i].offset == i * 3);
+    CHECK(producer < PRODUCERS);
+    if (run->consumers != 1 || producer >= PRODUCERS)
+      continue;
+    if (run->policy == SCM_OVERFLOW_COALESCE) {
+      CHECK(packet[0] == (0xb0 | producer) && packet[1] < CONTROLLERS);
+      run->latest[producer][packet[1]] = packet[2];
+    } else {
+      sequence = ((long) packet[1] << 7) | packet[2];
+      CHECK(packet[0] == (0x90 | producer));
+      CHECK(taken->packets[i].timestamp == (uint64_t) sequence);
+      CHECK(sequence >= run->next[producer]);
+      run->next[producer] = sequence + 1;
+    }
+  }
+}
+
+static void*
+consume(void* argument) {
+  Worker* worker = (Worker*) argument;
+  Run* run = worker->run;
+  SCMPacketBuffer taken;
+  size_t numBytes;
+  int producing;
+
+  SCMPacketBufferInit(&taken);
+  do {
+    pthread_mutex_lock(&run->queue.mutex);
+    producing = run->producing;
+    pthread_mutex_unlock(&run->queue.mutex);
+
+    numBytes = SCMPacketQueueTake(&run->queue, 0.01, &taken, countEmptied, run);
+    CHECK(numBytes == taken.length);
+    if (numBytes > 0) {
+      checkTaken(run, &taken);
+      pthread_mutex_lock(&run->queue.mutex);
+      run->consumed += numBytes;
+      pthread_mutex_unlock(&run->queue.mutex);
+      /* the queue keeps the storage, so taking again needn't allocate */
+      SCMPacketQueueRecycle(&run->queue, &taken);
+      CHECK(taken.data == NULL);
+    }
+    /* a consumer that isn't the only one leaves a little time for the others to get a share */
+    if (run->consumers > 1 && worker->index == 0)
+      sleepMillis(0);
+  } while (producing || numBytes > 0);
+  SCMPacketBufferFree(&taken);
+  return NULL;
+}
+
+static void
+stress(SCMOverflowPolicy policy, int consumers) {
+  Run run;
+  Worker producers[PRODUCERS], readers[4];
+  pthread_t producerThreads[PRODUCERS], readerThreads[4];
+  unsigned long produced = PRODUCERS * PACKETS_PER_PRODUCER * 3UL;
+  SCMOverflowCounters* counters;
+  int i, j;
+
+  memset(&run, 0, sizeof(run));
+  CHECK(SCMPacketQueueInit(&run.queue) == 0);
+  run.policy = policy;
+  run.consumers = consumers;
+  run.producing = PRODUCERS;
+  for (i = 0; i < PRODUCERS; i++)
+    for (j = 0; j < CONTROLLERS; j++)
+      run.latest[i][j] = -1;
+  if (policy != SCM_OVERFLOW_GROW)
+    CHECK(SCMPacketBufferSetLimit(&run.queue.buffer, LIMIT, policy) == 0);
+
+  for (i = 0; i < consumers; i++) {
+    readers[i].run = &run;
+    readers[i].index = i;
+    pthread_create(&readerThreads[i], NULL, consume, &readers[i]);
+  }
+  for (i = 0; i < PRODUCERS; i++) {
+    producers[i].run = &run;
+    producers[i].index = i;
+    pthread_create(&producerThreads[i], NULL, produce, &producers[i]);
+  }
+  for (i = 0; i < PRODUCERS; i++)
+    pthread_join(producerThreads[i], NULL);
+  for (i = 0; i < consumers; i++)
+    pthread_join(readerThreads[i], NULL);
+
+  counters = &run.queue.buffer.counters;
+  printf("%-11s %d consumer%s: took %lu of %lu bytes in %lu takes; overflows %llu, dropped %llu bytes, "
+         "coalesced %llu, notified %lu\n",
+         policyNames[policy], consumers, consumers == 1 ? " " : "s", run.consumed, produced, run.emptied,
+         (unsigned long long) counters->overflows, (unsigned long long) counters->droppedBytes,
+         (unsigned long long) counters->coalesced, run.notified);
+
+  CHECK(SCMPacketBufferSize(&run.queue.buffer) == 0);
+  CHECK(run.consumed + counters->droppedBytes + 3 * counters->coalesced == produced);
+  CHECK(counters->droppedBytes == 3 * counters->droppedPackets);
+  if (policy == SCM_OVERFLOW_GROW || policy == SCM_OVERFLOW_BLOCK) {
+    CHECK(run.consumed == produced);
+    CHECK(counters->droppedPackets == 0 && counters->coalesced == 0);
+  }
+  if (policy == SCM_OVERFLOW_BLOCK)
+    CHECK(run.notified >= counters->overflows);
+  else
+    CHECK(run.notified == 0);
+  if (policy == SCM_OVERFLOW_DROP_OLDEST || policy == SCM_OVERFLOW_DROP_NEWEST)
+    CHECK(counters->coalesced == 0);
+  if (policy == SCM_OVERFLOW_COALESCE) {
+    /* every controller's latest value takes far less than the limit, so only superseded values are discarded */
+    CHECK(counters->droppedPackets == 0);
+    if (consumers == 1)
+      for (i = 0; i < PRODUCERS; i++)
+        for (j = 0; j < CONTROLLERS; j++)
+          CHECK(run.latest[i][j] == ((PACKETS_PER_PRODUCER - CONTROLLERS + j) / CONTROLLERS & 0x7f));
+  }
+  /* recycled storage is only kept if it is within the limit */
+  CHECK(policy == SCM_OVERFLOW_GROW || run.queue.spare.capacity <= LIMIT);
+  SCMPacketQueueDestroy(&run.queue);
+}
+
+static void*
+putLater(void* argument) {
+  SCMPacketQueue* queue = (SCMPacketQueue*) argument;
+  unsigned char packet[3] = {0x90, 60, 100};
+
+  sleepMillis(20);
+  pthread_mutex_lock(&queue->mutex);
+  SCMPacketQueuePut(queue, packet, sizeof(packet), 0, 0, NULL, NULL);
+  pthread_cond_signal(&queue->dataReady);
+  pthread_mutex_unlock(&queue->mutex);
+  return NULL;
+}
+
+static void
+timedWaits(void) {
+  SCMPacketQueue queue;
+  SCMPacketBuffer taken;
+  pthread_t putter;
+  unsigned char packet[3] = {0x90, 60, 100};
+  unsigned char* storage;
+  uint64_t start, waited;
+  int result;
+
+  CHECK(SCMPacketQueueInit(&queue) == 0);
+  SCMPacketBufferInit(&taken);
+
+  /* a timeout is waited out in full, with sub-millisecond resolution, but not much longer */
+  start = SCMMonotonicNanos();
+  CHECK(SCMPacketQueueTake(&queue, 0.0125, &taken, NULL, NULL) == 0);
+  waited = SCMMonotonicNanos() - start;
+  printf("timed wait: %.3f ms for 12.5 ms\n", waited / 1e6);
+  CHECK(waited >= 12500000 && waited < 500000000);
+
+  /* a zero timeout doesn't wait */
+  start = SCMMonotonicNanos();
+  CHECK(SCMPacketQueueTake(&queue, 0, &taken, NULL, NULL) == 0);
+  CHECK(SCMMonotonicNanos() - start < 100000000);
+
+  /* a negative timeout waits until something arrives */
+  pthread_create(&putter, NULL, putLater, &queue);
+  start = SCMMonotonicNanos();
+  CHECK(SCMPacketQueueTake(&queue, -1, &taken, NULL, NULL) == 3);
+  CHECK(SCMMonotonicNanos() - start >= 20000000);
+  pthread_join(putter, NULL);
+  CHECK(taken.length == 3 && memcmp(taken.data, packet, 3) == 0);
+
+  /* recycled storage is handed to the queue by the next take, rather than allocated afresh */
+  storage = taken.data;
+  SCMPacketQueueRecycle(&queue, &taken);
+  CHECK(taken.data == NULL && queue.spare.data == storage);
+  pthread_mutex_lock(&queue.mutex);
+  SCMPacketQueuePut(&queue, packet, sizeof(packet), 0, 0, NULL, NULL);
+  pthread_mutex_unlock(&queue.mutex);
+  CHECK(SCMPacketQueueTake(&queue, 0, &taken, NULL, NULL) == 3);
+  CHECK(queue.buffer.data == storage && queue.spare.data == NULL);
+
+  /* under the block policy, a put that doesn't fit gives up after its timeout, dropping the packet */
+  CHECK(SCMPacketBufferSetLimit(&queue.buffer, 3, SCM_OVERFLOW_BLOCK) == 0);
+  pthread_mutex_lock(&queue.mutex);
+  CHECK(SCMPacketQueuePut(&queue, packet, sizeof(packet), 0, 0.01, NULL, NULL) == 0);
+  start = SCMMonotonicNanos();
+  result = SCMPacketQueuePut(&queue, packet, sizeof(packet), 0, 0.01, NULL, NULL);
+  waited = SCMMonotonicNanos() - start;
+  pthread_mutex_unlock(&queue.mutex);
+  CHECK(result == SCM_BUFFER_FULL);
+  CHECK(waited >= 10000000);
+  CHECK(queue.buffer.counters.droppedPackets == 1 && queue.buffer.counters.droppedBytes == 3);
+
+  SCMPacketBufferFree(&taken);
+  SCMPacketQueueDestroy(&queue);
+}
+
+int
+main(void) {
+  int policy;
+
+  timedWaits();
+  for (policy = SCM_OVERFLOW_GROW; policy < SCM_OVERFLOW_POLICIES; policy++) {
+    stress((SCMOverflowPolicy) policy, 1);
+    stress((SCMOverflowPolicy) policy, 3);
+  }
+  if (failures) {
+    fprintf(stderr, "%d checks failed\n", failures);
+    return 1;
+  }
+  printf("all checks passed\n");
+  return 0;
+}
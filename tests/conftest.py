@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+from simplecoremidi import backends
+
+# the example mapper imports its modules as top level ones
+EXAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'simplecoremidi', 'examples')
+if EXAMPLES not in sys.path:
+    sys.path.append(EXAMPLES)
+
+# asyncio support is Python 3 only, and its tests aren't even valid Python 2
+collect_ignore = ['test_aio.py'] if sys.version_info[0] < 3 else []
+
+
+@pytest.fixture
+def loopback():
+    """a fresh loopback backend, with one port named 'loopback', selected for the duration of a test"""
+    previous = backends._backend
+    backend = backends.set_backend('loopback')
+    yield backend
+    backends._backend = previous
@@ -0,0 +1,64 @@
+import asyncio
+
+from simplecoremidi import MIDISource
+from simplecoremidi.clock import monotonic
+
+
+def test_areceive_waits_without_blocking_the_loop(loopback):
+    port = loopback.port('loopback')
+    source = MIDISource('loopback', port)
+
+    async def receive():
+        # injected by the loop itself, so the loop must keep running while areceive waits
+        asyncio.get_running_loop().call_later(0.02, port.inject, [0x90, 60, 100])
+        return await source.areceive(timeout=2)
+
+    message = asyncio.run(receive())
+    assert (message.channel, message.number, message.velocity) == (0, 60, 100)
+
+
+def test_areceive_times_out(loopback):
+    source = MIDISource('loopback', loopback.port('loopback'))
+    start = monotonic()
+    assert asyncio.run(source.areceive(timeout=0.05)) is None
+    assert 0.04 <= monotonic() - start < 1
+    assert asyncio.run(source.areceive_many(timeout=0)) == []
+
+
+def test_areceive_many_returns_everything_queued(loopback):
+    port = loopback.port('loopback')
+    source = MIDISource('loopback', port)
+    source.receive(timeout=0)
+    port.inject([0x90, 60, 100, 62, 100])
+    port.inject([0xC0, 3])
+    assert len(asyncio.run(source.areceive_many(timeout=1))) == 3
+
+
+def test_stream_yields_messages_in_order(loopback):
+    port = loopback.port('loopback')
+    source = MIDISource('loopback', port)
+
+    async def first(count):
+        loop = asyncio.get_running_loop()
+        for i in range(count):
+            loop.call_later(0.01 * (i + 1), port.inject, [0xB0, 7, i])
+        values = []
+        async for message in source.stream():
+            values.append(message.value)
+            if len(values) == count:
+                return values
+
+    assert asyncio.run(first(5)) == [0, 1, 2, 3, 4]
+
+
+def test_sources_share_one_loop(loopback):
+    ports = [loopback.create_port('port %d' % i) for i in range(3)]
+    sources = [MIDISource(port.name, port) for port in ports]
+
+    async def receive_all():
+        loop = asyncio.get_running_loop()
+        for i, port in enumerate(ports):
+            loop.call_later(0.01 * (3 - i), port.inject, [0xC0, i])
+        return await asyncio.gather(*[source.areceive(timeout=2) for source in sources])
+
+    assert [message.program for message in asyncio.run(receive_all())] == [0, 1, 2]
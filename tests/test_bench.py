@@ -0,0 +1,40 @@
+import io
+import os
+import sys
+
+BENCHMARKS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks')
+if BENCHMARKS not in sys.path:
+    sys.path.append(BENCHMARKS)
+
+import bench
+
+
+def test_every_benchmark_runs(loopback):
+    report = bench.run_benchmarks(scale=0.001, repeat=1)
+    names = [name for name, setup, count in bench.BENCHMARKS]
+    assert sorted(report['results']) == sorted(names)
+    for name, result in report['results'].items():
+        if 'skipped' in result:
+            # only numpy is optional
+            assert name == 'decode_array'
+            continue
+        assert result['operations'] >= 1
+        assert result['seconds'] >= 0
+
+
+def test_only_named_benchmarks_run(loopback):
+    report = bench.run_benchmarks(['parse_message', 'send'], scale=0.001, repeat=1)
+    assert sorted(report['results']) == ['parse_message', 'send']
+
+
+def test_compare_against_a_baseline(loopback):
+    report = bench.run_benchmarks(['parse_message', 'to_bytes'], scale=0.001, repeat=1)
+    baseline = {'results': {'parse_message': dict(report['results']['parse_message'])}}
+    baseline['results']['parse_message']['operations_per_second'] /= 2
+    out = io.StringIO() if sys.version_info[0] > 2 else io.BytesIO()
+    bench.compare(report, baseline, file=out)
+    lines = out.getvalue().splitlines()
+    assert lines[0].split()[0] == 'benchmark'
+    assert lines[1].split()[0] == 'parse_message' and lines[1].endswith('2.00x')
+    # not in the baseline: no speedup
+    assert lines[2].split()[0] == 'to_bytes' and lines[2].endswith('-')
@@ -0,0 +1,137 @@
+import threading
+
+import pytest
+
+from simplecoremidi import MIDISource
+from simplecoremidi.backends import loopback as loopback_backend
+
+
+@pytest.fixture
+def connection(loopback):
+    return loopback.port('loopback').connect()
+
+
+def put(connection, *packets):
+    for packet in packets:
+        connection.put(bytearray(packet))
+
+
+def take(connection):
+    data, packets = connection.take_packets(0)
+    return [data[offset:end] for (offset, timestamp), end in zip(packets, [p[0] for p in packets[1:]] + [len(data)])]
+
+
+def counters(connection):
+    c = connection.counters
+    return c['overflows'], c['dropped_packets'], c['dropped_bytes'], c['coalesced']
+
+
+def test_unbounded_by_default(connection):
+    put(connection, *[(0x90, i % 128, 100) for i in range(1000)])
+    assert len(take(connection)) == 1000
+    assert counters(connection) == (0, 0, 0, 0)
+
+
+@pytest.mark.parametrize('limit, policy', [(10, 'sometimes'), (-1, 'drop-oldest')])
+def test_rejects_bad_settings(connection, limit, policy):
+    with pytest.raises(ValueError):
+        connection.set_limit(limit, policy)
+
+
+def test_drop_newest(connection):
+    connection.set_limit(6, 'drop-newest')
+    put(connection, (0x90, 60, 100), (0x90, 62, 100), (0x90, 64, 100))
+    assert take(connection) == [b'\x90\x3c\x64', b'\x90\x3e\x64']
+    assert counters(connection) == (1, 1, 3, 0)
+
+
+def test_drop_oldest(connection):
+    connection.set_limit(6, 'drop-oldest')
+    put(connection, (0x90, 60, 100), (0x90, 62, 100), (0x90, 64, 100), (0x90, 65, 100))
+    assert take(connection) == [b'\x90\x40\x64', b'\x90\x41\x64']
+    assert counters(connection) == (2, 2, 6, 0)
+
+
+def test_a_packet_larger_than_the_limit_is_dropped(connection):
+    connection.set_limit(4, 'drop-oldest')
+    put(connection, (0x90, 60, 100), b'\xf0' + b'\x01' * 10 + b'\xf7')
+    assert take(connection) == [b'\x90\x3c\x64']
+    assert counters(connection) == (1, 1, 12, 0)
+
+
+def test_the_limit_counts_packets_too(connection):
+    connection.set_limit(3, 'drop-oldest')
+    put(connection, (0xF8,), (0xF8,), (0xFA,), (0xFC,))
+    assert take(connection) == [b'\xf8', b'\xfa', b'\xfc']
+
+
+def test_lowering_the_limit_drops_what_no_longer_fits(connection):
+    put(connection, (0x90, 60, 100), (0x90, 62, 100), (0x90, 64, 100))
+    connection.set_limit(3, 'drop-oldest')
+    assert take(connection) == [b'\x90\x40\x64']
+    assert counters(connection)[1:3] == (2, 6)
+
+
+def test_block_waits_for_room(connection):
+    connection.set_limit(3, 'block')
+    put(connection, (0x90, 60, 100))
+    blocked = threading.Thread(target=put, args=(connection, (0x90, 62, 100)))
+    blocked.start()
+    blocked.join(0.05)
+    assert blocked.is_alive()
+    assert take(connection) == [b'\x90\x3c\x64']
+    blocked.join(5)
+    assert take(connection) == [b'\x90\x3e\x64']
+    assert counters(connection) == (1, 0, 0, 0)
+
+
+def test_block_gives_up_eventually(connection, monkeypatch):
+    monkeypatch.setattr(loopback_backend, 'BLOCK_TIMEOUT', 0.05)
+    connection.set_limit(3, 'block')
+    put(connection, (0x90, 60, 100), (0x90, 62, 100))
+    assert take(connection) == [b'\x90\x3c\x64']
+    assert counters(connection) == (1, 1, 3, 0)
+
+
+def test_coalesce_keeps_the_latest_values(connection):
+    connection.set_limit(9, 'coalesce')
+    put(connection, (0xB0, 7, 1), (0x90, 60, 100), (0xB0, 7, 2), (0xB0, 7, 3))
+    data, packets = connection.take_packets(0)
+    assert data == b'\x90\x3c\x64\xb0\x07\x03'
+    # the packets emptied by coalescing are gone
+    assert [offset for offset, timestamp in packets] == [0, 3]
+    assert counters(connection) == (1, 0, 0, 2)
+
+
+def test_coalesce_keys(connection):
+    connection.set_limit(12, 'coalesce')
+    # pitch bend and channel pressure by channel, controllers and polyphonic aftertouch by number too
+    put(connection, (0xE0, 0, 64), (0xB0, 7, 1), (0xB0, 10, 1), (0xE1, 0, 64),
+        (0xE0, 0, 65))
+    assert take(connection) == [b'\xb0\x07\x01', b'\xb0\x0a\x01', b'\xe1\x00\x40', b'\xe0\x00\x41']
+    assert counters(connection)[3] == 1
+
+
+def test_coalesce_restores_running_status(connection):
+    connection.set_limit(9, 'coalesce')
+    put(connection, (0xB0, 7, 1, 10, 64), (0x90, 60, 100), (0xB0, 7, 2))
+    assert take(connection) == [b'\xb0\x0a\x40', b'\x90\x3c\x64', b'\xb0\x07\x02']
+    assert counters(connection) == (1, 0, 0, 1)
+
+
+def test_coalesce_drops_the_oldest_when_nothing_is_superseded(connection):
+    connection.set_limit(6, 'coalesce')
+    put(connection, (0x90, 60, 100), (0xB0, 7, 1), (0xB0, 10, 1))
+    assert take(connection) == [b'\xb0\x07\x01', b'\xb0\x0a\x01']
+    assert counters(connection) == (1, 1, 3, 0)
+
+
+def test_sources_apply_the_setting(loopback):
+    port = loopback.port('loopback')
+    source = MIDISource('loopback', port)
+    source.set_buffer(6, 'coalesce')
+    port.inject((0xB0, 7, 1))
+    port.inject((0xB0, 7, 2))
+    port.inject((0xB0, 7, 3))
+    assert [m.toBytes() for m in source.receive_many(timeout=0)] == [b'\xb0\x07\x03']
+    assert source.overflow() == dict(overflows=1, dropped_packets=0, dropped_bytes=0, coalesced=2)
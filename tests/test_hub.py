@@ -0,0 +1,101 @@
+import threading
+
+import pytest
+
+from simplecoremidi import MIDISource, backends, clock
+from simplecoremidi.backends.loopback import LoopbackBackend
+from simplecoremidi.hub import MIDIHub
+
+
+class PolledBackend(LoopbackBackend):
+    """a backend without readiness descriptors"""
+
+    def fileno(self, source):
+        raise NotImplementedError
+
+
+@pytest.fixture
+def sources(loopback):
+    ports = [loopback.create_port(name) for name in ('a', 'b', 'c')]
+    return ports, [MIDISource(port.name, port) for port in ports]
+
+
+def received(batches):
+    return [(source.name, [m.toBytes() for m in messages]) for source, messages in batches]
+
+
+def test_registering_connects(sources):
+    ports, (a, b, c) = sources
+    hub = MIDIHub([a, b])
+    hub.register(a)
+    assert hub.sources == [a, b] and len(hub) == 2
+    ports[0].inject((0x90, 60, 100))
+    assert received(hub.receive(timeout=0)) == [('a', [b'\x90\x3c\x64'])]
+    hub.unregister(a)
+    ports[0].inject((0x90, 60, 100))
+    assert hub.receive(timeout=0) == []
+
+
+def test_sources_in_order_of_arrival(sources):
+    ports, (a, b, c) = sources
+    hub = MIDIHub([a, b, c])
+    ports[2].inject((0xB0, 7, 1))
+    ports[0].inject((0xB0, 7, 2))
+    ports[2].inject((0xB0, 7, 3))
+    assert received(hub.receive(timeout=0)) == [
+        ('c', [b'\xb0\x07\x01', b'\xb0\x07\x03']),
+        ('a', [b'\xb0\x07\x02']),
+    ]
+
+
+def test_a_quiet_source_does_not_hold_up_a_busy_one(sources):
+    ports, (a, b, c) = sources
+    hub = MIDIHub([a, b])
+    timer = threading.Timer(0.05, ports[1].inject, [(0x90, 60, 100)])
+    timer.start()
+    start = clock.monotonic()
+    try:
+        assert received(hub.receive(timeout=5)) == [('b', [b'\x90\x3c\x64'])]
+    finally:
+        timer.join()
+    assert clock.monotonic() - start < 1
+
+
+def test_receive_times_out(sources):
+    ports, (a, b, c) = sources
+    hub = MIDIHub([a, b])
+    start = clock.monotonic()
+    assert hub.receive(timeout=0.05) == []
+    assert clock.monotonic() - start >= 0.04
+
+
+def test_messages_already_queued_are_returned(sources):
+    ports, (a, b, c) = sources
+    hub = MIDIHub([a])
+    ports[0].inject((0x90, 60, 100, 62, 100))
+    assert a.receive(timeout=0).toBytes() == b'\x90\x3c\x64'
+    # the second note was parsed along with the first, so a's descriptor isn't readable for it
+    assert received(hub.receive(timeout=0)) == [('a', [b'\x90\x3e\x64'])]
+
+
+def test_polled_sources(loopback):
+    backend = backends.set_backend(PolledBackend(('a', 'b')))
+    a, b = [MIDISource(name, backend.port(name)) for name in ('a', 'b')]
+    hub = MIDIHub([a, b])
+    timer = threading.Timer(0.05, backend.port('b').inject, [(0x90, 60, 100)])
+    timer.start()
+    try:
+        assert received(hub.receive(timeout=5)) == [('b', [b'\x90\x3c\x64'])]
+    finally:
+        timer.join()
+    assert hub.receive(timeout=0.01) == []
+
+
+def test_iterating(sources):
+    ports, (a, b, c) = sources
+    hub = MIDIHub([a, b])
+    ports[1].inject((0x90, 60, 100))
+    ports[0].inject((0x90, 62, 100))
+    it = iter(hub)
+    assert [(source.name, m.toBytes()) for source, m in (next(it), next(it))] == [
+        ('b', b'\x90\x3c\x64'), ('a', b'\x90\x3e\x64')]
@@ -0,0 +1,163 @@
+import pytest
+
+from simplecoremidi import (ChannelAftertouchMessage, ControllerChangeMessage, MIDIDestination, MIDISource,
+                            NoteOnMessage, PitchBendMessage, ProgramChangeMessage, SysExMessage, limiter)
+from simplecoremidi.clock import monotonic
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class ManualScheduler(object):
+    """records calls rather than making them, so a test decides when the limiter flushes"""
+
+    class Call(object):
+        def __init__(self, delay):
+            self.delay = delay
+            self.cancelled = False
+
+        def cancel(self):
+            self.cancelled = True
+
+    def __init__(self):
+        self.calls = []
+
+    def call_later(self, delay, function, *args):
+        call = self.Call(delay)
+        self.calls.append(call)
+        return call
+
+
+class Recorder(object):
+    def __init__(self):
+        self.batches = []
+
+    def _send_many(self, messages):
+        self.batches.append([m.toBytes() for m in messages])
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(limiter, 'monotonic', clock)
+    return clock
+
+
+@pytest.fixture
+def scheduler():
+    return ManualScheduler()
+
+
+@pytest.fixture
+def out():
+    return Recorder()
+
+
+def test_messages_wait_for_a_flush(clock, scheduler, out):
+    rate = limiter.OutputLimiter(out, scheduler=scheduler)
+    rate.submit(NoteOnMessage(0, 60, 100))
+    rate.submit(NoteOnMessage(0, 62, 100))
+    assert out.batches == [] and rate.pending() == 2
+    # one flush is scheduled, a window away
+    assert [call.delay for call in scheduler.calls] == [0.005]
+    assert rate.flush() == 2
+    assert out.batches == [[b'\x90\x3c\x64', b'\x90\x3e\x64']]
+    assert rate.pending() == 0
+
+
+def test_waiting_values_are_merged(clock, scheduler, out):
+    rate = limiter.OutputLimiter(out, scheduler=scheduler)
+    rate.submit_many([ControllerChangeMessage(0, 7, value) for value in range(10)])
+    rate.submit(ControllerChangeMessage(1, 7, 5))
+    rate.submit_many([PitchBendMessage(0, 8192), ChannelAftertouchMessage(0, 10), PitchBendMessage(0, 9000),
+                      ChannelAftertouchMessage(0, 20)])
+    rate.flush(everything=True)
+    assert out.batches == [[
+        ControllerChangeMessage(0, 7, 9).toBytes(),
+        ControllerChangeMessage(1, 7, 5).toBytes(),
+        PitchBendMessage(0, 9000).toBytes(),
+        ChannelAftertouchMessage(0, 20).toBytes(),
+    ]]
+    assert rate.merged == 11
+
+
+@pytest.mark.parametrize('control', [0x00, 0x20, 0x40, 0x06, 0x62, 0x7B])
+def test_some_controllers_are_never_merged(clock, scheduler, out, control):
+    rate = limiter.OutputLimiter(out, scheduler=scheduler)
+    messages = [ControllerChangeMessage(0, control, 127), ControllerChangeMessage(0, control, 0)]
+    rate.submit_many(messages)
+    rate.flush(everything=True)
+    assert out.batches == [[m.toBytes() for m in messages]]
+    assert rate.merged == 0
+
+
+def test_notes_and_programs_keep_their_order(clock, scheduler, out):
+    rate = limiter.OutputLimiter(out, scheduler=scheduler)
+    messages = [ControllerChangeMessage(0, 0, 1), ProgramChangeMessage(0, 5), NoteOnMessage(0, 60, 100),
+                ControllerChangeMessage(0, 1, 10), NoteOnMessage(0, 60, 0), ControllerChangeMessage(0, 1, 20)]
+    rate.submit_many(messages)
+    rate.flush(everything=True)
+    # the merged value is sent in the place of the latest
+    assert out.batches == [[m.toBytes() for m in messages[:3] + messages[4:]]]
+
+
+def test_keeps_to_the_rate(clock, scheduler, out):
+    rate = limiter.OutputLimiter(out, bytes_per_second=300, window=0.01, burst=15, scheduler=scheduler)
+    rate.submit_many([NoteOnMessage(0, n, 100) for n in range(60, 70)])
+    assert rate.flush() == 5
+    # the next flush is when there is budget for another message
+    assert scheduler.calls[-1].delay == pytest.approx(0.01)
+    assert rate.flush() == 0
+    clock.now += 0.01
+    assert rate.flush() == 1
+    clock.now += 1
+    # no more than a burst after a quiet spell
+    assert rate.flush() == 4
+    assert sum(len(batch) for batch in out.batches) == 10
+
+
+def test_a_message_bigger_than_the_burst_goes_once_the_budget_is_full(clock, scheduler, out):
+    rate = limiter.OutputLimiter(out, bytes_per_second=1000, burst=16, scheduler=scheduler)
+    rate.submit_many([ControllerChangeMessage(0, 1, 1), SysExMessage(b'\x01' * 100), NoteOnMessage(0, 60, 100)])
+    assert rate.flush() == 1
+    clock.now += 1
+    assert rate.flush() == 1
+    # leaving the budget in debt
+    assert scheduler.calls[-1].delay == pytest.approx(0.089)
+    clock.now += 0.05
+    assert rate.flush() == 0
+    clock.now += 0.05
+    assert rate.flush() == 1
+
+
+def test_close_sends_everything(clock, scheduler, out):
+    rate = limiter.OutputLimiter(out, bytes_per_second=300, burst=3, scheduler=scheduler)
+    rate.submit_many([NoteOnMessage(0, n, 100) for n in range(60, 70)])
+    rate.close()
+    assert sum(len(batch) for batch in out.batches) == 10
+    assert all(call.cancelled for call in scheduler.calls)
+
+
+def test_limiting_a_destination(loopback):
+    port = loopback.port('loopback')
+    source = MIDISource('loopback', port)
+    source.receive(timeout=0)
+    destination = MIDIDestination('loopback', port)
+    rate = destination.limit_rate(3125, window=0.001)
+    destination.send_many([ControllerChangeMessage(0, 7, value) for value in range(100)])
+    destination.send(NoteOnMessage(0, 60, 100))
+    received = []
+    deadline = monotonic() + 2
+    while len(received) < 2 and monotonic() < deadline:
+        received.extend(source.receive_many(timeout=0.05))
+    assert [m.toBytes() for m in received] == [b'\xb0\x07\x63', b'\x90\x3c\x64']
+    assert rate.merged == 99
+
+    destination.send_bytes((0x90, 62, 100))
+    assert destination.limit_rate(None) is None
+    assert [m.toBytes() for m in source.receive_many(timeout=0)] == [b'\x90\x3e\x64']
@@ -0,0 +1,100 @@
+import select
+import threading
+import time
+
+import pytest
+
+from simplecoremidi import backends, MIDIDestination, MIDISource
+from simplecoremidi.backends.loopback import LoopbackBackend
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        backends.set_backend('nonesuch')
+
+
+def test_set_backend_by_instance(loopback):
+    backend = LoopbackBackend(port_names=('a', 'b'))
+    assert backends.set_backend(backend) is backend
+    assert backends.get_backend() is backend
+    assert [backend.endpoint_name(ref) for ref in backend.source_list()] == ['a', 'b']
+
+
+def test_send_reaches_every_connection(loopback):
+    port = loopback.port('loopback')
+    first, second = loopback.connect_source(port), loopback.connect_source(port)
+    MIDIDestination('loopback', port).send_bytes(bytearray([0x90, 60, 100]))
+    assert bytes(loopback.receive(first, 0)) == b'\x90\x3c\x64'
+    assert bytes(loopback.receive(second, 0)) == b'\x90\x3c\x64'
+
+
+def test_packets_keep_their_boundaries(loopback):
+    port = loopback.port('loopback')
+    connection = loopback.connect_source(port)
+    port.inject([0x90, 60, 100])
+    port.inject([0x80, 60, 0, 0xF8])
+    data, packets = loopback.receive_packets(connection, 0)
+    assert bytes(data) == b'\x90\x3c\x64\x80\x3c\x00\xf8'
+    assert [offset for offset, timestamp in packets] == [0, 3]
+    assert packets[0][1] <= packets[1][1]
+    assert loopback.receive_packets(connection, 0) is None
+
+
+def test_timeouts(loopback):
+    connection = loopback.connect_source(loopback.port('loopback'))
+    start = time.time()
+    assert not loopback.receive(connection, 0)
+    assert not loopback.receive(connection, 0.05)
+    assert time.time() - start >= 0.05
+
+
+@pytest.mark.parametrize('timeout', [None, -1])
+def test_no_timeout_waits_for_data(loopback, timeout):
+    port = loopback.port('loopback')
+    connection = loopback.connect_source(port)
+    timer = threading.Timer(0.05, port.inject, [[0xC0, 1]])
+    timer.start()
+    try:
+        assert bytes(loopback.receive(connection, timeout)) == b'\xc0\x01'
+    finally:
+        timer.join()
+
+
+def test_fileno_readable_while_data_waits(loopback):
+    port = loopback.port('loopback')
+    connection = loopback.connect_source(port)
+    fd = loopback.fileno(connection)
+    assert select.select([fd], [], [], 0)[0] == []
+    port.inject([0xC0, 1])
+    assert select.select([fd], [], [], 0)[0] == [fd]
+    loopback.receive(connection, 0)
+    assert select.select([fd], [], [], 0)[0] == []
+
+
+def test_disconnected_connections_receive_nothing(loopback):
+    port = loopback.port('loopback')
+    connection = loopback.connect_source(port)
+    loopback.disconnect(connection)
+    port.inject([0xC0, 1])
+    assert not loopback.receive(connection, 0)
+
+
+def test_setup_generation_changes(loopback):
+    generation = loopback.setup_generation()
+    port = loopback.create_port('new')
+    assert loopback.setup_generation() != generation
+    generation = loopback.setup_generation()
+    loopback.remove_port(port)
+    assert loopback.setup_generation() != generation
+    with pytest.raises(KeyError):
+        loopback.port('new')
+
+
+def test_endpoints_through_the_backend(loopback):
+    loopback.create_port('other')
+    source = MIDISource('other', loopback.port('other'))
+    destination = MIDIDestination('other', loopback.port('other'))
+    source.receive(timeout=0)
+    destination.send_bytes((0xB0, 7, 100))
+    message = source.receive(timeout=0)
+    assert (message.channel, message.control, message.value) == (0, 7, 100)
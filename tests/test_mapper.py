@@ -0,0 +1,222 @@
+import json
+import threading
+import time
+
+import pytest
+
+from simplecoremidi import Message, MIDISource
+from simplecoremidi.clock import monotonic
+from simplecoremidi.scheduler import Scheduler
+from mapper import (ActionPool, Change, Compare, Controller, LongPress, MIDIMapper, Note, Program, Send, Tap, Trigger,
+                    TriggerState)
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = Scheduler('test mapper scheduler')
+    yield scheduler
+    scheduler.stop()
+
+
+@pytest.fixture
+def output(loopback):
+    """a source reading what mappers send to the 'out' port. Mappers read from the 'in' port."""
+    loopback.create_port('in')
+    loopback.create_port('out')
+    output = MIDISource('out', loopback.port('out'))
+    output.receive(timeout=0)
+    return output
+
+
+def message(*data):
+    return Message.parse_message(list(data))
+
+
+def sent(output, timeout=0):
+    return [bytes(bytearray(m.toBytes())) for m in output.receive_many(timeout=timeout)]
+
+
+def test_action_pool_runs_actions_on_a_worker():
+    pool = ActionPool()
+    done = threading.Event()
+    threads = []
+    pool.submit(lambda: (threads.append(threading.current_thread()), done.set()))
+    assert done.wait(2)
+    assert threads[0] is not threading.current_thread()
+
+
+def test_action_pool_drops_when_full():
+    pool = ActionPool(queue_size=1)
+    release = threading.Event()
+    started = threading.Event()
+    pool.submit(lambda: (started.set(), release.wait(2)))
+    assert started.wait(2)
+    assert pool.submit(lambda: None)
+    assert not pool.submit(lambda: None)
+    assert pool.dropped == 1
+    release.set()
+
+
+def test_a_tap_doesnt_block_the_receive_thread(output, scheduler):
+    mapper = MIDIMapper({Note(1): Note(5, duration=0.2)}, 'in', 'out', scheduler=scheduler)
+    mapper.handle(message(0x90, 1, 100))
+    assert sent(output) == []
+    # notes act when released
+    start = monotonic()
+    mapper.handle(message(0x80, 1, 0))
+    assert monotonic() - start < 0.1
+    assert sent(output) == [b'\x9f\x05\x64']
+    # the note off comes later, from the scheduler
+    assert sent(output, timeout=1) == [b'\x9f\x05\x00']
+    assert monotonic() - start >= 0.2
+
+
+def test_unmapped_messages_pass_through(output, scheduler):
+    mapper = MIDIMapper({Note(1): Program(4)}, 'in', 'out', scheduler=scheduler)
+    for data in ([0x90, 2, 100], [0xB3, 7, 1], [0xC0, 9], [0xF8]):
+        mapper.handle(message(*data))
+    assert sent(output) == [b'\x90\x02\x64', b'\xb3\x07\x01', b'\xc0\x09', b'\xf8']
+    assert (mapper.received, mapper.passed_through) == (4, 4)
+
+
+def test_mapped_on_every_channel(output, scheduler):
+    mapper = MIDIMapper({Controller(7): Program(4), Program(2): Program(5)}, 'in', 'out', scheduler=scheduler)
+    mapper.handle(message(0xB0, 7, 1))
+    mapper.handle(message(0xB9, 7, 1))
+    mapper.handle(message(0xC3, 2))
+    mapper.handle(message(0xC3, 3))
+    assert sent(output) == [b'\xcf\x04', b'\xcf\x04', b'\xcf\x05', b'\xc3\x03']
+    assert mapper.passed_through == 1
+
+
+def test_every_response_in_a_list_runs(output, scheduler):
+    mapper = MIDIMapper({Controller(7): [Program(4), Controller(8, 9)]}, 'in', 'out', scheduler=scheduler)
+    mapper.handle(message(0xB0, 7, 1))
+    assert sent(output) == [b'\xcf\x04', b'\xbf\x08\x09']
+
+
+def test_actions_must_be_keyed_by_input(output, scheduler):
+    with pytest.raises(TypeError):
+        MIDIMapper({'note': Program(4)}, 'in', 'out', scheduler=scheduler)
+
+
+def test_run_handles_messages_as_they_arrive(loopback, output, scheduler):
+    mapper = MIDIMapper({Controller(7): Program(4)}, 'in', 'out', scheduler=scheduler, merge=True)
+    runner = threading.Thread(target=mapper.run)
+    runner.daemon = True
+    runner.start()
+    # the loop connects to its source when it starts
+    time.sleep(0.05)
+    port = loopback.port('in')
+    for i in range(3):
+        start = monotonic()
+        port.inject([0xB0, 7, i, 0x90, 60, 100])
+        assert sent(output, timeout=1) == [b'\xcf\x04', b'\x90\x3c\x64']
+        # no polling interval between the message arriving and it being handled
+        assert monotonic() - start < 0.5
+    assert mapper.received == 6
+
+
+def test_trigger_state_tracks_held_notes():
+    state = TriggerState()
+    state.note_on(0, 60, 1.0)
+    state.note_on(15, 127, 1.5)
+    # a repeated note on doesn't restart the note
+    state.note_on(0, 60, 1.2)
+    assert state.active_notes() == [(0, 60), (15, 127)]
+    assert state.note_off(0, 60, 3.0) == 2.0
+    assert state.note_off(0, 60, 4.0) is None
+    assert state.active_notes() == [(15, 127)]
+
+
+def test_trigger_state_keeps_values_apart():
+    state = TriggerState()
+    assert state.swap_value('value', message(0xB0, 7, 1), 1) == TriggerState.UNKNOWN
+    assert state.swap_value('value', message(0xB0, 7, 2), 2) == 1
+    # another channel, controller or message type has a slot of its own
+    for data in ([0xB1, 7, 3], [0xB0, 8, 3], [0xA0, 7, 3], [0xE0, 7, 3]):
+        assert state.swap_value('value', message(*data), 3) == TriggerState.UNKNOWN
+    indexes = set(TriggerState.index(message(*data)) for data in
+                  ([0xB0, 7, 0], [0xB1, 7, 0], [0xB0, 8, 0], [0x90, 7, 0], [0xF8], [0xFA]))
+    assert len(indexes) == 6
+
+
+def test_trigger_state_doesnt_grow():
+    state = TriggerState()
+    for i in range(5000):
+        state.note_on(i % 16, i % 128, 1.0)
+        state.note_off(i % 16, i % 128, 2.0)
+        state.swap_value('value', message(0xB0 | (i % 16), i % 128, i % 128), i % 128)
+    assert len(state._values) == 1
+    assert len(state.note_on_times) == 2048
+
+
+def test_tap_and_long_press(output, scheduler):
+    mapper = MIDIMapper({Note(1): {Tap(): Program(1), LongPress(): Program(2)}}, 'in', 'out', scheduler=scheduler)
+    mapper.handle(message(0x90, 1, 100))
+    mapper.handle(message(0x80, 1, 0))
+    mapper.handle(message(0x90, 1, 100))
+    time.sleep(Trigger.LONG_PRESS_THRESHOLD + 0.05)
+    mapper.handle(message(0x90, 1, 0))
+    assert sent(output) == [b'\xcf\x01', b'\xcf\x02']
+    assert mapper.state.active_notes() == []
+
+
+def test_a_repeated_note_off_fires_nothing(output, scheduler):
+    mapper = MIDIMapper({Note(1): {Tap(): Program(1), LongPress(): Program(2)}}, 'in', 'out', scheduler=scheduler)
+    mapper.handle(message(0x90, 1, 100))
+    mapper.handle(message(0x80, 1, 0))
+    mapper.handle(message(0x80, 1, 0))
+    mapper.handle(message(0x90, 1, 0))
+    assert sent(output) == [b'\xcf\x01']
+
+
+def test_change_fires_only_on_new_values(output, scheduler):
+    mapper = MIDIMapper({Controller(7): {Change(): Send(channel=0)}}, 'in', 'out', scheduler=scheduler)
+    for value in (1, 1, 2, 2, 1):
+        mapper.handle(message(0xB3, 7, value))
+    assert sent(output) == [b'\xb0\x07\x01', b'\xb0\x07\x02', b'\xb0\x07\x01']
+
+
+def test_compare_fires_once_the_condition_has_held(output, scheduler):
+    trigger = Compare(lambda m: m.value > 100, duration=0.1)
+    mapper = MIDIMapper({Controller(7): {trigger: Program(9)}}, 'in', 'out', scheduler=scheduler)
+    threads = threading.active_count()
+    mapper.handle(message(0xB0, 7, 120))
+    mapper.handle(message(0xB0, 7, 125))
+    # timers are armed on the mapper's scheduler, not on threads of their own
+    assert threading.active_count() <= threads + 1
+    assert len(scheduler) == 1
+    assert sent(output) == []
+    assert sent(output, timeout=1) == [b'\xcf\x09']
+
+
+def test_compare_is_cancelled_when_the_condition_stops_holding(output, scheduler):
+    trigger = Compare(lambda m: m.value > 100, duration=0.1)
+    mapper = MIDIMapper({Controller(7): {trigger: Program(9)}}, 'in', 'out', scheduler=scheduler)
+    mapper.handle(message(0xB0, 7, 120))
+    mapper.handle(message(0xB0, 7, 10))
+    assert len(scheduler) == 0
+    time.sleep(0.15)
+    assert sent(output) == []
+
+
+def test_compare_without_a_duration_fires_at_once(output, scheduler):
+    mapper = MIDIMapper({Controller(7): {Compare(lambda m: m.value > 100): Program(9)}}, 'in', 'out',
+                        scheduler=scheduler)
+    mapper.handle(message(0xB0, 7, 10))
+    mapper.handle(message(0xB0, 7, 120))
+    assert sent(output) == [b'\xcf\x09']
+
+
+def test_stats(output, scheduler):
+    mapper = MIDIMapper({Controller(7): Program(4)}, 'in', 'out', scheduler=scheduler)
+    mapper.handle(message(0xB0, 7, 1))
+    mapper.handle(message(0xB0, 8, 1))
+    stats = mapper.stats()
+    assert (stats['received'], stats['passed_through']) == (2, 1)
+    assert stats['latency']['handle']['count'] == 2
+    assert stats['latency']['action']['count'] == 1
+    assert stats['destination']['messages'] == 2
+    assert [source['name'] for source in stats['sources']] == ['in']
+    json.dumps(stats)
@@ -0,0 +1,265 @@
+import json
+import os
+import time
+
+import pytest
+
+import mapping
+from mapper import Change, Compare, MIDIMapper, Note, Program, Send
+from simplecoremidi import Message, MIDISource
+from simplecoremidi.clock import monotonic
+from simplecoremidi.scheduler import Scheduler
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.abspath(mapping.__file__)), 'my_midi_mapper.json')
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(mapping.sys, 'platform', 'linux')
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    return tmp_path / 'cache' / 'simplecoremidi' / 'mappings'
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = Scheduler('test mapping scheduler')
+    yield scheduler
+    scheduler.stop()
+
+
+@pytest.fixture
+def output(loopback):
+    """a source reading what mappers send to the 'out' port. Mappers read from the 'in' port."""
+    loopback.create_port('in')
+    loopback.create_port('out')
+    output = MIDISource('out', loopback.port('out'))
+    output.receive(timeout=0)
+    return output
+
+
+def write(path, document):
+    with open(str(path), 'w') as f:
+        f.write(document if isinstance(document, str) else json.dumps(document))
+    return str(path)
+
+
+def read(path):
+    with open(str(path)) as f:
+        return f.read()
+
+
+def message(*data):
+    return Message.parse_message(list(data))
+
+
+def test_validate_expands_shorthands():
+    assert mapping.validate({'mappings': [
+        {'note': 1, 'do': {'note': 2}},
+        {'controller': 26, 'do': []},
+        {'program': 3, 'do': [{'program': 4}, {'controller': {'control': 7, 'value': 0}}]},
+        {'controller': 12, 'when': [
+            {'trigger': 'change', 'do': {'send': {'channel': 1}}},
+            {'trigger': {'compare': {'op': '>', 'value': 120, 'duration': 1.0}}, 'do': {'program': 5}}]},
+    ]}) == [
+        ['note', 1, 'action', ['note', {'number': 2}]],
+        ['controller', 26, 'do', []],
+        ['program', 3, 'do', [['program', {'program': 4}], ['controller', {'control': 7, 'value': 0}]]],
+        ['controller', 12, 'when', [
+            [['change', {}], ['send', {'channel': 1}]],
+            [['compare', {'op': '>', 'value': 120, 'duration': 1.0}], ['program', {'program': 5}]]]],
+    ]
+
+
+@pytest.mark.parametrize('document, where', [
+    ([], "mapping"),
+    ({'mappings': [{'do': []}]}, "mappings[0]"),
+    ({'mappings': [{'note': 1, 'controller': 2, 'do': []}]}, "mappings[0]"),
+    ({'mappings': [{'note': 128, 'do': []}]}, "mappings[0].note"),
+    ({'mappings': [{'note': True, 'do': []}]}, "mappings[0].note"),
+    ({'mappings': [{'note': 1, 'do': []}, {'note': 1, 'do': []}]}, "mappings[1]"),
+    ({'mappings': [{'note': 1}]}, "mappings[0]"),
+    ({'mappings': [{'note': 1, 'do': [], 'when': []}]}, "mappings[0]"),
+    ({'mappings': [{'note': 1, 'do': {'chord': 1}}]}, "mappings[0].do"),
+    ({'mappings': [{'note': 1, 'do': {'note': {'number': 2, 'loud': True}}}]}, "mappings[0].do.note"),
+    ({'mappings': [{'note': 1, 'do': {'note': {'velocity': 2}}}]}, "mappings[0].do.note"),
+    ({'mappings': [{'note': 1, 'do': {'note': {'number': 2, 'toggle': 1}}}]}, "mappings[0].do.note.toggle"),
+    ({'mappings': [{'note': 1, 'do': [{'note': 2}, {'program': -1}]}]}, "mappings[0].do[1].program.program"),
+    ({'mappings': [{'note': 1, 'do': {'send': {'channel': 16}}}]}, "mappings[0].do.send.channel"),
+    ({'mappings': [{'note': 1, 'do': {'send': {'velocty': 3}}}]}, "mappings[0].do.send"),
+    ({'mappings': [{'note': 1, 'do': {'send': {'value': 3}}}]}, "mappings[0].do.send"),
+    ({'mappings': [{'program': 1, 'do': [{'send': {'number': 3}}]}]}, "mappings[0].do[0].send"),
+    ({'mappings': [{'controller': 1, 'when': [{'trigger': 'change', 'do': {'send': {'message_type': 0x90}}}]}]},
+     "mappings[0].when[0].do.send"),
+    ({'mappings': [{'controller': 1, 'do': {'send': {'value': 128}}}]}, "mappings[0].do.send.value"),
+    ({'mappings': [{'note': 1, 'when': {}}]}, "mappings[0].when"),
+    ({'mappings': [{'note': 1, 'when': [{'trigger': 'tap'}]}]}, "mappings[0].when[0]"),
+    ({'mappings': [{'note': 1, 'when': [{'trigger': 'hold', 'do': {'note': 2}}]}]}, "mappings[0].when[0].trigger"),
+    ({'mappings': [{'controller': 1, 'when': [{'trigger': {'compare': {'op': '~', 'value': 1}}, 'do': {'note': 2}}]}]},
+     "mappings[0].when[0].trigger.compare.op"),
+    ({'mappings': [{'controller': 1, 'when': [{'trigger': {'compare': {'op': '<'}}, 'do': {'note': 2}}]}]},
+     "mappings[0].when[0].trigger.compare"),
+])
+def test_validation_errors_say_where(document, where):
+    with pytest.raises(mapping.MappingError) as raised:
+        mapping.validate(document)
+    assert str(raised.value).startswith(where + ": ")
+
+
+def test_send_attributes_depend_on_the_input():
+    assert mapping.validate({'mappings': [
+        {'note': 1, 'do': {'send': {'channel': 15, 'number': 127, 'velocity': 0}}},
+        {'program': 1, 'do': {'send': {'program': 127}}},
+        {'controller': 1, 'do': {'send': {'control': 0, 'value': 127}}},
+    ]})[0] == ['note', 1, 'action', ['send', {'channel': 15, 'number': 127, 'velocity': 0}]]
+
+
+def test_a_send_replaces_attributes_of_the_message_received(output, scheduler):
+    actions = mapping.build_actions({'mappings': [
+        {'note': 1, 'do': {'send': {'number': 2, 'velocity': 64}}},
+        {'controller': 7, 'do': {'send': {'control': 8, 'channel': 2}}},
+    ]})
+    mapper = MIDIMapper(actions, 'in', 'out', scheduler=scheduler)
+    mapper.handle(message(0x90, 1, 100))
+    mapper.handle(message(0xB0, 7, 99))
+    assert [m.toBytes() for m in output.receive_many(timeout=0)] == [b'\x90\x02\x40', b'\xb2\x08\x63']
+
+
+def test_build():
+    actions = mapping.build_actions({'mappings': [
+        {'note': 1, 'do': {'note': {'number': 2, 'toggle': True}}},
+        {'program': 3, 'do': [{'program': 4}]},
+        {'controller': 12, 'when': [
+            {'trigger': 'change', 'do': {'send': {'channel': 1}}},
+            {'trigger': {'compare': {'op': '>', 'value': 120}}, 'do': {'program': 5}}]},
+    ]})
+    note = actions[Note(1)]
+    assert isinstance(note, Note) and (note.number, note.toggle) == (2, True)
+    program, = actions[Program(3)]
+    assert isinstance(program, Program) and program.program == 4
+    triggers = dict((type(trigger), (trigger, action)) for trigger, action in actions[mapping.Controller(12)].items())
+    change, send = triggers[Change]
+    assert isinstance(send, Send) and send.kwargs == {'channel': 1}
+    compare, program = triggers[Compare]
+    assert compare.predicate(message(0xB0, 12, 121)) and not compare.predicate(message(0xB0, 12, 120))
+    assert program.program == 5
+
+
+def test_the_example_mapping_builds():
+    with open(EXAMPLE) as f:
+        document = json.load(f)
+    assert len(mapping.build_actions(document)) == len(document['mappings'])
+
+
+def test_cache_directory(monkeypatch, tmp_path):
+    monkeypatch.setattr(mapping.sys, 'platform', 'darwin')
+    assert mapping.cache_directory() == os.path.expanduser('~/Library/Caches/simplecoremidi/mappings')
+    monkeypatch.setattr(mapping.sys, 'platform', 'linux')
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    assert mapping.cache_directory() == str(tmp_path / 'simplecoremidi' / 'mappings')
+    monkeypatch.delenv('XDG_CACHE_HOME')
+    assert mapping.cache_directory() == os.path.expanduser('~/.cache/simplecoremidi/mappings')
+
+
+def test_load_caches_the_validated_mapping(cache, tmp_path, monkeypatch):
+    path = write(tmp_path / 'song.json', {'mappings': [{'note': 1, 'do': {'note': 2}}]})
+    assert list(mapping.load(path)) == [Note(1)]
+    cached, = [json.loads(read(cache / name)) for name in os.listdir(str(cache))]
+    assert cached['mappings'] == [['note', 1, 'action', ['note', {'number': 2}]]]
+
+    def validate(document):
+        raise AssertionError("validated again")
+    monkeypatch.setattr(mapping, 'validate', validate)
+    assert mapping.load(path)[Note(1)].number == 2
+
+
+def test_a_changed_file_is_validated_again(cache, tmp_path):
+    path = write(tmp_path / 'song.json', {'mappings': [{'note': 1, 'do': {'note': 2}}]})
+    mapping.load(path)
+    write(tmp_path / 'song.json', {'mappings': [{'note': 1, 'do': {'note': 3}}]})
+    assert mapping.load(path)[Note(1)].number == 3
+    write(tmp_path / 'song.json', {'mappings': [{'note': 1, 'do': {'note': 300}}]})
+    with pytest.raises(mapping.MappingError):
+        mapping.load(path)
+
+
+@pytest.mark.parametrize('damage', [
+    '', '{"key": ', '[]', '{"key": null, "mappings": []}', '{"mappings": [["note", 1, "action"]]}'])
+def test_a_damaged_cache_is_ignored(cache, tmp_path, damage):
+    path = write(tmp_path / 'song.json', {'mappings': [{'note': 1, 'do': {'note': 2}}]})
+    mapping.load(path)
+    cache_file, = [cache / name for name in os.listdir(str(cache))]
+    write(cache_file, damage)
+    assert mapping.load(path)[Note(1)].number == 2
+    # and replaced
+    assert json.loads(read(cache_file))['mappings'] == [['note', 1, 'action', ['note', {'number': 2}]]]
+
+
+def test_a_cache_written_with_a_different_key_is_ignored(cache, tmp_path):
+    path = write(tmp_path / 'song.json', {'mappings': [{'note': 1, 'do': {'note': 2}}]})
+    mapping.load(path)
+    cache_file, = [cache / name for name in os.listdir(str(cache))]
+    cached = json.loads(read(cache_file))
+    cached['key'][0] -= 1
+    cached['mappings'] = [['note', 1, 'action', ['note', {'number': 5}]]]
+    write(cache_file, cached)
+    assert mapping.load(path)[Note(1)].number == 2
+
+
+def test_load_without_a_cache(cache, tmp_path):
+    path = write(tmp_path / 'song.json', {'mappings': []})
+    assert mapping.load(path, cache=False) == {}
+    assert not cache.exists()
+
+
+def test_invalid_json(cache, tmp_path):
+    path = write(tmp_path / 'song.json', '{"mappings": [')
+    with pytest.raises(mapping.MappingError) as raised:
+        mapping.load(path)
+    assert str(raised.value).startswith(path)
+
+
+def wait_for(condition, timeout=2):
+    deadline = monotonic() + timeout
+    while not condition() and monotonic() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+
+def test_watcher_reloads_changed_files(cache, tmp_path):
+    path = write(tmp_path / 'song.json', {'mappings': [{'note': 1, 'do': {'note': 2}}]})
+    loaded = []
+    watcher = mapping.MappingWatcher(path, loaded.append, interval=0.01)
+    try:
+        time.sleep(0.05)
+        assert loaded == []
+        # a file that doesn't load is skipped
+        write(tmp_path / 'song.json', {'mappings': [{'note': 1, 'do': {'note': 200}}]})
+        time.sleep(0.05)
+        assert loaded == []
+        write(tmp_path / 'song.json', {'mappings': [{'note': 1, 'do': {'note': 3}}, {'note': 4, 'do': []}]})
+        assert wait_for(lambda: loaded)
+        assert sorted(note.number for note in loaded[-1]) == [1, 4]
+    finally:
+        watcher.stop()
+
+
+def test_hot_swap_keeps_toggled_notes(output, cache, tmp_path, scheduler):
+    def toggle(number):
+        return {'mappings': [{'note': 1, 'when': [{'trigger': 'tap', 'do': {'note': {'number': number,
+                                                                                       'toggle': True}}}]}]}
+    path = write(tmp_path / 'song.json', toggle(3))
+    mapper = MIDIMapper(mapping.load(path), 'in', 'out', scheduler=scheduler)
+    watcher = mapping.MappingWatcher(path, mapper.swap_actions, interval=0.01)
+    try:
+        mapper.handle(message(0x90, 1, 100))
+        mapper.handle(message(0x80, 1, 0))
+        assert [m.toBytes() for m in output.receive_many(timeout=0)] == [b'\x9f\x03\x64']
+        # a toggle of the same note, as another song's mapping might have
+        write(tmp_path / 'song.json', json.dumps(toggle(3)) + ' ')
+        assert wait_for(lambda: mapper._staged is not None)
+        mapper.handle(message(0x90, 1, 100))
+        mapper.handle(message(0x80, 1, 0))
+        # it was on, so it goes off
+        assert [m.toBytes() for m in output.receive_many(timeout=0)] == [b'\x9f\x03\x00']
+    finally:
+        watcher.stop()
@@ -0,0 +1,108 @@
+import pytest
+
+from simplecoremidi import Message, NoteOnMessage
+
+
+def test_parsed_messages_are_interned():
+    first = Message.parse_message([0x90, 60, 100])
+    assert Message.parse_message(bytearray([0x90, 60, 100])) is first
+    assert Message.parse_message([0x90, 60, 101]) is not first
+
+
+def test_parse_ignores_bytes_past_the_message():
+    assert Message.parse_message([0xC0, 5, 6, 7]) is Message.parse_message([0xC0, 5])
+
+
+def test_interning_is_bounded():
+    interned = Message._interned
+    limit = Message.INTERN_LIMIT
+    try:
+        Message._interned = {}
+        Message.INTERN_LIMIT = 2
+        for value in range(5):
+            Message.parse_message([0xB0, 7, value])
+        assert len(Message._interned) == 2
+        assert Message.parse_message([0xB0, 7, 4]).value == 4
+    finally:
+        Message._interned = interned
+        Message.INTERN_LIMIT = limit
+
+
+def test_messages_have_no_dict():
+    message = NoteOnMessage(0, 60, 100)
+    assert not hasattr(message, '__dict__')
+    with pytest.raises(AttributeError):
+        message.colour = 'red'
+
+
+def test_to_bytes_is_encoded_once():
+    message = NoteOnMessage(1, 60, 100)
+    data = message.toBytes()
+    assert data == b'\x91\x3c\x64'
+    assert message.toBytes() is data
+    # parsed messages keep the bytes they were parsed from
+    parsed = Message.parse_message([0x91, 60, 100])
+    assert parsed.toBytes() == data
+
+
+@pytest.mark.parametrize('data, message_class, fields', [
+    ([0x81, 60, 64], 'NoteOffMessage', dict(channel=1, number=60, velocity=64)),
+    ([0x92, 60, 100], 'NoteOnMessage', dict(channel=2, number=60, velocity=100)),
+    ([0xA3, 60, 20], 'PolyAftertouchMessage', dict(channel=3, number=60, pressure=20)),
+    ([0xB4, 7, 127], 'ControllerChangeMessage', dict(channel=4, control=7, value=127)),
+    ([0xC5, 12], 'ProgramChangeMessage', dict(channel=5, program=12)),
+    ([0xD6, 90], 'ChannelAftertouchMessage', dict(channel=6, pressure=90)),
+    ([0xE7, 0x01, 0x40], 'PitchBendMessage', dict(channel=7, value=0x2001)),
+    ([0xF0, 0x7E, 0x01, 0xF7], 'SysExMessage', dict(channel=None, data=b'\x7e\x01')),
+    ([0xF1, 0x35], 'MTCQuarterFrameMessage', dict(channel=None, piece=3, value=5)),
+    ([0xF2, 0x10, 0x02], 'SongPositionMessage', dict(channel=None, position=0x110)),
+    ([0xF3, 9], 'SongSelectMessage', dict(channel=None, song=9)),
+    ([0xF6], 'TuneRequestMessage', dict(channel=None)),
+    ([0xF8], 'RealtimeMessage', dict(channel=None, message_type=0xF8)),
+    ([0xFF], 'RealtimeMessage', dict(channel=None, message_type=0xFF)),
+    ([0xF4], 'UnknownMessage', dict()),
+])
+def test_every_message_type_round_trips(data, message_class, fields):
+    message = Message.parse_message(data)
+    assert type(message).__name__ == message_class
+    for name, value in fields.items():
+        assert getattr(message, name) == value
+    assert message.toBytes() == bytes(bytearray(data))
+    # a fresh message, encoded from its fields rather than the bytes it was parsed from
+    assert message.replace().toBytes() == bytes(bytearray(data))
+    str(message)
+
+
+def test_pitch_bend_is_relative_to_the_centre():
+    assert Message.parse_message([0xE0, 0, 0x40]).bend == 0
+    assert Message.parse_message([0xE0, 0, 0]).bend == -0x2000
+
+
+def test_fields_are_read_only():
+    message = Message.parse_message([0xB0, 7, 100])
+    with pytest.raises(AttributeError):
+        message.value = 5
+    assert message.toBytes() == b'\xb0\x07\x64'
+
+
+def test_replace_returns_a_modified_copy():
+    message = Message.parse_message([0xB0, 7, 100])
+    louder = message.replace(value=127, channel=2)
+    assert louder.toBytes() == b'\xb2\x07\x7f'
+    assert message.toBytes() == b'\xb0\x07\x64'
+    with pytest.raises(TypeError):
+        message.replace(colour='red')
+
+
+def test_equality_and_hashing():
+    parsed = Message.parse_message([0x90, 60, 100])
+    built = NoteOnMessage(0, 60, 100)
+    assert parsed == built and not parsed != built
+    assert hash(parsed) == hash(built)
+    assert parsed != NoteOnMessage(0, 60, 99)
+    assert parsed != 'a string'
+    assert parsed != None
+    # messages that can't be encoded yet are compared by their fields
+    assert NoteOnMessage() == NoteOnMessage()
+    assert NoteOnMessage() != NoteOnMessage(channel=1)
+    assert len(set([NoteOnMessage(), NoteOnMessage()])) == 1
@@ -0,0 +1,87 @@
+import random
+
+import pytest
+
+from simplecoremidi import MIDISource, Message
+from simplecoremidi.parser import MIDIParser
+
+numpy = pytest.importorskip('numpy')
+from simplecoremidi import npcodec  # noqa: E402
+
+
+def rows(events):
+    return [tuple(int(event[field]) for field in npcodec.EVENT_FIELDS[1:]) for event in events]
+
+
+def test_decode():
+    data = bytearray([0x90, 60, 100, 62, 101,     # running status
+                      0xC3, 5,                    # one data byte
+                      0xF0, 1, 2, 3, 0xF7,        # SysEx is skipped
+                      0xB1, 7, 0xF8, 64,          # a realtime byte within a message
+                      0xF2, 1, 2,                 # song position
+                      0xF6])                      # tune request
+    assert rows(npcodec.decode(data)) == [
+        (0x90, 0, 60, 100),
+        (0x90, 0, 62, 101),
+        (0xC0, 3, 5, 0),
+        (0xF8, 0, 0, 0),
+        (0xB0, 1, 7, 64),
+        (0xF2, 0, 1, 2),
+        (0xF6, 0, 0, 0),
+    ]
+
+
+def test_decode_empty():
+    assert len(npcodec.decode(b'')) == 0
+    assert npcodec.encode(npcodec.decode(b'')) == b''
+
+
+def test_timestamps_come_from_the_packet_holding_the_last_byte():
+    data = bytearray([0x90, 60, 100, 0x80, 60, 0])
+    events = npcodec.decode(data, [(0, 1.0), (2, 2.0), (4, 3.0)])
+    assert list(events['timestamp']) == [2.0, 3.0]
+    assert list(npcodec.decode(data, timestamp=5.0)['timestamp']) == [5.0, 5.0]
+
+
+@pytest.mark.parametrize('running_status', [False, True])
+def test_encode_round_trip(running_status):
+    data = bytearray([0x90, 60, 100, 0x90, 62, 101, 0xC3, 5, 0xF8, 0xB1, 7, 64, 0xF2, 1, 2, 0xB1, 7, 65])
+    events = npcodec.decode(data)
+    encoded = npcodec.encode(events, running_status=running_status)
+    assert rows(npcodec.decode(encoded)) == rows(events)
+    if running_status:
+        # the second note, and the controller after the realtime byte, share their status
+        assert encoded == bytes(bytearray([0x90, 60, 100, 62, 101, 0xC3, 5, 0xF8, 0xB1, 7, 64, 0xF2, 1, 2,
+                                           0xB1, 7, 65]))
+    else:
+        assert encoded == bytes(data)
+
+
+def test_matches_the_parser():
+    rng = random.Random(1234)
+    statuses = [0x80, 0x93, 0xA0, 0xB5, 0xC0, 0xDF, 0xE2, 0xF1, 0xF2, 0xF3, 0xF6, 0xF8, 0xFE]
+    data = bytearray([0x90])
+    for i in range(5000):
+        choice = rng.random()
+        if choice < 0.2:
+            data.append(rng.choice(statuses))
+        elif choice < 0.22:
+            data.extend([0xF0, rng.randrange(128), 0xF7])
+        else:
+            data.append(rng.randrange(128))
+    parsed = [Message.parse_message(m) for m in MIDIParser().feed(data)]
+    parsed = [bytearray(m.toBytes()) for m in parsed if not m.toBytes().startswith(b'\xf0')]
+    decoded = npcodec.encode(npcodec.decode(data))
+    assert decoded == b''.join(bytes(m) for m in parsed)
+
+
+def test_message_and_source_entry_points(loopback):
+    port = loopback.port('loopback')
+    source = MIDISource('loopback', port)
+    assert source.receive_array(timeout=0) is None
+    port.inject((0x90, 60, 100))
+    port.inject((0x80, 60, 0))
+    events = source.receive_array(timeout=0)
+    assert rows(events) == [(0x90, 0, 60, 100), (0x80, 0, 60, 0)]
+    assert events['timestamp'][0] <= events['timestamp'][1]
+    assert Message.encode_array(Message.decode_array(b'\x90\x3c\x64')) == b'\x90\x3c\x64'
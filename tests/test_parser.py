@@ -0,0 +1,68 @@
+from simplecoremidi import MIDISource
+from simplecoremidi.parser import MIDIParser, data_length
+
+
+def test_running_status():
+    parser = MIDIParser()
+    assert parser.feed([0x90, 60, 100, 62, 100, 64, 0]) == [[0x90, 60, 100], [0x90, 62, 100], [0x90, 64, 0]]
+
+
+def test_messages_split_across_reads():
+    parser = MIDIParser()
+    assert parser.feed([0xB0, 7]) == []
+    assert parser.feed([127, 0xC0]) == [[0xB0, 7, 127]]
+    assert parser.feed([5]) == [[0xC0, 5]]
+
+
+def test_realtime_interleaved_mid_message():
+    parser = MIDIParser()
+    assert parser.feed([0x90, 60, 0xF8, 100, 0xFA]) == [[0xF8], [0x90, 60, 100], [0xFA]]
+    # and the running status survives it
+    assert parser.feed([61, 100]) == [[0x90, 61, 100]]
+
+
+def test_system_common_cancels_running_status():
+    parser = MIDIParser()
+    assert parser.feed([0x90, 60, 100, 0xF3, 4, 61, 100]) == [[0x90, 60, 100], [0xF3, 4]]
+    assert parser.discarded == 2
+
+
+def test_status_only_messages():
+    parser = MIDIParser()
+    assert parser.feed([0xF6, 0xF8]) == [[0xF6], [0xF8]]
+    assert data_length(0xF6) == 0
+    assert data_length(0xF0) is None
+
+
+def test_sysex_split_across_reads():
+    parser = MIDIParser()
+    assert parser.feed([0xF0, 0x7E, 1]) == []
+    assert parser.feed([2, 3, 0xF7, 0xC0, 1]) == [[0xF0, 0x7E, 1, 2, 3, 0xF7], [0xC0, 1]]
+
+
+def test_sysex_ended_by_another_status():
+    parser = MIDIParser()
+    assert parser.feed([0xF0, 1, 2, 0x90, 60, 100]) == [[0xF0, 1, 2, 0xF7], [0x90, 60, 100]]
+
+
+def test_stray_data_discarded():
+    parser = MIDIParser()
+    assert parser.feed([1, 2, 0xF7, 3]) == []
+    assert parser.discarded == 3
+
+
+def test_reset_forgets_partial_message():
+    parser = MIDIParser()
+    parser.feed([0x90, 60])
+    parser.reset()
+    assert parser.feed([100]) == []
+
+
+def test_receive_returns_every_message_in_a_burst(loopback):
+    port = loopback.port('loopback')
+    source = MIDISource('loopback', port)
+    source.receive(timeout=0)
+    port.inject([0x90, 60, 100, 62, 100, 0xB0, 7, 127])
+    received = [source.receive(timeout=0) for i in range(3)]
+    assert [m.toBytes() for m in received] == [b'\x90\x3c\x64', b'\x90\x3e\x64', b'\xb0\x07\x7f']
+    assert source.receive(timeout=0) is None
@@ -0,0 +1,95 @@
+import threading
+
+import pytest
+
+from simplecoremidi import MIDISource, clock
+
+
+def test_receive_packets_returns_bytes_and_arrival_times(loopback):
+    port = loopback.port('loopback')
+    source = MIDISource('loopback', port)
+    assert source.receive_packets(timeout=0) is None
+    before = clock.monotonic()
+    port.inject([0x90, 60, 100])
+    port.inject([0xB0, 7, 127, 10, 64])
+    after = clock.monotonic()
+    data, packets = source.receive_packets(timeout=0)
+    assert bytes(data) == b'\x90\x3c\x64\xb0\x07\x7f\x0a\x40'
+    assert [offset for offset, timestamp in packets] == [0, 3]
+    for offset, timestamp in packets:
+        assert before <= timestamp <= after
+
+
+def test_receive_records_arrival_and_stats(loopback):
+    port = loopback.port('loopback')
+    source = MIDISource('loopback', port)
+    source.receive(timeout=0)
+    before = clock.monotonic()
+    port.inject([0x90, 60, 100, 62, 100])
+    assert len(source.receive_many(timeout=0)) == 2
+    assert before <= source.last_arrival <= clock.monotonic()
+    assert (source.stats.messages, source.stats.bytes, source.stats.batches) == (2, 5, 1)
+    assert source.stats.latency.count == 1
+
+
+def test_receive_many_waits_for_a_timeout(loopback):
+    source = MIDISource('loopback', loopback.port('loopback'))
+    start = clock.monotonic()
+    assert source.receive_many(timeout=0.05) == []
+    assert clock.monotonic() - start >= 0.04
+
+
+def test_monotonic_never_goes_back():
+    times = [clock.monotonic() for i in range(1000)]
+    assert times == sorted(times)
+
+
+@pytest.mark.parametrize('timeout', [0.02, 0.15, 0.3])
+def test_fractional_timeouts_are_kept(loopback, timeout):
+    source = MIDISource('loopback', loopback.port('loopback'))
+    start = clock.monotonic()
+    assert source.receive(timeout=timeout) is None
+    waited = clock.monotonic() - start
+    # not truncated to whole seconds, either way
+    assert timeout * 0.9 <= waited < timeout + 0.5
+
+
+def test_a_wait_ends_when_data_arrives(loopback):
+    port = loopback.port('loopback')
+    source = MIDISource('loopback', port)
+    source.receive(timeout=0)
+    timer = threading.Timer(0.05, port.inject, [(0x90, 60, 100)])
+    timer.start()
+    start = clock.monotonic()
+    try:
+        assert source.receive(timeout=5).toBytes() == b'\x90\x3c\x64'
+    finally:
+        timer.join()
+    assert clock.monotonic() - start < 1
+
+
+def test_other_threads_run_while_receive_waits(loopback):
+    source = MIDISource('loopback', loopback.port('loopback'))
+    stop = threading.Event()
+    counted = [0]
+
+    def count():
+        while not stop.is_set():
+            counted[0] += 1
+    counter = threading.Thread(target=count)
+    counter.start()
+    try:
+        source.receive(timeout=0.1)
+        assert counted[0] > 0
+    finally:
+        stop.set()
+        counter.join()
+
+
+def test_coremidi_timeouts():
+    pytest.importorskip('simplecoremidi._simplecoremidi')
+    from simplecoremidi.backends.coremidi import _timeout
+    assert _timeout(None) == -1.0
+    assert _timeout(0) == 0.0
+    assert _timeout(0.25) == 0.25
+    assert isinstance(_timeout(2), float)
@@ -0,0 +1,126 @@
+import pytest
+
+from simplecoremidi import MIDIDestination, MIDISource, backends, registry
+from simplecoremidi.backends.loopback import LoopbackBackend
+from simplecoremidi.hub import MIDIHub
+
+
+class ReplugBackend(LoopbackBackend):
+    """identifies ports by name, as CoreMIDI does devices by unique id, so a port recreated under its old name is
+    the same endpoint with a new ref"""
+
+    def endpoint_id(self, ref):
+        return ref.name
+
+
+class UnversionedBackend(LoopbackBackend):
+    """can't report setup changes"""
+
+    def setup_generation(self):
+        return None
+
+
+@pytest.fixture
+def replug(loopback):
+    return backends.set_backend(ReplugBackend())
+
+
+def replug_port(backend, name):
+    backend.remove_port(backend.port(name))
+    return backend.create_port(name)
+
+
+def test_listings_are_cached_until_the_setup_changes(loopback):
+    reg = registry.get_registry()
+    sources = MIDISource.list()
+    destinations = MIDIDestination.list()
+    assert [s.name for s in sources] == [d.name for d in destinations] == ['loopback']
+    assert MIDISource.list() == sources and MIDISource.list()[0] is sources[0]
+    assert reg.scans == 1
+
+    loopback.create_port('other')
+    listed = MIDISource.list()
+    assert reg.scans == 2
+    assert [s.name for s in listed] == ['loopback', 'other']
+    assert listed[0] is sources[0]
+    assert MIDIDestination.list()[0] is destinations[0]
+
+
+def test_a_registry_per_backend(loopback):
+    first = registry.get_registry()
+    assert registry.get_registry() is first
+    backends.set_backend('loopback')
+    assert registry.get_registry() is not first
+
+
+def test_invalidate_forces_a_rescan(loopback):
+    reg = registry.get_registry()
+    reg.sources()
+    reg.invalidate()
+    reg.sources()
+    assert reg.scans == 2
+
+
+def test_backends_without_a_generation_rescan_but_keep_their_objects(loopback):
+    backends.set_backend(UnversionedBackend())
+    reg = registry.get_registry()
+    first = reg.sources()
+    assert reg.sources()[0] is first[0]
+    assert reg.scans == 2
+
+
+def test_find_by_substring(loopback):
+    loopback.create_port('nanoKONTROL2')
+    loopback.create_port('FCB1010')
+    reg = registry.get_registry()
+    assert [s.name for s in reg.find_sources('KONTROL')] == ['nanoKONTROL2']
+    assert [d.name for d in reg.find_destinations('o')] == ['loopback', 'nanoKONTROL2']
+    assert reg.find_sources('missing') == []
+    # lookups are cached, but not across a rescan
+    loopback.create_port('nanoKONTROL Studio')
+    assert [s.name for s in reg.find_sources('KONTROL')] == ['nanoKONTROL2', 'nanoKONTROL Studio']
+
+
+def test_vanished_endpoints_are_closed(loopback):
+    port = loopback.create_port('gone')
+    source, = registry.get_registry().find_sources('gone')
+    source.receive(timeout=0)
+    assert port._connections
+    loopback.remove_port(port)
+    assert [s.name for s in MIDISource.list()] == ['loopback']
+    assert not port._connections
+
+
+def test_recreated_endpoints_are_rebound(replug):
+    source, = MIDISource.list()
+    destination, = MIDIDestination.list()
+    source.receive(timeout=0)
+    connections = source._connections
+    port = replug_port(replug, 'loopback')
+    assert MIDISource.list() == [source]
+    assert source._connections > connections
+    destination.send((0x90, 60, 100))
+    port.inject((0x90, 62, 100))
+    assert [m.toBytes() for m in source.receive_many(timeout=0)] == [b'\x90\x3c\x64', b'\x90\x3e\x64']
+
+
+def test_rebinding_keeps_the_buffer_setting(replug):
+    source, = MIDISource.list()
+    source.set_buffer(3, 'drop-newest')
+    source.receive(timeout=0)
+    port = replug_port(replug, 'loopback')
+    MIDISource.list()
+    port.inject((0x90, 60, 100))
+    port.inject((0x90, 62, 100))
+    assert [m.toBytes() for m in source.receive_many(timeout=0)] == [b'\x90\x3c\x64']
+
+
+def test_a_hub_follows_rebound_sources(replug):
+    source, = MIDISource.list()
+    hub = MIDIHub([source])
+    port = replug_port(replug, 'loopback')
+    MIDISource.list()
+    port.inject((0x90, 60, 100))
+    (received, messages), = hub.receive(timeout=1)
+    assert received is source
+    assert [m.toBytes() for m in messages] == [b'\x90\x3c\x64']
@@ -0,0 +1,81 @@
+import pytest
+
+import router
+from mapper import ActionPool, Note, Program
+from simplecoremidi import MIDISource, backends
+from simplecoremidi.scheduler import Scheduler
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = Scheduler('test router scheduler')
+    yield scheduler
+    scheduler.stop()
+
+
+@pytest.fixture
+def ports(loopback):
+    """the 'in' port routes read from, and sources reading what they send to 'out1' and 'out2'"""
+    port = loopback.create_port('in')
+    outputs = []
+    for name in ('out1', 'out2'):
+        output = MIDISource(name, loopback.create_port(name))
+        output.receive(timeout=0)
+        outputs.append(output)
+    return port, outputs
+
+
+def sent(output):
+    return [m.toBytes() for m in output.receive_many(timeout=0)]
+
+
+def test_routes_sharing_a_source(ports, scheduler):
+    port, (out1, out2) = ports
+    r = router.MIDIRouter(scheduler=scheduler, pool=ActionPool())
+    first = r.add_route({}, 'in', 'out1')
+    second = r.add_route({Note(1): Program(5)}, 'in', 'out2')
+    assert len(r.hub) == 1
+    port.inject((0x90, 1, 100))
+    port.inject((0x80, 1, 0))
+    r.handle_ready(timeout=1)
+    # the first route passes everything through, the second maps note 1 on and off alike
+    assert sent(out1) == [b'\x90\x01\x64', b'\x80\x01\x00']
+    assert sent(out2) == [b'\xcf\x05', b'\xcf\x05']
+    assert first.received == second.received == 2
+    assert [route['route'] for route in r.stats()['routes']] == ['in -> out1', 'in -> out2']
+
+
+def test_removing_routes(ports, scheduler):
+    port, (out1, out2) = ports
+    r = router.MIDIRouter(scheduler=scheduler, pool=ActionPool())
+    first = r.add_route({}, 'in', 'out1')
+    second = r.add_route({}, 'in', 'out2')
+    r.remove_route(first)
+    assert len(r.hub) == 1
+    port.inject((0x90, 1, 100))
+    r.handle_ready(timeout=1)
+    assert (sent(out1), sent(out2)) == ([], [b'\x90\x01\x64'])
+    r.remove_route(second)
+    assert len(r.hub) == 0 and r.routes == []
+
+
+def test_unknown_endpoints(ports, scheduler):
+    r = router.MIDIRouter(scheduler=scheduler, pool=ActionPool())
+    with pytest.raises(router.EndpointError):
+        r.add_route({}, 'nowhere', 'out1')
+    assert r.routes == []
+
+
+def test_workers_refuse_to_fork_a_connected_process(loopback):
+    with pytest.raises(RuntimeError):
+        router.serve_workers([('in', 'out1', 'song.json')], 2, 'loopback')
+
+
+def test_failing_workers_are_reported(monkeypatch, tmp_path, capsys):
+    monkeypatch.setattr(backends, '_backend', None)
+    missing = str(tmp_path / 'missing.json')
+    status = router.serve_workers([('a', 'b', missing), ('c', 'd', missing)], 2, 'loopback')
+    assert status == 2
+    err = capsys.readouterr().err
+    assert "MIDIRouter worker 0 (a -> b) exited with status 2" in err
+    assert "MIDIRouter worker 1 (c -> d) exited with status 2" in err
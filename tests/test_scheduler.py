@@ -0,0 +1,117 @@
+import random
+import threading
+import time
+
+import pytest
+
+from simplecoremidi.clock import monotonic
+from simplecoremidi.scheduler import Scheduler
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = Scheduler('test scheduler')
+    yield scheduler
+    scheduler.stop()
+
+
+def wait_for(condition, timeout=2):
+    deadline = monotonic() + timeout
+    while not condition() and monotonic() < deadline:
+        time.sleep(0.001)
+    return condition()
+
+
+def test_calls_run_in_time_order(scheduler):
+    fired = []
+    now = monotonic()
+    for delay in (0.03, 0.01, 0.02):
+        scheduler.call_at(now + delay, fired.append, delay)
+    assert len(scheduler) == 3
+    assert wait_for(lambda: len(fired) == 3)
+    assert fired == [0.01, 0.02, 0.03]
+    assert len(scheduler) == 0
+
+
+def test_calls_wait_for_their_time(scheduler):
+    fired = []
+    start = monotonic()
+    scheduler.call_later(0.05, lambda: fired.append(monotonic()))
+    assert wait_for(lambda: fired)
+    assert fired[0] - start >= 0.05
+
+
+def test_an_earlier_call_wakes_the_scheduler(scheduler):
+    fired = []
+    scheduler.call_later(10, fired.append, 'late')
+    scheduler.call_later(0.01, fired.append, 'early')
+    assert wait_for(lambda: fired)
+    assert fired == ['early']
+
+
+def test_an_idle_scheduler_is_still_true(scheduler):
+    assert len(scheduler) == 0
+    assert scheduler
+    assert (scheduler or None) is scheduler
+
+
+def test_cancel(scheduler):
+    fired = []
+    call = scheduler.call_later(0.02, fired.append, 'cancelled')
+    scheduler.call_later(0.04, fired.append, 'kept')
+    call.cancel()
+    call.cancel()
+    assert len(scheduler) == 1
+    assert wait_for(lambda: fired)
+    time.sleep(0.02)
+    assert fired == ['kept']
+
+
+def test_cancelling_a_call_that_has_run_changes_nothing(scheduler):
+    fired = []
+    call = scheduler.call_later(0, fired.append, 1)
+    assert wait_for(lambda: fired)
+    call.cancel()
+    assert len(scheduler) == 0
+    assert scheduler._num_cancelled == 0
+
+
+def test_concurrent_cancels_as_calls_fire(scheduler):
+    scheduler.COMPACT_THRESHOLD = 50
+    fired = []
+    calls = [scheduler.call_later(random.random() * 0.1, fired.append, i) for i in range(2000)]
+
+    def cancel(calls):
+        for call in calls:
+            call.cancel()
+            call.cancel()
+
+    time.sleep(0.05)
+    threads = [threading.Thread(target=cancel, args=(calls[i::4],)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert wait_for(lambda: len(scheduler._heap) == scheduler._num_cancelled)
+    assert len(scheduler) == 0
+    assert len(fired) == len(set(fired))
+
+
+def test_a_failing_call_doesnt_stop_the_scheduler(scheduler):
+    fired = []
+    scheduler.call_later(0, lambda: 1 / 0)
+    scheduler.call_later(0.01, fired.append, 'after')
+    assert wait_for(lambda: fired)
+
+
+def test_stop_discards_pending_calls(scheduler):
+    fired = []
+    call = scheduler.call_later(0.05, fired.append, 1)
+    scheduler.stop()
+    assert call.cancelled
+    assert len(scheduler) == 0
+    time.sleep(0.07)
+    assert fired == []
+    # and it starts again when needed
+    scheduler.call_later(0, fired.append, 2)
+    assert wait_for(lambda: fired == [2])
@@ -0,0 +1,120 @@
+from array import array
+
+import pytest
+
+from simplecoremidi import backends, ControllerChangeMessage, MIDIDestination, MIDISource, NoteOnMessage, clock
+from simplecoremidi.backends import Backend
+from simplecoremidi.backends.loopback import LoopbackBackend
+
+
+class RecordingBackend(LoopbackBackend):
+    """a loopback backend that records each call to send and send_batch"""
+
+    def __init__(self):
+        LoopbackBackend.__init__(self)
+        self.calls = []
+
+    def send(self, destination, data):
+        self.calls.append(('send', bytes(bytearray(data)), None))
+        LoopbackBackend.send(self, destination, data)
+
+    def send_batch(self, destination, data, packets=None):
+        self.calls.append(('send_batch', bytes(bytearray(data)), packets))
+        LoopbackBackend.send_batch(self, destination, data, packets)
+
+
+@pytest.fixture
+def recording(loopback):
+    return backends.set_backend(RecordingBackend())
+
+
+def test_send_many_makes_one_backend_call(recording):
+    destination = MIDIDestination('loopback', recording.port('loopback'))
+    messages = [NoteOnMessage(0, 60, 100), ControllerChangeMessage(0, 7, 127), NoteOnMessage(0, 60, 0)]
+    destination.send_many(messages)
+    assert recording.calls == [('send_batch', b''.join(m.toBytes() for m in messages), None)]
+    assert (destination.stats.messages, destination.stats.bytes, destination.stats.batches) == (3, 9, 1)
+
+
+def test_send_many_with_timestamps_gives_each_packet_its_time(recording):
+    destination = MIDIDestination('loopback', recording.port('loopback'))
+    now = clock.monotonic()
+    destination.send_many([NoteOnMessage(0, 60, 100), NoteOnMessage(0, 60, 0)], [now, now + 0.5])
+    name, data, packets = recording.calls[0]
+    assert packets == [(0, now), (3, now + 0.5)]
+
+
+def test_send_many_of_nothing_sends_nothing(recording):
+    MIDIDestination('loopback', recording.port('loopback')).send_many([])
+    assert recording.calls == []
+
+
+def test_default_send_batch_sends_each_packet():
+    class SendOnly(Backend):
+        def __init__(self):
+            self.sent = []
+
+        def send(self, destination, data):
+            self.sent.append(bytes(bytearray(data)))
+
+    backend = SendOnly()
+    backend.send_batch(None, b'\x90\x3c\x64\xc0\x01', [(0, 0), (3, 0)])
+    assert backend.sent == [b'\x90\x3c\x64', b'\xc0\x01']
+
+
+def test_coremidi_timestamps_must_be_near_now():
+    pytest.importorskip('simplecoremidi._simplecoremidi')
+    from simplecoremidi.backends.coremidi import _nanos, SCHEDULE_WINDOW
+    now = 1000.0
+    assert _nanos(0, now) == 0
+    assert _nanos(now - 1, now) == 0
+    assert _nanos(now + 1, now) == int((now + 1) * 1e9)
+    with pytest.raises(ValueError):
+        _nanos(now + SCHEDULE_WINDOW + 1, now)
+
+
+NOTES = b'\x90\x3c\x64\x80\x3c\x00'
+
+
+@pytest.mark.parametrize('data', [
+    NOTES, bytearray(NOTES), memoryview(NOTES), array('B', NOTES), tuple(bytearray(NOTES)), list(bytearray(NOTES))],
+    ids=['bytes', 'bytearray', 'memoryview', 'array', 'tuple', 'list'])
+def test_send_raw_data(recording, data):
+    port = recording.port('loopback')
+    source = MIDISource('loopback', port)
+    source.receive(timeout=0)
+    destination = MIDIDestination('loopback', port)
+    destination.send(data)
+    assert recording.calls == [('send', NOTES, None)]
+    assert [m.toBytes() for m in source.receive_many(timeout=0)] == [b'\x90\x3c\x64', b'\x80\x3c\x00']
+    assert (destination.stats.batches, destination.stats.bytes) == (1, 6)
+
+
+def test_buffers_are_handed_over_without_a_copy(loopback):
+    class Capturing(LoopbackBackend):
+        def send(self, destination, data):
+            self.data = data
+    capturing = backends.set_backend(Capturing())
+    destination = MIDIDestination('loopback', capturing.port('loopback'))
+    for data in (NOTES, bytearray(NOTES), memoryview(NOTES), array('B', NOTES)):
+        destination.send(data)
+        assert capturing.data is data
+
+
+def test_a_slice_of_a_larger_buffer(recording):
+    buffer = bytearray(b'\x00' * 10 + NOTES + b'\x00' * 10)
+    MIDIDestination('loopback', recording.port('loopback')).send(memoryview(buffer)[10:16])
+    assert recording.calls == [('send', NOTES, None)]
+
+
+@pytest.mark.parametrize('data', [NOTES, memoryview(NOTES), array('B', NOTES)], ids=['bytes', 'memoryview', 'array'])
+def test_raw_data_through_a_rate_limit(loopback, data):
+    port = loopback.port('loopback')
+    source = MIDISource('loopback', port)
+    source.receive(timeout=0)
+    destination = MIDIDestination('loopback', port)
+    rate = destination.limit_rate(3125)
+    destination.send(data)
+    assert rate.pending() == 2
+    destination.limit_rate(None)
+    assert [m.toBytes() for m in source.receive_many(timeout=0)] == [b'\x90\x3c\x64', b'\x80\x3c\x00']
@@ -0,0 +1,120 @@
+import struct
+import pytest
+
+from simplecoremidi import MIDIDestination, MIDISource, smf
+
+MESSAGES = [
+    (0.0, b'\x90\x3c\x64'),
+    (0.25, b'\x90\x3e\x64'),                 # running status
+    (0.25, b'\xf0\x7e\x7f\x06\x01\xf7'),     # SysEx
+    (0.5, b'\xf8'),                          # realtime, as an escape
+    (0.5, b'\x90\x3c\x00'),                  # the status is written again after the escape
+    (1.0, b'\xb0\x07\x7f'),
+    (1.5, b'\xe0\x00\x40'),
+]
+
+
+def write(path, events, **kwargs):
+    with smf.SMFWriter(str(path), **kwargs) as writer:
+        for seconds, data in events:
+            writer.write(data, 100 + seconds)
+    return writer
+
+
+def chunk(kind, data):
+    return struct.pack('>4sI', kind, len(data)) + data
+
+
+def test_write_and_read_back(tmp_path):
+    path = tmp_path / 'capture.mid'
+    assert write(path, MESSAGES).events == len(MESSAGES)
+    with smf.SMFReader(str(path)) as reader:
+        assert (reader.format, len(reader.tracks), reader.ticks_per_beat) == (0, 1, smf.DEFAULT_TICKS_PER_BEAT)
+        events = list(reader.events())
+    assert [bytes(data) for seconds, data in events] == [data for seconds, data in MESSAGES]
+    for (seconds, data), (expected, data) in zip(events, MESSAGES):
+        assert seconds == pytest.approx(expected, abs=1e-3)
+
+
+def test_messages_are_parsed(tmp_path):
+    path = tmp_path / 'capture.mid'
+    write(path, MESSAGES)
+    with smf.SMFReader(str(path)) as reader:
+        assert [m.toBytes() for seconds, m in reader] == [data for seconds, data in MESSAGES]
+
+
+def test_reads_across_windows(tmp_path, monkeypatch):
+    monkeypatch.setattr(smf, 'WINDOW', 64)
+    events = [(i * 0.01, bytes(bytearray((0x90, i % 128, 100)))) for i in range(500)]
+    events.insert(250, (2.5, b'\xf0' + b'\x01' * 200 + b'\xf7'))
+    path = tmp_path / 'long.mid'
+    write(path, sorted(events, key=lambda event: event[0]))
+    with smf.SMFReader(str(path)) as reader:
+        assert sorted(bytes(data) for seconds, data in reader.events()) == sorted(data for seconds, data in events)
+
+
+def test_out_of_order_timestamps_are_clamped(tmp_path):
+    path = tmp_path / 'capture.mid'
+    write(path, [(1.0, b'\x90\x3c\x64'), (0.5, b'\x80\x3c\x00')])
+    with smf.SMFReader(str(path)) as reader:
+        assert [seconds for seconds, data in reader.events()] == [0.0, 0.0]
+
+
+def test_format_1_tracks_merge_by_time_and_follow_tempo(tmp_path):
+    # 100 ticks a beat; the first track doubles the tempo (250000us a beat) at tick 100
+    first = (b'\x00\x90\x3c\x64'
+             b'\x64\xff\x51\x03\x03\xd0\x90'
+             b'\x64\x80\x3c\x00'
+             b'\x00\xff\x2f\x00')
+    second = (b'\x32\xb0\x07\x40'
+              b'\x64\x07\x7f'                # running status
+              b'\x00\xff\x2f\x00')
+    path = tmp_path / 'format1.mid'
+    path.write_bytes(struct.pack('>4sIHHH', b'MThd', 6, 1, 2, 100) + chunk(b'MTrk', first) + chunk(b'MTrk', second))
+    with smf.SMFReader(str(path)) as reader:
+        events = [(round(seconds, 6), bytes(data)) for seconds, data in reader.events()]
+    assert events == [
+        (0.0, b'\x90\x3c\x64'),
+        (0.25, b'\xb0\x07\x40'),
+        (0.625, b'\xb0\x07\x7f'),
+        (0.75, b'\x80\x3c\x00'),
+    ]
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / 'not.mid'
+    path.write_bytes(b'RIFF' + b'\0' * 20)
+    with pytest.raises(smf.SMFError):
+        smf.SMFReader(str(path))
+
+
+def test_replay_into_a_function(tmp_path):
+    path = tmp_path / 'capture.mid'
+    write(path, MESSAGES)
+    played = []
+    assert smf.replay(str(path), played.append, speed=0) == len(MESSAGES)
+    assert [m.toBytes() for m in played] == [data for seconds, data in MESSAGES]
+
+
+def test_replay_keeps_time(tmp_path):
+    path = tmp_path / 'capture.mid'
+    write(path, [(0.0, b'\x90\x3c\x64'), (0.2, b'\x80\x3c\x00')])
+    played = []
+    start = smf.monotonic()
+    smf.replay(str(path), lambda message: played.append(smf.monotonic() - start), speed=2)
+    assert played[1] - played[0] == pytest.approx(0.1, abs=0.05)
+
+
+def test_record_and_replay_round_trip(loopback, tmp_path):
+    port = loopback.port('loopback')
+    source = MIDISource('loopback', port)
+    path = tmp_path / 'session.mid'
+    # sources connect when first used, and buffer everything that arrives from then on
+    assert source.receive_packets(timeout=0) is None
+    for seconds, data in MESSAGES:
+        port.inject(data)
+    assert smf.record(source, str(path), duration=0.1) == len(MESSAGES)
+
+    destination = MIDIDestination('loopback', port)
+    assert smf.replay(str(path), destination, speed=0) == len(MESSAGES)
+    assert [m.toBytes() for m in source.receive_many(timeout=0)] == [data for seconds, data in MESSAGES]
@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+from simplecoremidi import MIDIDestination, MIDISource
+from simplecoremidi.stats import EndpointStats, LatencyHistogram
+
+
+def test_histogram_buckets_are_powers_of_two_microseconds():
+    histogram = LatencyHistogram()
+    for seconds in (0.5e-6, 3e-6, 3e-6, 100e-6):
+        histogram.record(seconds)
+    assert histogram.counts[0] == 1
+    assert histogram.counts[2] == 2
+    assert histogram.counts[7] == 1
+    assert histogram.count == 4
+    assert histogram.max == 100e-6
+
+
+def test_histogram_percentiles_are_upper_bounds():
+    histogram = LatencyHistogram()
+    for i in range(99):
+        histogram.record(10e-6)
+    histogram.record(0.01)
+    assert 10e-6 <= histogram.percentile(50) <= 16e-6
+    assert histogram.percentile(99) <= 16e-6
+    assert histogram.percentile(100) == 0.01
+    summary = histogram.summary()
+    assert summary['count'] == 100
+    assert summary['mean'] == pytest.approx((99 * 10e-6 + 0.01) / 100)
+
+
+def test_histogram_clamps_negative_and_huge_latencies():
+    histogram = LatencyHistogram()
+    histogram.record(-1)
+    histogram.record(1e9)
+    assert histogram.counts[0] == 1
+    assert histogram.counts[LatencyHistogram.BUCKETS - 1] == 1
+
+
+def test_empty_histogram():
+    assert LatencyHistogram().summary() == {'count': 0, 'mean': 0.0, 'p50': 0.0, 'p99': 0.0, 'max': 0.0}
+
+
+def test_reset():
+    stats = EndpointStats('test')
+    stats.messages = 5
+    stats.latency.record(1)
+    stats.reset()
+    assert stats.messages == 0
+    assert stats.latency.count == 0
+
+
+def test_endpoint_stats_count_traffic(loopback):
+    port = loopback.port('loopback')
+    source = MIDISource('loopback', port)
+    destination = MIDIDestination('loopback', port)
+    source.receive(timeout=0)
+    destination.send_bytes((0x90, 60, 100, 62, 100))
+    source.receive_many(timeout=0)
+    # a stray end of exclusive cancels the running status, leaving a data byte with no status
+    port.inject([0xF7, 5])
+    source.receive_many(timeout=0)
+    summary = source.stats.summary()
+    assert (summary['messages'], summary['bytes'], summary['batches'], summary['dropped']) == (2, 7, 2, 1)
+    assert summary['latency']['count'] == 2
+    assert destination.stats.summary()['bytes'] == 5
+    # summaries are plain data, ready to dump
+    json.dumps(summary)
@@ -0,0 +1,183 @@
+import io
+import threading
+
+import pytest
+
+from simplecoremidi import MIDIDestination, MIDISource, backends, sysex
+from simplecoremidi.backends.loopback import LoopbackBackend
+
+
+class PacedBackend(LoopbackBackend):
+    """sends SysEx a few bytes at each wait, as CoreMIDI paces it to a device"""
+
+    class Request(object):
+        def __init__(self, destination, data):
+            self.destination = destination
+            self.data = data
+            self.sent = 0
+            self.cancelled = False
+
+    def __init__(self, step=16):
+        LoopbackBackend.__init__(self)
+        self.step = step
+        self.requests = []
+
+    def send_sysex(self, destination, data):
+        request = self.Request(destination, bytes(data))
+        self.requests.append(request)
+        return request
+
+    def sysex_progress(self, request):
+        return request.sent, request.cancelled or request.sent == len(request.data)
+
+    def wait_sysex(self, request, timeout=None):
+        if not request.cancelled and request.sent < len(request.data):
+            step = request.data[request.sent:request.sent + self.step]
+            self.send_batch(request.destination, step)
+            request.sent += len(step)
+        return self.sysex_progress(request)[1]
+
+    def cancel_sysex(self, request):
+        request.cancelled = True
+
+
+def dump(messages, size):
+    return b''.join(b'\xf0' + bytes(bytearray([i % 128] * size)) + b'\xf7' for i in range(messages))
+
+
+@pytest.fixture
+def ports(loopback):
+    port = loopback.port('loopback')
+    source = MIDISource('loopback', port)
+    source.receive(timeout=0)
+    return source, MIDIDestination('loopback', port)
+
+
+@pytest.mark.parametrize('data', [dump(10, 20), dump(3, 200), b'\xf0' + b'\x01' * 100, b''])
+def test_chunks_end_with_messages_where_they_can(data):
+    chunks = list(sysex._chunks(io.BytesIO(data).read, 64))
+    assert b''.join(chunks) == data
+    for chunk in chunks:
+        assert 0 < len(chunk) <= 64
+        # a chunk holding the end of a message ends with it
+        assert b'\xf7' not in chunk or chunk.endswith(b'\xf7')
+
+
+def test_send_in_chunks(ports):
+    source, destination = ports
+    data = dump(10, 100)
+    reports = []
+    transfer = destination.send_sysex(data, chunk_size=256, progress=lambda t: reports.append(t.sent))
+    assert transfer.wait(5)
+    assert (transfer.done(), transfer.error, transfer.total, transfer.sent) == (True, None, len(data), len(data))
+    assert reports[-1] == len(data) and reports == sorted(reports)
+    received, packets = source.receive_packets(timeout=0)
+    assert received == data
+    assert (destination.stats.bytes, destination.stats.messages) == (len(data), 10)
+    assert destination.stats.batches == len(list(sysex._chunks(io.BytesIO(data).read, 256)))
+
+
+def test_send_from_a_file(ports):
+    source, destination = ports
+    data = dump(4, 50)
+    transfer = destination.send_sysex(io.BytesIO(data), chunk_size=64)
+    assert transfer.wait(5)
+    assert transfer.total is None and transfer.sent == len(data)
+    assert source.receive_packets(timeout=0)[0] == data
+
+
+def test_progress_while_a_chunk_is_paced(loopback, monkeypatch):
+    paced = backends.set_backend(PacedBackend(step=16))
+    monkeypatch.setattr(sysex, 'PROGRESS_INTERVAL', 0)
+    destination = MIDIDestination('loopback', paced.port('loopback'))
+    reports = []
+    transfer = destination.send_sysex(dump(1, 62), chunk_size=64, progress=lambda t: reports.append(t.sent))
+    assert transfer.wait(5)
+    assert reports[:4] == [16, 32, 48, 64]
+
+
+def test_cancel(loopback):
+    paced = backends.set_backend(PacedBackend(step=16))
+    destination = MIDIDestination('loopback', paced.port('loopback'))
+    started = threading.Event()
+    release = threading.Event()
+
+    def progress(transfer):
+        started.set()
+        release.wait(5)
+    transfer = destination.send_sysex(dump(10, 62), chunk_size=64, progress=progress)
+    assert started.wait(5)
+    transfer.cancel()
+    release.set()
+    assert transfer.wait(5)
+    assert transfer.error is None and 0 < transfer.sent < 640
+    assert len(paced.requests) == 1 and paced.requests[0].cancelled
+
+
+def test_an_error_ends_the_transfer(loopback):
+    class Broken(LoopbackBackend):
+        def send_sysex(self, destination, data):
+            raise IOError("unplugged")
+    broken = backends.set_backend(Broken())
+    transfer = MIDIDestination('loopback', broken.port('loopback')).send_sysex(dump(1, 10))
+    assert transfer.wait(5)
+    assert isinstance(transfer.error, IOError) and transfer.sent == 0
+
+
+def test_reassembly_across_reads():
+    sink = io.BytesIO()
+    reports = []
+    reassembler = sysex.SysExReassembler(sink, progress=lambda r: reports.append((r.bytes, r.messages)))
+    assert reassembler.feed(b'\x90\x3c\x64\xf0\x01\x02') == b'\x90\x3c\x64'
+    assert reassembler.in_message
+    # realtime bytes within a message are passed on, not written
+    assert reassembler.feed(b'\x03\xf8\x04') == b'\xf8'
+    assert reassembler.feed(b'\x05\xf7\xb0\x07\x7f') == b'\xb0\x07\x7f'
+    assert reassembler.feed(b'\x80\x3c\x00') == b'\x80\x3c\x00'
+    assert sink.getvalue() == b'\xf0\x01\x02\x03\x04\x05\xf7'
+    assert (reassembler.bytes, reassembler.messages, reassembler.truncated) == (7, 1, 0)
+    assert reports == [(3, 0), (5, 0), (7, 1)]
+
+
+def test_a_status_byte_truncates_a_message():
+    sink = io.BytesIO()
+    reassembler = sysex.SysExReassembler(sink)
+    assert reassembler.feed(b'\xf0\x01\x02\x90\x3c\x64\xf0\x03\xf7') == b'\x90\x3c\x64'
+    assert sink.getvalue() == b'\xf0\x01\x02\xf7\xf0\x03\xf7'
+    assert (reassembler.messages, reassembler.truncated) == (2, 1)
+
+
+def test_receive_sysex(ports):
+    source, destination = ports
+    port = destination._destination()
+    port.inject(b'\x90\x3c\x64\xf0\x01')
+    port.inject(b'\x02\xf7\xf0\x03\xf7\x80\x3c\x00')
+    sink = io.BytesIO()
+    received = source.receive_sysex(sink, count=2, idle_timeout=0.05)
+    assert (received.messages, sink.getvalue()) == (2, b'\xf0\x01\x02\xf7\xf0\x03\xf7')
+    # other messages are queued on the source
+    assert [m.toBytes() for m in source.receive_many(timeout=0)] == [b'\x90\x3c\x64', b'\x80\x3c\x00']
+
+    # without a count, until the source goes quiet
+    port.inject(b'\xf0\x04\xf7')
+    port.inject(b'\xf0\x05\xf7')
+    sink = io.BytesIO()
+    assert source.receive_sysex(sink, idle_timeout=0.05).messages == 2
+    assert sink.getvalue() == b'\xf0\x04\xf7\xf0\x05\xf7'
+
+
+def test_receive_sysex_times_out(ports):
+    source, destination = ports
+    received = source.receive_sysex(io.BytesIO(), timeout=0.05)
+    assert (received.messages, received.started) == (0, None)
+
+
+def test_send_and_receive_a_large_dump(ports):
+    source, destination = ports
+    data = dump(50, 1000)
+    transfer = destination.send_sysex(data, chunk_size=1024)
+    sink = io.BytesIO()
+    received = source.receive_sysex(sink, count=50, timeout=5)
+    assert transfer.wait(5)
+    assert (received.messages, received.truncated, sink.getvalue()) == (50, 0, data)
+    assert received.throughput() >= 0